@@ -1,22 +1,432 @@
 # Arquivo completo para Elastic Beanstalk
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_CA_BUNDLE_PATH, extract_zipped_paths, get_encoding_from_headers
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.ssl_ import create_urllib3_context
+from urllib3.util.retry import Retry
 import re
+import codecs
+import html
+import itertools
+import io
+import json
+import logging
+import math
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+import base64
+import email.utils
+import hashlib
 import os
-from urllib.parse import urljoin, urlparse
+import shutil
+import ssl
+import traceback
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urljoin, urlparse, urlunparse
+from werkzeug.wsgi import wrap_file
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente do arquivo .env
 load_dotenv()
 
 # Versão da API
-VERSION = "1.0.7"
+VERSION = "1.0.28"
+
+# Limites do motor de escaneamento concorrente
+SCAN_MAX_WORKERS = int(os.environ.get("SCAN_MAX_WORKERS", 16))
+SCAN_MAX_PER_HOST = int(os.environ.get("SCAN_MAX_PER_HOST", 6))
+SIZE_PROBE_MAX_WORKERS = int(os.environ.get("SIZE_PROBE_MAX_WORKERS", 16))
+
+# Orçamento de cada escaneamento (máximos do servidor; a requisição pode reduzir)
+SCAN_DEADLINE_SECONDS = float(os.environ.get("SCAN_DEADLINE_SECONDS", 25))
+SCAN_MAX_PAGES = int(os.environ.get("SCAN_MAX_PAGES", 2000))
+SCAN_MAX_FILES = int(os.environ.get("SCAN_MAX_FILES", 50000))
+SCAN_MAX_LISTING_BYTES = int(os.environ.get("SCAN_MAX_LISTING_MB", 16)) * 1024 * 1024
+SCAN_DEFAULT_DEPTH = 3
+SCAN_MAX_DEPTH = int(os.environ.get("SCAN_MAX_DEPTH", 10))
+SCAN_TOKEN_VERSION = 1
+
+# Governador por host do escaneamento (AIMD, Retry-After e disjuntor)
+SCAN_BREAKER_THRESHOLD = int(os.environ.get("SCAN_BREAKER_THRESHOLD", 5))
+SCAN_RETRY_AFTER_MAX = float(os.environ.get("SCAN_RETRY_AFTER_MAX", 30))
+SCAN_MIN_TIMEOUT = float(os.environ.get("SCAN_MIN_TIMEOUT", 5))
+SCAN_LISTING_TIMEOUT = 30
+SCAN_PROBE_TIMEOUT = 10
+SCAN_TIMEOUT_FACTOR = 4
+SCAN_SLOW_FACTOR = 3
+SCAN_MAX_ATTEMPTS = 2
+SCAN_THROTTLE_BACKOFF = 1.0
+SCAN_STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
+# Extensões aceitas por tipo de arquivo (consulta em conjunto pré-calculado)
+FILE_TYPE_EXTENSIONS = {
+    'zip': frozenset(['.zip', '.7z', '.rar', '.tar', '.gz', '.bz2']),
+    'images': frozenset(['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.svg']),
+    'pdf': frozenset(['.pdf'])
+}
+
+# Extração de links das listagens HTML
+LISTING_CHUNK_SIZE = 64 * 1024
+LISTING_MAX_PENDING = 64 * 1024
+SRC_TAGS = frozenset(['img', 'script', 'iframe', 'video', 'audio', 'source', 'embed'])
+HTML_LINK_TAG_PATTERN = re.compile(
+    r'<(a|base|img|script|iframe|video|audio|source|embed)(?=[\s/>])((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>',
+    re.IGNORECASE
+)
+HTML_ANCHOR_TAG_PATTERN = re.compile(
+    r'<(a|base)(?=[\s/>])((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>',
+    re.IGNORECASE
+)
+HTML_ANY_TAG_PATTERN = re.compile(r'<[^>]*>')
+HTML_ATTR_PATTERN = re.compile(r'([^\s"\'=<>/]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+))?')
+FALLBACK_LINK_PATTERNS = {
+    'pdf': re.compile(r'[^"\'>\s]+\.pdf(?:\?[^"\'>\s]*)?', re.IGNORECASE),
+    'zip': re.compile(r'[^"\'>\s]+\.(?:zip|7z|rar|tar|gz|bz2)(?:\?[^"\'>\s]*)?', re.IGNORECASE),
+    'images': re.compile(r'[^"\'>\s]+\.(?:png|jpg|jpeg|gif|bmp|webp|svg)(?:\?[^"\'>\s]*)?', re.IGNORECASE)
+}
+
+# Coluna "Size" das listagens autoindex do Apache/nginx
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+AUTOINDEX_SIZE_PATTERN = re.compile(
+    r'(?:\d{1,2}-\w{3}-\d{4}|\d{4}-\d{2}-\d{2})\s+\d{1,2}:\d{2}(?::\d{2})?\s+(\d+(?:\.\d+)?[KMGT]?|-)',
+    re.IGNORECASE
+)
+AUTOINDEX_ROW_MAX_TEXT = 512
+
+# Cache de listagens do /scan
+SCAN_CACHE_MAX_ENTRIES = int(os.environ.get("SCAN_CACHE_MAX_ENTRIES", 2048))
+
+# Índice persistente de sites (/changes e prioridade dos re-escaneamentos); vazio desativa
+SITE_INDEX_DB = os.environ.get("SITE_INDEX_DB", os.path.join(tempfile.gettempdir(), 'autohunter-site-index.db'))
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Normalização de URLs (chaves de cache e deduplicação de arquivos)
+URL_UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+URL_ESCAPE_PATTERN = re.compile(r'%([0-9A-Fa-f]{2})')
+URL_TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid')
+# Variantes Plone/gov.br do mesmo arquivo: .../view, .../@@download/file e .../@@download/file/<nome>
+PLONE_DOWNLOAD_SUFFIX_PATTERN = re.compile(r'/(?:view|@@download/file(?:/[^/]*)?)$')
+
+# Pool de conexões HTTP keep-alive por host
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 16))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 2))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.5))
+HTTP_RETRY_STATUS = (429, 500, 502, 503, 504)
+HTTP_RETRY_AFTER_MAX = float(os.environ.get("HTTP_RETRY_AFTER_MAX", 5))
+
+# Pré-aquecimento na importação (contexto TLS e SQLite prontos antes da primeira requisição)
+WARM_START = os.environ.get("WARM_START", "0").lower() in ('1', 'true', 'yes')
+
+# Download de arquivos / ZIP em streaming
+DOWNLOAD_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+ZIP_STREAM_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_ERRORS_ENTRY = '_erros_download.txt'
+DOWNLOAD_DUPLICATES_ENTRY = '_duplicados.txt'
+DOWNLOAD_ORDERS = ('request', 'completion')
+DOWNLOAD_MAX_PARALLEL = int(os.environ.get("DOWNLOAD_MAX_PARALLEL", 4))
+DOWNLOAD_MAX_PER_HOST = int(os.environ.get("DOWNLOAD_MAX_PER_HOST", 3))
+DOWNLOAD_INFLIGHT_BYTES = int(os.environ.get("DOWNLOAD_INFLIGHT_MB", 64)) * 1024 * 1024
+DOWNLOAD_CACHE_DIR = os.environ.get("DOWNLOAD_CACHE_DIR") or os.path.join(tempfile.gettempdir(), 'autohunter-download-cache')
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get("DOWNLOAD_CACHE_MAX_MB", 1024)) * 1024 * 1024
+
+# Download único de arquivos grandes: acima do limite, streaming (em faixas paralelas se o servidor aceitar Range)
+DOWNLOAD_LARGE_THRESHOLD = int(os.environ.get("DOWNLOAD_LARGE_THRESHOLD_MB", 32)) * 1024 * 1024
+DOWNLOAD_RANGE_PART_SIZE = int(os.environ.get("DOWNLOAD_RANGE_PART_MB", 8)) * 1024 * 1024
+DOWNLOAD_RANGE_CONNECTIONS = int(os.environ.get("DOWNLOAD_RANGE_CONNECTIONS", 4))
+DOWNLOAD_RANGE_RETRIES = int(os.environ.get("DOWNLOAD_RANGE_RETRIES", 3))
+DOWNLOAD_RANGE_TIMEOUT = 30
+
+# Jobs de download em segundo plano (/download e /jobs)
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", 2))
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 3600))
+JOB_SPOOL_MAX_BYTES = int(os.environ.get("JOB_SPOOL_MAX_MB", 32)) * 1024 * 1024
+JOB_READ_CHUNK_SIZE = 256 * 1024
+
+# Política de compressão por entrada do ZIP
+COMPRESSION_MODES = ('auto', 'store', 'deflate')
+COMPRESSION_NAMES = {zipfile.ZIP_STORED: 'stored', zipfile.ZIP_DEFLATED: 'deflated'}
+ZIP_COMPRESSION_LEVEL = int(os.environ.get("ZIP_COMPRESSION_LEVEL", 6))
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MIN_RATIO = 0.95
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.zip', '.7z', '.rar', '.gz', '.tgz', '.bz2', '.xz', '.zst',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp3', '.mp4', '.avi', '.mkv', '.mov', '.ogg',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods'
+])
+INCOMPRESSIBLE_CONTENT_TYPES = frozenset([
+    'application/zip', 'application/x-7z-compressed', 'application/x-rar-compressed',
+    'application/vnd.rar', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'image/jpeg', 'image/png', 'image/gif', 'image/webp'
+])
+
+# Observabilidade: logs com nível e métricas no formato do Prometheus
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class JsonLogFormatter(logging.Formatter):
+    """Uma linha JSON por evento, incluindo os campos passados em ``extra``"""
+    
+    RESERVED = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+    
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        data.update((key, value) for key, value in record.__dict__.items() if key not in self.RESERVED)
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    log = logging.getLogger('autohunter')
+    log.handlers[:] = [handler]
+    log.setLevel(level)
+    log.propagate = False
+    return log
+
+logger = configure_logging()
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    """Série de métricas (counter, gauge ou histogram) com labels"""
+    
+    def __init__(self, name, kind, help_text, label_names=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets or ())
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observa a duração do bloco (histogram)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    @contextmanager
+    def track(self, **labels):
+        """Conta o bloco como em andamento enquanto executa (gauge)"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+    
+    def _labels(self, key, extra=None):
+        pairs = list(zip(self.label_names, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + '}'
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted(self._values.items())
+            if self.kind == 'histogram':
+                values = [(key, ([*state[0]], state[1], state[2])) for key, state in values]
+        for key, value in values:
+            if self.kind != 'histogram':
+                lines.append(f"{self.name}{self._labels(key)} {value}")
+                continue
+            counts, total, count = value
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{self._labels(key, ('le', repr(float(bound))))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{self._labels(key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Registro das métricas do processo, exposto em /metrics.
+
+    Além das séries instrumentadas diretamente, ``add_collector`` registra
+    funções chamadas a cada coleta que retornam valores já mantidos em outros
+    componentes (caches, pools), como tuplas ``(nome, tipo, ajuda, amostras)``.
+    """
+    
+    def __init__(self, prefix='autohunter'):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = []
+    
+    def _add(self, name, kind, help_text, labels, buckets=None):
+        metric = Metric(f"{self.prefix}_{name}", kind, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, help_text, labels=()):
+        return self._add(name, 'counter', help_text, labels)
+    
+    def gauge(self, name, help_text, labels=()):
+        return self._add(name, 'gauge', help_text, labels)
+    
+    def histogram(self, name, help_text, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+        return self._add(name, 'histogram', help_text, labels, buckets)
+    
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+        return collector
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, kind, help_text, samples in collector():
+                metric = Metric(f"{self.prefix}_{name}", kind, help_text, sorted({k for labels, _ in samples for k in labels}))
+                for labels, value in samples:
+                    metric.set(value, **labels)
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram('stage_seconds', 'Duração de cada estágio (connect, listagem, parse, HEAD, download, escrita do ZIP)', ['stage'])
+UPSTREAM_SECONDS = metrics.histogram('upstream_response_seconds', 'Tempo até os headers das respostas do upstream, por host', ['host'])
+UPSTREAM_RESPONSES = metrics.counter('upstream_responses_total', 'Respostas recebidas do upstream, por host e status', ['host', 'status'])
+BYTES_IN = metrics.counter('bytes_in_total', 'Bytes recebidos do upstream', ['kind'])
+BYTES_OUT = metrics.counter('bytes_out_total', 'Bytes enviados aos clientes', ['endpoint'])
+IN_FLIGHT = metrics.gauge('in_flight', 'Operações em andamento', ['kind'])
+HTTP_REQUESTS = metrics.counter('http_requests_total', 'Requisições atendidas pela API', ['endpoint', 'method', 'status'])
+GOVERNOR_EVENTS = metrics.counter('host_governor_events_total', 'Ações do governador por host do escaneamento', ['event'])
+DEDUPLICATED = metrics.counter('deduplicated_total', 'Arquivos repetidos descartados (escaneamento, pedido e conteúdo do ZIP)', ['kind'])
+HTTP_REQUEST_SECONDS = metrics.histogram('http_request_seconds', 'Tempo até a resposta (headers) da API', ['endpoint'])
+
+class TimedConnectionMixin:
+    """Mede resolução DNS + conexão TCP e o handshake TLS das conexões novas"""
+    
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            self._connect_seconds = time.perf_counter() - start
+            STAGE_SECONDS.observe(self._connect_seconds, stage='dns_connect')
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        self._connect_seconds = 0.0
+        super().connect()
+        STAGE_SECONDS.observe(max(time.perf_counter() - start - self._connect_seconds, 0.0), stage='tls_handshake')
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class InstrumentedHTTPAdapter(HTTPAdapter):
+    """``HTTPAdapter`` cujas conexões registram os tempos de connect/TLS.
+
+    Com ``tls_context`` (função que retorna o ``SSLContext`` pronto de um
+    bundle de CAs), as conexões HTTPS verificadas usam esse contexto
+    compartilhado em vez de criar um e reler o bundle a cada conexão nova.
+    """
+    
+    def __init__(self, *args, tls_context=None, **kwargs):
+        self.tls_context = tls_context
+        super().__init__(*args, **kwargs)
+    
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        # verify=False ou certificado de cliente: contexto próprio por conexão, como no requests
+        if self.tls_context is not None and verify and not cert and url.lower().startswith('https'):
+            location = extract_zipped_paths(DEFAULT_CA_BUNDLE_PATH) if verify is True else verify
+            conn.conn_kw['ssl_context'] = self.tls_context(location)
+            conn.ca_certs = conn.ca_cert_dir = None
+        else:
+            conn.conn_kw.pop('ssl_context', None)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+def record_upstream_response(response, *args, **kwargs):
+    """Hook do ``requests``: latência e status por host"""
+    host = urlparse(response.url).hostname or ''
+    UPSTREAM_SECONDS.observe(response.elapsed.total_seconds(), host=host)
+    UPSTREAM_RESPONSES.inc(host=host, status=response.status_code)
 
 # Criar a aplicação Flask
 app = Flask(__name__)
 CORS(app, origins=["*"], allow_headers=["*"], methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    start = g.get('request_start')
+    if start is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+    return response
+
 @app.route('/')
 def home():
     return jsonify({
@@ -24,8 +434,14 @@ def home():
         "version": VERSION,
         "endpoints": {
             "/scan": "POST - Escanear URLs por arquivos",
-            "/download": "POST - Download de arquivos (placeholder)",
-            "/download-stream": "POST - Download de múltiplos arquivos como ZIP"
+            "/scan-stream": "GET/POST - Escanear com resultados incrementais (NDJSON ou SSE)",
+            "/changes": "GET - Arquivos novos e removidos de um site indexado desde ?since=",
+            "/download": "POST - Cria um job de download em segundo plano (retorna job_id)",
+            "/jobs/<id>": "GET - Progresso de um job de download",
+            "/jobs/<id>/download": "GET - Resultado do job (aceita Range para retomar)",
+            "/download-stream": "POST - Download de múltiplos arquivos como ZIP",
+            "/stats": "GET - Estatísticas internas (pools de conexão)",
+            "/metrics": "GET - Métricas no formato do Prometheus"
         }
     })
 
@@ -34,315 +450,2976 @@ def scan_options():
     """Handle preflight requests for CORS"""
     return '', 200
 
-def get_file_extension(filename):
-    """Extrai a extensão do arquivo"""
-    return os.path.splitext(filename)[1].lower()
+def get_file_extension(filename):
+    """Extrai a extensão do arquivo"""
+    return os.path.splitext(filename)[1].lower()
+
+def should_include_file(filename, file_type):
+    """Verifica se o arquivo deve ser incluído baseado no tipo"""
+    return get_file_extension(filename) in FILE_TYPE_EXTENSIONS.get(file_type, ())
+
+def is_valid_url(url):
+    """Verifica se a URL é válida"""
+    try:
+        result = urlparse(url)
+        return all([result.scheme, result.netloc])
+    except:
+        return False
+
+def has_credentials(url):
+    """Verifica se a URL contém credenciais (usuário/senha)"""
+    try:
+        result = urlparse(url)
+        return bool(result.username or result.password)
+    except:
+        return False
+
+def parse_retry_after(value):
+    """Segundos de espera de um header Retry-After (número ou data HTTP)"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+class CappedRetry(Retry):
+    """``Retry`` que não dorme mais que ``HTTP_RETRY_AFTER_MAX`` por um Retry-After.
+
+    Com uma espera maior a resposta volta na hora, sem dormir nem repetir:
+    quem decide é o governador do escaneamento, que adia o host inteiro (ou
+    abre o disjuntor) sem prender uma thread dormindo.
+    """
+    
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and self.respect_retry_after_header:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > HTTP_RETRY_AFTER_MAX:
+                # Com raise_on_status=False o urllib3 devolve a própria resposta
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After de {retry_after:.0f}s"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+def parse_host_retry_policy(value):
+    """Lê políticas por host no formato "host=tentativas:backoff,host2=..." """
+    policies = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        try:
+            host, policy = item.split('=', 1)
+            retries, backoff = policy.split(':', 1)
+            policies[host.strip().lower()] = (int(retries), float(backoff))
+        except ValueError:
+            logger.warning("Política de retry inválida ignorada: %s", item)
+    return policies
+
+class HostSessionPool:
+    """Sessões HTTP keep-alive compartilhadas, uma por host.
+
+    Cada sessão tem um ``HTTPAdapter`` com pool de conexões dimensionado e
+    política de retry/backoff própria do host, de modo que escaneamento e
+    downloads reaproveitem conexões TCP/TLS em vez de abrir uma por requisição.
+    """
+    
+    def __init__(self, pool_maxsize=HTTP_POOL_MAXSIZE, retries=HTTP_RETRIES,
+                 backoff=HTTP_BACKOFF, host_policies=None):
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff = backoff
+        self.host_policies = host_policies or {}
+        self._sessions = {}
+        self._tls_contexts = {}
+        self._lock = threading.Lock()
+    
+    def _host_key(self, url):
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.hostname or ''}:{parsed.port or ''}".lower()
+    
+    def _build_session(self, host):
+        retries, backoff = self.host_policies.get(host, (self.retries, self.backoff))
+        retry = CappedRetry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=HTTP_RETRY_STATUS,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = InstrumentedHTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize, max_retries=retry,
+                                          tls_context=self.tls_context)
+        session = requests.Session()
+        session.hooks['response'].append(record_upstream_response)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    
+    def tls_context(self, ca_location):
+        """Contexto TLS com o bundle (arquivo ou diretório) de CAs já carregado, um
+        por processo: carregar o bundle custa dezenas de ms de CPU, antes pagos a
+        cada conexão HTTPS nova"""
+        context = self._tls_contexts.get(ca_location)
+        if context is None:
+            with self._lock:
+                context = self._tls_contexts.get(ca_location)
+                if context is None:
+                    context = create_urllib3_context(cert_reqs=ssl.CERT_REQUIRED)
+                    if os.path.isdir(ca_location):
+                        context.load_verify_locations(capath=ca_location)
+                    else:
+                        context.load_verify_locations(cafile=ca_location)
+                    self._tls_contexts[ca_location] = context
+        return context
+    
+    def warm_up(self):
+        """Pré-carrega o contexto TLS do bundle que o requests usaria por padrão"""
+        location = (os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE')
+                    or extract_zipped_paths(DEFAULT_CA_BUNDLE_PATH))
+        self.tls_context(location)
+    
+    def session_for(self, url):
+        """Retorna a sessão compartilhada do host da URL"""
+        key = self._host_key(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._build_session(urlparse(url).hostname or '')
+                    self._sessions[key] = session
+        return session
+    
+    def stats(self):
+        """Estatísticas de reaproveitamento de conexões por host"""
+        hosts = {}
+        with self._lock:
+            sessions = list(self._sessions.items())
+        for key, session in sessions:
+            pools = session.get_adapter(key).poolmanager.pools
+            num_requests = num_connections = 0
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+            hosts[key] = {
+                'requests': num_requests,
+                'connections': num_connections,
+                'pool_hits': max(num_requests - num_connections, 0),
+                'hit_ratio': round(1 - num_connections / num_requests, 3) if num_requests else 0.0
+            }
+        return hosts
+
+http_pool = HostSessionPool(host_policies=parse_host_retry_policy(os.environ.get("HTTP_HOST_RETRY_POLICY", "")))
+
+def normalize_url_escape(match):
+    # %7E vira ~; os demais escapes ficam, com hexadecimal maiúsculo
+    char = chr(int(match.group(1), 16))
+    return char if char in URL_UNRESERVED else '%' + match.group(1).upper()
+
+def remove_dot_segments(path):
+    """Resolve segmentos ``.`` e ``..`` de um caminho absoluto (RFC 3986)"""
+    if '/.' not in path:
+        return path
+    parts = path.split('/')
+    output = []
+    for part in parts[1:]:
+        if part == '..':
+            if output:
+                output.pop()
+        elif part != '.':
+            output.append(part)
+    if parts[-1] in ('.', '..'):
+        output.append('')
+    return '/' + '/'.join(output)
+
+def normalize_url(url):
+    """Forma canônica de uma URL: esquema/host minúsculos, sem porta padrão nem
+    fragmento, caminho sem ``.``/``..`` e escapes ``%xx`` padronizados"""
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or '').lower()
+    port = parsed.port
+    if port and DEFAULT_PORTS.get(scheme) != port:
+        host = f"{host}:{port}"
+    if parsed.username:
+        credentials = parsed.username + (f":{parsed.password}" if parsed.password else '')
+        host = f"{credentials}@{host}"
+    path = remove_dot_segments(parsed.path or '/')
+    query = parsed.query
+    if '%' in path:
+        path = URL_ESCAPE_PATTERN.sub(normalize_url_escape, path)
+    if '%' in query:
+        query = URL_ESCAPE_PATTERN.sub(normalize_url_escape, query)
+    return urlunparse((scheme, host, path, parsed.params, query, ''))
+
+def resource_key(url):
+    """Identidade do arquivo apontado por uma URL, para deduplicação.
+
+    Além de ``normalize_url``: parâmetros da query em ordem e sem os de
+    rastreamento (``utm_*``, ``fbclid``, ``gclid``), e as variantes de download
+    do Plone (``/view``, ``/@@download/file[/nome]``) reduzidas a uma só.
+    """
+    parsed = urlparse(normalize_url(url))
+    path = PLONE_DOWNLOAD_SUFFIX_PATTERN.sub('/@@download/file', parsed.path)
+    query = parsed.query
+    if query:
+        params = [param for param in query.split('&')
+                  if param and not param.split('=', 1)[0].lower().startswith(URL_TRACKING_PARAMS)]
+        query = '&'.join(sorted(params))
+    return urlunparse(parsed._replace(path=path, query=query))
+
+def strip_credentials(url):
+    """Remove usuário/senha de uma URL (para logs e armazenamento)"""
+    parsed = urlparse(url)
+    if not (parsed.username or parsed.password):
+        return url
+    return parsed._replace(netloc=parsed.netloc.rsplit('@', 1)[-1]).geturl()
+
+class FlightCall:
+    """Operação em andamento de um ``SingleFlight``"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Coalescência de chamadas idênticas concorrentes (single-flight).
+
+    A primeira chamada de uma chave executa a operação; as que chegam enquanto
+    ela está em andamento esperam e recebem o mesmo resultado (ou a mesma
+    exceção), sem repetir o trabalho no upstream.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.counters = Counter()
+    
+    def do(self, key, func, share=None):
+        """Retorna (resultado, compartilhado).
+
+        ``share(resultado, n)`` é chamado antes de o resultado ser entregue aos
+        ``n`` chamadores em espera (ex.: para contar referências).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = FlightCall()
+                self.counters['executed'] += 1
+            else:
+                call.waiters += 1
+                self.counters['shared'] += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        
+        try:
+            result = func()
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            call.error = e
+            call.done.set()
+            raise
+        
+        with self._lock:
+            del self._calls[key]
+            waiters = call.waiters
+        if share is not None and waiters:
+            share(result, waiters)
+        call.result = result
+        call.done.set()
+        return result, False
+    
+    async def do_async(self, key, func):
+        """Como ``do``, para corrotinas (modo ASGI); retorna (resultado, compartilhado).
+
+        A operação roda numa tarefa própria: se um chamador é cancelado
+        (cliente desconectou), os demais continuam esperando o mesmo trabalho.
+        """
+        # Importado aqui: só o modo ASGI usa, e o modo WSGI não paga o asyncio na partida a frio
+        import asyncio
+        
+        with self._lock:
+            task = self._tasks.get(key)
+            shared = task is not None
+            if shared:
+                self.counters['shared'] += 1
+            else:
+                task = self._tasks[key] = asyncio.ensure_future(func())
+                task.add_done_callback(lambda _: self._tasks.pop(key, None))
+                self.counters['executed'] += 1
+        return await asyncio.shield(task), shared
+    
+    def stats(self):
+        with self._lock:
+            data = dict(self.counters)
+            data['in_flight'] = len(self._calls) + len(self._tasks)
+        return data
+
+class DirectoryListing:
+    """Itens de uma listagem de diretório e seus validadores HTTP"""
+    
+    def __init__(self, items=None, etag=None, last_modified=None, not_modified=False):
+        self.items = items if items is not None else []
+        self.etag = etag
+        self.last_modified = last_modified
+        self.not_modified = not_modified
+        self.error = None
+        # Preenchidos pela busca: status/Retry-After de uma falha e duração
+        self.status = None
+        self.retry_after = None
+        self.elapsed = 0.0
+        self.truncated = False
+    
+    @property
+    def cacheable(self):
+        return bool(self.etag or self.last_modified)
+    
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+    
+    def copy(self, not_modified=False):
+        # Os dicionários de arquivo são copiados: o estágio de tamanhos os altera
+        items = [(kind, dict(item) if kind == 'file' else item) for kind, item in self.items]
+        return DirectoryListing(items, self.etag, self.last_modified, not_modified)
+    
+    def to_json(self):
+        return json.dumps({'etag': self.etag, 'last_modified': self.last_modified, 'items': self.items})
+    
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        return cls([tuple(item) for item in data['items']], data['etag'], data['last_modified'])
+
+# Importado por import_sqlite() quando o primeiro armazenamento é aberto
+sqlite3 = None
+
+def import_sqlite():
+    """Importa o ``sqlite3`` (fora da partida a frio); os ``except sqlite3.Error``
+    só rodam depois de algum armazenamento ter sido aberto"""
+    global sqlite3
+    import sqlite3
+
+class LazyDatabase:
+    """Conexão SQLite aberta no primeiro uso, e não na importação do módulo.
+
+    Na partida a frio (serverless), importar o ``sqlite3`` e criar diretórios,
+    arquivos e tabelas fica para a primeira requisição que usa o
+    armazenamento (ou para ``warm_up``). As subclasses implementam
+    ``_open_db``, que retorna a conexão ou None (armazenamento desativado).
+    """
+    
+    def _init_db(self):
+        self._db_conn = None
+        self._db_opened = False
+        self._db_lock = threading.Lock()
+    
+    @property
+    def _db(self):
+        if not self._db_opened:
+            with self._db_lock:
+                if not self._db_opened:
+                    import_sqlite()
+                    self._db_conn = self._open_db()
+                    self._db_opened = True
+        return self._db_conn
+    
+    @property
+    def enabled(self):
+        return self._db is not None
+    
+    def open(self):
+        """Abre a conexão agora (pré-aquecimento); retorna se o armazenamento está ativo"""
+        return self.enabled
+
+class ScanCache(LazyDatabase):
+    """Cache de listagens do /scan com revalidação condicional.
+
+    Cada listagem é guardada com seus links já processados (e tamanhos
+    resolvidos) junto com ``ETag``/``Last-Modified``. A camada em memória usa
+    LRU; a camada SQLite opcional sobrevive a reinícios do processo.
+    """
+    
+    def __init__(self, max_entries=SCAN_CACHE_MAX_ENTRIES, db_path=None):
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counter()
+        self.db_path = db_path
+        self._init_db()
+    
+    def _open_db(self):
+        if not self.db_path:
+            return None
+        try:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS scan_listings ('
+                'key TEXT PRIMARY KEY, url TEXT, data TEXT, stored_at REAL)'
+            )
+            db.commit()
+            return db
+        except sqlite3.Error as e:
+            logger.warning("Cache de listagens em disco desativado: %s", e)
+            return None
+    
+    @staticmethod
+    def make_key(url, file_type, include_src):
+        # Hash da chave: credenciais na URL não vão em claro para o disco
+        raw = f"{normalize_url(url)}|{file_type}|{int(bool(include_src))}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            listing = self._memory.get(key)
+            if listing is not None:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return listing.copy()
+            
+            if self._db is not None:
+                row = self._db.execute('SELECT data FROM scan_listings WHERE key = ?', (key,)).fetchone()
+                if row:
+                    listing = DirectoryListing.from_json(row[0])
+                    self.counters['disk_hits'] += 1
+                    self._remember(key, listing)
+                    return listing.copy()
+            
+            self.counters['misses'] += 1
+            return None
+    
+    def _remember(self, key, listing):
+        self._memory[key] = listing
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counters['evictions'] += 1
+    
+    def store(self, key, url, listing):
+        if not listing.cacheable:
+            return
+        listing = listing.copy()
+        with self._lock:
+            self._remember(key, listing)
+            self.counters['stores'] += 1
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO scan_listings (key, url, data, stored_at) VALUES (?, ?, ?, ?)',
+                    (key, strip_credentials(url), listing.to_json(), time.time())
+                )
+                self._db.commit()
+    
+    def stats(self):
+        with self._lock:
+            data = dict(self.counters)
+            data.update({'memory_entries': len(self._memory), 'disk_enabled': self._db is not None})
+        return data
+
+scan_cache = ScanCache(db_path=os.environ.get("SCAN_CACHE_DB") or None)
+
+class SiteIndex(LazyDatabase):
+    """Índice persistente (SQLite) de diretórios e arquivos já escaneados.
+
+    Cada escaneamento grava, por escopo (URL raiz + tipo + ``include_src``),
+    os diretórios buscados e os arquivos de cada um, com tamanho, validadores
+    e quando foram vistos pela primeira e pela última vez. Um arquivo que some
+    de uma listagem completa (ou cujo diretório sumiu do pai) é marcado como
+    removido. Daí saem o feed do ``/changes`` e a prioridade dos diretórios
+    nos re-escaneamentos (os que mudaram há menos tempo primeiro).
+    """
+    
+    def __init__(self, db_path):
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self.db_path = db_path
+        self._init_db()
+    
+    def _open_db(self):
+        if not self.db_path:
+            return None
+        try:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.executescript(
+                'CREATE TABLE IF NOT EXISTS index_sites ('
+                'scope TEXT PRIMARY KEY, url TEXT, file_type TEXT, include_src INTEGER, '
+                'first_crawled REAL, last_crawled REAL);'
+                'CREATE TABLE IF NOT EXISTS index_directories ('
+                'scope TEXT, url TEXT, parent TEXT, depth INTEGER, etag TEXT, last_modified TEXT, '
+                'first_seen REAL, last_seen REAL, last_changed REAL, removed_at REAL, PRIMARY KEY (scope, url));'
+                'CREATE TABLE IF NOT EXISTS index_files ('
+                'scope TEXT, url TEXT, directory TEXT, filename TEXT, size INTEGER, etag TEXT, last_modified TEXT, '
+                'first_seen REAL, last_seen REAL, removed_at REAL, PRIMARY KEY (scope, url));'
+                'CREATE INDEX IF NOT EXISTS index_files_directory ON index_files (scope, directory);'
+                'CREATE INDEX IF NOT EXISTS index_directories_parent ON index_directories (scope, parent);'
+            )
+            db.commit()
+            return db
+        except sqlite3.Error as e:
+            logger.warning("Índice de sites desativado: %s", e)
+            return None
+    
+    @staticmethod
+    def make_scope(url, file_type, include_src):
+        return ScanCache.make_key(url, file_type, include_src)
+    
+    def priorities(self, scope):
+        """Momento da última mudança de cada diretório conhecido do escopo"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT url, last_changed FROM index_directories WHERE scope = ? AND removed_at IS NULL', (scope,)
+            ).fetchall()
+        return dict(rows)
+    
+    def record(self, scope, root_url, file_type, include_src, fetched, parents):
+        """Grava um escaneamento: ``fetched`` traz (url, profundidade, listagem)
+        de cada diretório buscado e ``parents`` o diretório pai de cada um"""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO index_sites (scope, url, file_type, include_src, first_crawled, last_crawled) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (scope) DO UPDATE SET last_crawled = excluded.last_crawled',
+                (scope, strip_credentials(root_url), file_type, int(bool(include_src)), now, now)
+            )
+            for url, depth, listing in fetched:
+                if listing.error is None:
+                    self._record_directory(scope, url, depth, listing, parents.get(url), now)
+        self.counters['scans'] += 1
+    
+    def _record_directory(self, scope, url, depth, listing, parent, now):
+        db = self._db
+        directory = strip_credentials(url)
+        files = {}
+        for kind, item in listing.items:
+            if kind == 'file':
+                files[strip_credentials(item['url'])] = item
+        subdirs = {strip_credentials(item) for kind, item in listing.items if kind == 'dir'}
+        
+        known_files = {row[0] for row in db.execute(
+            'SELECT url FROM index_files WHERE scope = ? AND directory = ? AND removed_at IS NULL', (scope, directory)
+        )}
+        known_dirs = {row[0] for row in db.execute(
+            'SELECT url FROM index_directories WHERE scope = ? AND parent = ? AND removed_at IS NULL', (scope, directory)
+        )}
+        known = db.execute(
+            'SELECT 1 FROM index_directories WHERE scope = ? AND url = ? AND removed_at IS NULL', (scope, directory)
+        ).fetchone()
+        
+        # Listagem truncada não prova que o que faltou foi removido
+        gone_files = set() if listing.truncated else known_files - set(files)
+        gone_dirs = set() if listing.truncated else known_dirs - subdirs
+        added = set(files) - known_files
+        changed = known is None or added or gone_files or gone_dirs
+        
+        # Um diretório que aparece na própria listagem (arquivo direto) traz os validadores do arquivo
+        validators = (listing.etag, listing.last_modified)
+        db.executemany(
+            'INSERT INTO index_files (scope, url, directory, filename, size, etag, last_modified, first_seen, last_seen) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (scope, url) DO UPDATE SET '
+            'directory = excluded.directory, size = excluded.size, '
+            'etag = COALESCE(excluded.etag, index_files.etag), '
+            'last_modified = COALESCE(excluded.last_modified, index_files.last_modified), '
+            'first_seen = CASE WHEN index_files.removed_at IS NULL THEN index_files.first_seen ELSE excluded.first_seen END, '
+            'last_seen = excluded.last_seen, removed_at = NULL',
+            [(scope, file_url, directory, item['filename'], item['size'],
+              *(validators if file_url == directory else (None, None)), now, now)
+             for file_url, item in files.items()]
+        )
+        db.executemany(
+            'UPDATE index_files SET removed_at = ? WHERE scope = ? AND url = ?',
+            [(now, scope, file_url) for file_url in gone_files]
+        )
+        for subdir in gone_dirs:
+            # Subdiretório sumiu: tudo que estava abaixo dele também
+            prefix = subdir if subdir.endswith('/') else subdir + '/'
+            for table in ('index_files', 'index_directories'):
+                cursor = db.execute(
+                    f'UPDATE {table} SET removed_at = ? WHERE scope = ? AND removed_at IS NULL '
+                    'AND (url = ? OR substr(url, 1, ?) = ?)',
+                    (now, scope, subdir, len(prefix), prefix)
+                )
+                if table == 'index_files':
+                    self.counters['files_removed'] += cursor.rowcount
+        
+        db.execute(
+            'INSERT INTO index_directories (scope, url, parent, depth, etag, last_modified, first_seen, last_seen, '
+            'last_changed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (scope, url) DO UPDATE SET '
+            'parent = COALESCE(excluded.parent, index_directories.parent), depth = excluded.depth, '
+            'etag = excluded.etag, last_modified = excluded.last_modified, last_seen = excluded.last_seen, '
+            'last_changed = CASE WHEN ? THEN excluded.last_changed ELSE index_directories.last_changed END, '
+            'removed_at = NULL',
+            (scope, directory, strip_credentials(parent) if parent else None, depth,
+             listing.etag, listing.last_modified, now, now, now, bool(changed))
+        )
+        self.counters['files_added'] += len(added)
+        self.counters['files_removed'] += len(gone_files)
+    
+    def changes(self, scope, since, until):
+        """Arquivos novos e removidos entre ``since`` e ``until``; None se o escopo
+        não foi indexado"""
+        with self._lock:
+            site = self._db.execute(
+                'SELECT url, first_crawled, last_crawled FROM index_sites WHERE scope = ?', (scope,)
+            ).fetchone()
+            if site is None:
+                return None
+            added = self._db.execute(
+                'SELECT filename, url, size, first_seen FROM index_files '
+                'WHERE scope = ? AND first_seen > ? AND first_seen <= ? AND removed_at IS NULL '
+                'ORDER BY first_seen, url',
+                (scope, since, until)
+            ).fetchall()
+            removed = self._db.execute(
+                'SELECT filename, url, size, removed_at FROM index_files '
+                'WHERE scope = ? AND removed_at > ? AND removed_at <= ? AND first_seen <= ? '
+                'ORDER BY removed_at, url',
+                (scope, since, until, since)
+            ).fetchall()
+        return {
+            'url': site[0],
+            'first_crawled': site[1],
+            'last_crawled': site[2],
+            'added': [
+                {'filename': name, 'url': url, 'size': size, 'first_seen': seen}
+                for name, url, size, seen in added
+            ],
+            'removed': [
+                {'filename': name, 'url': url, 'size': size, 'removed_at': removed_at}
+                for name, url, size, removed_at in removed
+            ]
+        }
+    
+    def stats(self):
+        data = dict(self.counters, enabled=self.enabled)
+        if self.enabled:
+            with self._lock:
+                for table in ('sites', 'directories', 'files'):
+                    data[table] = self._db.execute(f'SELECT COUNT(*) FROM index_{table}').fetchone()[0]
+        return data
+
+site_index = SiteIndex(SITE_INDEX_DB)
+
+def record_listing_failure(listing, error):
+    """Anota o erro no ``DirectoryListing`` e, se houve resposta, o status e o Retry-After"""
+    # Só a primeira linha: o httpx acrescenta um link de referência à mensagem
+    message = str(error)
+    listing.error = message.splitlines()[0] if message else type(error).__name__
+    # HTTPError (requests) e HTTPStatusError (httpx) trazem a resposta
+    response = getattr(error, 'response', None)
+    if response is not None:
+        listing.status = response.status_code
+        listing.retry_after = parse_retry_after(response.headers.get('retry-after'))
+    return listing
+
+class ListingBuilder:
+    """Monta um ``DirectoryListing`` a partir de uma resposta já aberta.
+
+    Não depende do cliente HTTP: recebe os headers e, quando a página é HTML,
+    os blocos do corpo por ``feed``. É usado tanto pelo modo WSGI (requests)
+    quanto pelo modo ASGI (httpx, em ``asgi.py``).
+    """
+    
+    def __init__(self, url, file_type, include_src, headers, max_bytes=None):
+        self.url = url
+        self.file_type = file_type
+        self.max_bytes = max_bytes
+        self.listing = DirectoryListing()
+        self.listing.etag = headers.get('etag')
+        self.listing.last_modified = headers.get('last-modified')
+        self.content_type = headers.get('content-type', '').lower()
+        self.received = 0
+        self.parse_seconds = 0.0
+        
+        # Se é HTML, continuar com o escaneamento de diretório
+        self.wants_body = 'text/html' in self.content_type
+        if self.wants_body:
+            # Parse incremental do HTML: o corpo é lido em blocos, sem montar a página inteira
+            self.extractor = LinkExtractor(file_type, include_src)
+            self.decoder = get_incremental_decoder(get_encoding_from_headers(headers))
+            return
+        
+        # Se não é HTML, verificar se é um arquivo do tipo desejado
+        filename = os.path.basename(urlparse(url).path)
+        if filename and should_include_file(filename, file_type):
+            file_size = int(headers.get('content-length', 0))
+            self.listing.items.append(('file', {
+                'filename': filename,
+                'url': url,
+                'size': file_size
+            }))
+            logger.debug("Arquivo direto encontrado: %s (%d bytes)", filename, file_size)
+    
+    def feed(self, chunk):
+        """Processa um bloco do corpo; retorna False quando o limite de bytes foi atingido"""
+        truncated = self.max_bytes is not None and self.received + len(chunk) > self.max_bytes
+        if truncated:
+            chunk = chunk[:self.max_bytes - self.received]
+        self.received += len(chunk)
+        parse_start = time.perf_counter()
+        self.extractor.feed(self.decoder.decode(chunk))
+        self.parse_seconds += time.perf_counter() - parse_start
+        if truncated:
+            # Listagem parcial: não pode ser revalidada nem ir para o cache
+            self.listing.truncated = True
+            self.listing.etag = self.listing.last_modified = None
+            logger.warning("Listagem truncada em %d bytes: %s", self.received, strip_credentials(self.url))
+        return not truncated
+    
+    def finish(self):
+        if not self.wants_body:
+            return self.listing
+        
+        extractor = self.extractor
+        parse_start = time.perf_counter()
+        extractor.feed(self.decoder.decode(b'', final=True))
+        extractor.close()
+        self.parse_seconds += time.perf_counter() - parse_start
+        BYTES_IN.inc(self.received, kind='listing')
+        STAGE_SECONDS.observe(self.parse_seconds, stage='listing_parse')
+        
+        links = extractor.links()
+        logger.debug("Listagem processada: %s (%d href, %d src, %d links)",
+                     strip_credentials(self.url), len(extractor.hrefs), len(extractor.srcs), len(links),
+                     extra={'content_type': self.content_type, 'bytes': self.received,
+                            'fallback': not extractor.hrefs and not extractor.srcs})
+        
+        # <base href> muda a referência dos links relativos
+        page_url = urljoin(self.url, extractor.base_href) if extractor.base_href else self.url
+        listing_sizes = extractor.sizes
+        items = self.listing.items
+        
+        for href in links:
+            if not href or href in ['../', './', '/']:
+                continue
+            
+            # Construir URL completa
+            full_url = urljoin(page_url, href)
+            
+            # Verificar se é um arquivo
+            filename = os.path.basename(href.rstrip('/'))
+            
+            if not filename:
+                continue
+            
+            # Verificar se deve ser incluído
+            if should_include_file(filename, self.file_type):
+                # Tamanho vem da listagem quando o servidor o imprime;
+                # caso contrário fica para o estágio de sondagem
+                file_size = listing_sizes.get(href)
+                items.append(('file', {
+                    'filename': filename,
+                    'url': full_url,
+                    'size': file_size
+                }))
+                
+                logger.debug("Arquivo encontrado: %s (%s bytes)", filename, file_size if file_size is not None else '?')
+            
+            # Se for um diretório, marcar para o crawler
+            elif href.endswith('/'):
+                items.append(('dir', full_url))
+        
+        return self.listing
+
+def fetch_directory_listing(url, file_type, include_src=False, cached=None, timeout=SCAN_LISTING_TIMEOUT,
+                            max_bytes=None):
+    """Busca uma única listagem de diretório.
+
+    Retorna um ``DirectoryListing`` cujos itens ``('file', info)`` ou
+    ``('dir', url)`` seguem a ordem em que os links aparecem na página. Com
+    ``cached``, a requisição é condicional e um 304 reaproveita os itens.
+    """
+    builder = None
+    try:
+        logger.debug("Escaneando: %s", strip_credentials(url))
+        
+        # Preparar autenticação se necessário
+        auth = None
+        parsed_url = urlparse(url)
+        if parsed_url.username and parsed_url.password:
+            auth = (parsed_url.username, parsed_url.password)
+        
+        # Requisição condicional quando já existe uma versão em cache
+        headers = cached.conditional_headers() if cached else {}
+        
+        # Fazer requisição com timeout e autenticação
+        response = http_pool.session_for(url).get(url, timeout=timeout, stream=True, auth=auth, headers=headers)
+        try:
+            if response.status_code == 304 and cached:
+                logger.debug("Listagem não modificada (304): %s", strip_credentials(url))
+                return cached.copy(not_modified=True)
+            response.raise_for_status()
+            
+            builder = ListingBuilder(url, file_type, include_src, response.headers, max_bytes)
+            if builder.wants_body:
+                for chunk in response.iter_content(LISTING_CHUNK_SIZE):
+                    if not builder.feed(chunk):
+                        break
+        finally:
+            response.close()
+        return builder.finish()
+    
+    except Exception as e:
+        listing = record_listing_failure(builder.listing if builder is not None else DirectoryListing(), e)
+        logger.warning("Erro ao escanear %s: %s", strip_credentials(url), listing.error)
+        return listing
+
+def parse_size_token(token):
+    """Converte um tamanho de autoindex ("12345", "1.5K", "12M") em bytes"""
+    token = token.strip().upper()
+    if not token or token == '-':
+        return None
+    unit = token[-1]
+    if unit in SIZE_UNITS:
+        try:
+            return int(float(token[:-1]) * SIZE_UNITS[unit])
+        except ValueError:
+            return None
+    return int(token) if token.isdigit() else None
+
+def get_incremental_decoder(encoding):
+    """Decodificador incremental para o charset da resposta (UTF-8 se desconhecido)"""
+    try:
+        return codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+class LinkExtractor:
+    """Extrai candidatos a link de uma página HTML numa única passada.
+
+    Recebe o corpo em blocos via ``feed()``; uma tag cortada entre dois
+    blocos fica pendente até o próximo. Coleta ``href`` de âncoras, ``src``
+    de mídia/scripts, o ``<base href>`` e o tamanho impresso depois de cada
+    link nas listagens autoindex (Apache/nginx).
+    """
+    
+    def __init__(self, file_type, include_src=False):
+        self.extensions = FILE_TYPE_EXTENSIONS.get(file_type, frozenset())
+        self.fallback_pattern = FALLBACK_LINK_PATTERNS.get(file_type)
+        self.include_src = include_src
+        self.base_href = None
+        self.hrefs = []
+        self.srcs = []
+        self.fallback = []
+        self.sizes = {}
+        self._pending = ''
+        self._size_href = None
+        self._size_text = []
+        self._size_length = 0
+        self._text = []
+    
+    def feed(self, chunk):
+        data = self._pending + chunk if self._pending else chunk
+        pos = 0
+        # Achadas as âncoras, tags de mídia só interessam com include_src
+        if self.hrefs and not self.include_src:
+            pattern = HTML_ANCHOR_TAG_PATTERN
+        else:
+            pattern = HTML_LINK_TAG_PATTERN
+        for match in pattern.finditer(data):
+            if match.start() > pos:
+                self._handle_text(data[pos:match.start()])
+            self._handle_tag(match)
+            pos = match.end()
+        
+        # Tag possivelmente incompleta no fim do bloco fica para o próximo
+        rest = data[pos:]
+        cut = rest.find('<')
+        if cut >= 0 and len(rest) - cut > LISTING_MAX_PENDING:
+            cut = rest.rfind('<')
+        if cut < 0:
+            cut = len(rest)
+        if cut:
+            self._handle_text(rest[:cut])
+        self._pending = rest[cut:]
+    
+    def close(self):
+        if self._pending:
+            self._handle_text(self._pending)
+            self._pending = ''
+        self._flush_text()
+        self._flush_size()
+    
+    def _has_extension(self, value):
+        path = value.split('?', 1)[0].split('#', 1)[0]
+        return get_file_extension(path) in self.extensions
+    
+    def _flush_size(self):
+        """Lê data + tamanho impressos depois do link anterior, se houver"""
+        if self._size_href is not None and self._size_text:
+            text = HTML_ANY_TAG_PATTERN.sub(' ', ''.join(self._size_text)).replace('&nbsp;', ' ')
+            match = AUTOINDEX_SIZE_PATTERN.search(text)
+            if match:
+                size = parse_size_token(match.group(1))
+                if size is not None:
+                    self.sizes[self._size_href] = size
+        self._size_href = None
+        self._size_text = []
+        self._size_length = 0
+    
+    def _flush_text(self):
+        """Busca direta em texto corrido, que pode chegar em pedaços"""
+        if self._text:
+            if not self.hrefs and self.fallback_pattern is not None:
+                text = ''.join(self._text)
+                if '&' in text:
+                    text = html.unescape(text)
+                self.fallback.extend(self.fallback_pattern.findall(text))
+            self._text = []
+    
+    def _handle_text(self, data):
+        if self._size_href is not None and self._size_length < AUTOINDEX_ROW_MAX_TEXT:
+            self._size_text.append(data)
+            self._size_length += len(data)
+        if not self.hrefs and self.fallback_pattern is not None:
+            self._text.append(data)
+    
+    def _handle_tag(self, match):
+        self._flush_text()
+        tag = match.group(1).lower()
+        if tag == 'a':
+            self._flush_size()
+        elif self._size_href is not None:
+            self._size_text.append(' ')
+        
+        for name, value in HTML_ATTR_PATTERN.findall(match.group(2)):
+            if not value:
+                continue
+            if value[0] in '"\'':
+                value = value[1:-1]
+                if not value:
+                    continue
+            if '&' in value:
+                value = html.unescape(value)
+            name = name.lower()
+            
+            if name == 'href' and tag == 'a':
+                self.hrefs.append(value)
+                self._size_href = value
+            elif name == 'href' and tag == 'base':
+                if self.base_href is None:
+                    self.base_href = value
+            elif name == 'src' and tag in SRC_TAGS and self.include_src:
+                self.srcs.append(value)
+            elif not self.hrefs and self._has_extension(value):
+                self.fallback.append(value)
+    
+    def links(self):
+        """Links na ordem antiga: hrefs, depois srcs; busca direta só se não houver nenhum"""
+        links = self.hrefs + self.srcs
+        return links if links else self.fallback
+
+def probe_file_size(url, timeout=SCAN_PROBE_TIMEOUT):
+    """Obtém o tamanho de um arquivo via HEAD (0 se não for possível)"""
+    auth = None
+    parsed_url = urlparse(url)
+    if parsed_url.username and parsed_url.password:
+        auth = (parsed_url.username, parsed_url.password)
+    with IN_FLIGHT.track(kind='head_probe'), STAGE_SECONDS.time(stage='head_probe'):
+        try:
+            head_response = http_pool.session_for(url).head(url, timeout=timeout, auth=auth)
+            if head_response.status_code == 200:
+                return int(head_response.headers.get('content-length', 0))
+        except:
+            pass
+    return 0
+
+class ScanBudget:
+    """Limites de um escaneamento: prazo, páginas buscadas, arquivos e bytes por listagem.
+
+    Os máximos vêm da configuração do servidor; cada requisição pode pedir
+    limites menores. Páginas são verificadas antes de cada nova busca
+    (listagens já em andamento terminam), arquivos um a um, e o prazo
+    interrompe tudo.
+    """
+    
+    LIMITS = (
+        ('max_seconds', SCAN_DEADLINE_SECONDS, float),
+        ('max_pages', SCAN_MAX_PAGES, int),
+        ('max_files', SCAN_MAX_FILES, int),
+        ('max_listing_bytes', SCAN_MAX_LISTING_BYTES, int),
+    )
+    
+    def __init__(self, max_seconds=None, max_pages=None, max_files=None, max_listing_bytes=None):
+        self.max_seconds = max_seconds or SCAN_DEADLINE_SECONDS
+        self.max_pages = max_pages or SCAN_MAX_PAGES
+        self.max_files = max_files or SCAN_MAX_FILES
+        self.max_listing_bytes = max_listing_bytes or SCAN_MAX_LISTING_BYTES
+        self.deadline = None
+    
+    @classmethod
+    def from_request(cls, data):
+        """Lê os limites pedidos (nunca acima dos máximos); retorna (orçamento, erro)"""
+        values = {}
+        for name, maximum, kind in cls.LIMITS:
+            value = data.get(name)
+            if value is None:
+                continue
+            try:
+                # bool é subclasse de int: True viraria um limite de 1
+                value = kind(value) if not isinstance(value, bool) else 0
+            except (TypeError, ValueError, OverflowError):
+                value = 0
+            # NaN passaria pelo <= 0 e pelo min(), desligando o limite do servidor
+            if not math.isfinite(value) or value <= 0:
+                return None, f"Valor inválido para {name}: deve ser um número positivo"
+            values[name] = min(value, maximum)
+        return cls(**values), None
+    
+    def key(self):
+        return (self.max_seconds, self.max_pages, self.max_files, self.max_listing_bytes)
+    
+    def start(self):
+        self.deadline = time.monotonic() + self.max_seconds
+    
+    def remaining(self):
+        return max(self.deadline - time.monotonic(), 0.0)
+    
+    def pages_left(self, counts):
+        return max(self.max_pages - counts['pages'], 0)
+    
+    def exhausted(self, counts):
+        """Nome do limite esgotado (``deadline``, ``pages`` ou ``files``) ou None"""
+        if time.monotonic() >= self.deadline:
+            return 'deadline'
+        if counts['pages'] >= self.max_pages:
+            return 'pages'
+        if counts['accepted'] >= self.max_files:
+            return 'files'
+        return None
+
+def encode_scan_token(state):
+    """Token de continuação: JSON comprimido em base64 para URL"""
+    raw = zlib.compress(json.dumps(state, separators=(',', ':')).encode(), 9)
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_scan_token(token):
+    """Estado de um token de continuação; ``ValueError`` se for inválido"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        state = json.loads(zlib.decompress(raw))
+        if state.get('v') != SCAN_TOKEN_VERSION:
+            raise ValueError("versão incompatível")
+        state['frontier'] = [(str(url), int(depth)) for url, depth in state['frontier']]
+        state['visited'] = [str(url) for url in state.get('visited', [])]
+        state['files'] = [{'filename': str(filename), 'url': str(url), 'size': None if size is None else int(size)}
+                          for filename, url, size in state.get('files', [])]
+        state['max_depth'] = int(state['max_depth'])
+    except Exception as e:
+        raise ValueError(f"Token de continuação inválido: {e}")
+    urls = [state.get('url') or ''] + [url for url, _ in state['frontier']] + [item['url'] for item in state['files']]
+    if not all(is_valid_url(url) for url in urls):
+        raise ValueError("Token de continuação inválido: URL inválida")
+    return state
+
+class HostState:
+    """Saúde de um host durante um escaneamento"""
+    
+    def __init__(self, max_concurrency):
+        self.limit = float(max_concurrency)
+        self.latency = None
+        self.samples = 0
+        self.failures = 0
+        self.errors = 0
+        self.not_before = 0.0
+        self.open_reason = None
+
+class HostGovernor:
+    """Controle adaptativo por host para um único escaneamento.
+
+    A concorrência de cada host cresce de forma aditiva a cada resposta
+    rápida e cai pela metade em sobrecarga (429/503, erro do servidor,
+    timeout ou latência muito acima da média) — AIMD. ``Retry-After`` adia
+    o host inteiro; falhas consecutivas abrem o disjuntor, e o resto do
+    escaneamento deixa de buscar aquele host (os subdiretórios são pulados).
+    """
+    
+    def __init__(self, max_concurrency, breaker_threshold=None, retry_after_max=None):
+        self.max_concurrency = max_concurrency
+        self.breaker_threshold = breaker_threshold or SCAN_BREAKER_THRESHOLD
+        self.retry_after_max = SCAN_RETRY_AFTER_MAX if retry_after_max is None else retry_after_max
+        self.hosts = {}
+    
+    def _state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.max_concurrency)
+        return state
+    
+    def limit(self, host):
+        return max(int(self._state(host).limit), 1)
+    
+    def is_open(self, host):
+        return self._state(host).open_reason is not None
+    
+    def open_reason(self, host):
+        return self._state(host).open_reason
+    
+    def ready(self, host, now):
+        return now >= self._state(host).not_before
+    
+    def next_ready_in(self, hosts, now):
+        """Segundos até o primeiro dos ``hosts`` adiados poder voltar (None se nenhum)"""
+        delays = [self._state(host).not_before - now for host in hosts]
+        delays = [delay for delay in delays if delay > 0]
+        return min(delays) if delays else None
+    
+    def timeout(self, host, default):
+        """Timeout proporcional à latência observada do host, até ``default``"""
+        state = self._state(host)
+        if state.samples < 3:
+            return default
+        return min(default, max(SCAN_MIN_TIMEOUT, SCAN_TIMEOUT_FACTOR * state.latency))
+    
+    def _decrease(self, state):
+        state.limit = max(state.limit / 2, 1.0)
+        GOVERNOR_EVENTS.inc(event='backoff')
+    
+    def _trip(self, host, state, reason):
+        if state.open_reason is None:
+            state.open_reason = reason
+            GOVERNOR_EVENTS.inc(event='circuit_open')
+            logger.warning("Disjuntor aberto para %s: %s", host, reason)
+    
+    def record(self, host, listing):
+        """Registra o resultado de uma busca; retorna a espera antes de repetir
+        a mesma URL, ou None se ela não deve ser repetida"""
+        state = self._state(host)
+        status = listing.status
+        
+        # Qualquer resposta que não indique sobrecarga (inclusive 403/404): host saudável
+        if listing.error is None or (status is not None and status < 500 and status != 429):
+            state.failures = 0
+            if listing.error is not None:
+                return None
+            elapsed = listing.elapsed
+            if state.samples >= 3 and elapsed > SCAN_SLOW_FACTOR * state.latency:
+                self._decrease(state)
+            else:
+                state.limit = min(state.limit + 1 / state.limit, float(self.max_concurrency))
+            state.latency = elapsed if state.latency is None else 0.8 * state.latency + 0.2 * elapsed
+            state.samples += 1
+            return None
+        
+        # Sobrecarga, erro do servidor ou de rede (já repetidos pelo urllib3)
+        state.errors += 1
+        self._decrease(state)
+        delay = listing.retry_after
+        if delay is not None and delay > self.retry_after_max:
+            # Espera maior que o aceitável para um escaneamento: falhar rápido
+            self._trip(host, state, f"Retry-After de {delay:.0f}s")
+            return None
+        
+        # Um Retry-After aceitável é um pedido para ir mais devagar, não uma falha do host
+        if delay is None:
+            state.failures += 1
+            if state.failures >= self.breaker_threshold:
+                self._trip(host, state, f"{state.failures} falhas consecutivas")
+                return None
+        
+        if status not in (429, 503):
+            return None
+        if delay is None:
+            delay = SCAN_THROTTLE_BACKOFF * 2 ** (state.failures - 1)
+        state.not_before = max(state.not_before, time.monotonic() + delay)
+        return delay
+    
+    def snapshot(self):
+        return {
+            host: {
+                'concurrency': max(int(state.limit), 1),
+                'latency_ms': round(state.latency * 1000, 1) if state.latency is not None else None,
+                'errors': state.errors,
+                'circuit_open': state.open_reason is not None
+            }
+            for host, state in self.hosts.items()
+        }
+
+class ScanCrawler:
+    """Motor de escaneamento em largura (BFS) com pool de workers limitado.
+
+    Diretórios irmãos são buscados em paralelo, com limite por host
+    ajustado por um ``HostGovernor``. Cada diretório e cada arquivo
+    (``resource_key``) aparece uma vez só. O escaneamento respeita um
+    ``ScanBudget``; ao esgotá-lo, o resultado parcial traz um token de
+    continuação. Com um ``SiteIndex``, subdiretórios alterados há menos
+    tempo são buscados antes.
+    """
+    
+    def __init__(self, file_type, max_depth=SCAN_DEFAULT_DEPTH, include_src=False,
+                 max_workers=None, max_per_host=None, cache=None, budget=None, resume=None, index=None):
+        self.file_type = file_type
+        self.cache = cache
+        self.fetched = {}
+        self.max_depth = max_depth
+        self.include_src = include_src
+        self.max_workers = max_workers or SCAN_MAX_WORKERS
+        self.max_per_host = max_per_host or SCAN_MAX_PER_HOST
+        self.visited = set()
+        self.seen_files = set()
+        self.listings = {}
+        self.governor = HostGovernor(self.max_per_host)
+        self.attempts = Counter()
+        self.skipped = []
+        self.budget = budget or ScanBudget()
+        self.resume = resume
+        self.roots = []
+        self.resumed = []
+        self.deferred_files = []
+        self.truncated = []
+        self.exhausted = None
+        self.continuation = None
+        self.duplicates = 0
+        self.index = index if index is not None and index.enabled else None
+        self.indexed = []
+        self.parents = {}
+        self.priorities = {}
+    
+    def _fetch(self, url, depth):
+        timeout = self.governor.timeout(urlparse(url).netloc, SCAN_LISTING_TIMEOUT)
+        with IN_FLIGHT.track(kind='listing_fetch'), STAGE_SECONDS.time(stage='listing_fetch'):
+            start = time.perf_counter()
+            listing = self._fetch_listing(url, timeout)
+            listing.elapsed = time.perf_counter() - start
+            return listing
+    
+    def _fetch_listing(self, url, timeout=SCAN_LISTING_TIMEOUT):
+        max_bytes = self.budget.max_listing_bytes
+        if self.cache is None:
+            return fetch_directory_listing(url, self.file_type, self.include_src,
+                                           timeout=timeout, max_bytes=max_bytes)
+        
+        key = ScanCache.make_key(url, self.file_type, self.include_src)
+        listing = fetch_directory_listing(url, self.file_type, self.include_src, cached=self.cache.get(key),
+                                          timeout=timeout, max_bytes=max_bytes)
+        if not listing.not_modified and listing.cacheable:
+            self.fetched[url] = (key, listing)
+        return listing
+    
+    def _probe(self, url):
+        host = urlparse(url).netloc
+        if self.governor.is_open(host):
+            return 0
+        return probe_file_size(url, self.governor.timeout(host, SCAN_PROBE_TIMEOUT))
+    
+    def store_fetched(self):
+        """Guarda no cache as listagens novas (depois de resolvidos os tamanhos)"""
+        for url, (key, listing) in self.fetched.items():
+            self.cache.store(key, url, listing)
+    
+    def _start(self, root_url):
+        """Fronteira inicial, prioridades do índice e início do prazo"""
+        frontier = self._frontier(root_url)
+        self.load_priorities()
+        self.budget.start()
+        return frontier
+    
+    def _frontier(self, root_url):
+        """Fronteira inicial: a raiz, ou o que faltava no escaneamento retomado
+        (os arquivos pendentes do token são entregues por ``_resume_files``)"""
+        self.origin = root_url
+        if self.resume is None:
+            frontier = deque([(root_url, 0)] if self.max_depth > 0 else [])
+        else:
+            frontier = deque(self.resume['frontier'])
+            self.visited.update(self.resume['visited'])
+        self.visited.update(resource_key(url) for url, _ in frontier)
+        self.roots = [url for url, _ in frontier]
+        if self.index is not None:
+            self.scope = SiteIndex.make_scope(root_url, self.file_type, self.include_src)
+        return frontier
+    
+    def load_priorities(self):
+        """Lê do índice de sites quando cada diretório do escopo mudou (SQLite)"""
+        if self.index is None:
+            return
+        try:
+            self.priorities = self.index.priorities(self.scope)
+        except sqlite3.Error as e:
+            logger.warning("Erro ao ler o índice de sites: %s", e)
+    
+    def _priority(self, entry):
+        """Ordem de busca dos subdiretórios: novos primeiro, depois os que mudaram há menos tempo"""
+        return -self.priorities.get(strip_credentials(entry[0]), float('inf'))
+    
+    def record_index(self):
+        """Grava no índice de sites as listagens buscadas neste escaneamento"""
+        if self.index is None or not self.indexed:
+            return
+        try:
+            self.index.record(self.scope, self.origin, self.file_type, self.include_src, self.indexed, self.parents)
+        except sqlite3.Error as e:
+            logger.warning("Erro ao gravar o índice de sites: %s", e)
+    
+    def _dispatch(self, frontier, host_inflight, counts, events):
+        """Próximas URLs a buscar, dentro do orçamento; marca ``exhausted`` quando
+        ele acaba antes do fim da árvore"""
+        reason = self.budget.exhausted(counts)
+        if reason == 'deadline' or (reason and frontier):
+            self.exhausted = reason
+            return []
+        skipped = len(events)
+        batch = self._next_batch(frontier, host_inflight, events, self.budget.pages_left(counts))
+        counts['pages'] += len(batch)
+        counts['skipped'] += len(events) - skipped
+        return batch
+    
+    def _next_batch(self, frontier, host_inflight, events, max_items=None):
+        """Retira da fronteira as URLs cujo host ainda tem vagas livres (no máximo
+        ``max_items``).
+
+        URLs de hosts com o disjuntor aberto saem da fronteira como eventos
+        ``skipped`` (acrescentados a ``events``).
+        """
+        batch = []
+        deferred = deque()
+        now = time.monotonic()
+        while frontier and (max_items is None or len(batch) < max_items):
+            url, depth = frontier.popleft()
+            host = urlparse(url).netloc
+            if self.governor.is_open(host):
+                events.append(self._skip(url, depth, host))
+            elif host_inflight[host] < self.governor.limit(host) and self.governor.ready(host, now):
+                host_inflight[host] += 1
+                batch.append((url, depth))
+            else:
+                deferred.append((url, depth))
+        deferred.extend(frontier)
+        frontier.clear()
+        frontier.extend(deferred)
+        return batch
+    
+    def _skip(self, url, depth, host):
+        """Subárvore não buscada porque o host falhou demais neste escaneamento"""
+        skipped = {'url': strip_credentials(url), 'depth': depth, 'reason': self.governor.open_reason(host)}
+        self.skipped.append(skipped)
+        GOVERNOR_EVENTS.inc(event='skipped')
+        return dict(skipped, type='skipped')
+    
+    def _retry_later(self, url, depth, result, frontier):
+        """Repassa o resultado ao governador; True se a URL voltou à fronteira"""
+        delay = self.governor.record(urlparse(url).netloc, result)
+        if delay is None or self.attempts[url] + 1 >= SCAN_MAX_ATTEMPTS:
+            return False
+        self.attempts[url] += 1
+        frontier.append((url, depth))
+        GOVERNOR_EVENTS.inc(event='retry')
+        logger.info("Host sobrecarregado, nova tentativa em %.1fs: %s", delay, strip_credentials(url))
+        return True
+    
+    def _wait_timeout(self, frontier):
+        """Quanto esperar por resultados antes de rever hosts adiados por Retry-After
+        (nunca além do prazo do escaneamento)"""
+        hosts = {urlparse(url).netloc for url, _ in frontier}
+        timeout = self.governor.next_ready_in(hosts, time.monotonic())
+        remaining = self.budget.remaining()
+        return remaining if timeout is None else min(timeout, remaining)
+    
+    def _interrupt(self, pending, frontier, counts):
+        """Prazo esgotado: listagens em andamento voltam à fronteira e arquivos
+        ainda em sondagem são emitidos sem tamanho"""
+        for future, (kind, payload) in pending:
+            if kind == 'listing':
+                frontier.appendleft(payload)
+                continue
+            payload['size'] = future.result() if future.done() else 0
+            counts['files'] += 1
+            yield dict(payload, type='file')
+    
+    def _finish(self, frontier, counts, start_time, resolve_sizes):
+        """Grava o cache, prepara o token de continuação e monta o resumo"""
+        # Depois de um corte por prazo há tamanhos não resolvidos: não guardar
+        if self.cache is not None and resolve_sizes and self.exhausted != 'deadline':
+            self.store_fetched()
+        # A última listagem pode ter passado do limite sem deixar diretórios na fronteira
+        if self.deferred_files and self.exhausted is None:
+            self.exhausted = 'files'
+        
+        summary = self._summary(counts, start_time)
+        summary.update(self._completeness())
+        self.duplicates = counts['duplicates']
+        if self.exhausted:
+            self.continuation = encode_scan_token({
+                'v': SCAN_TOKEN_VERSION,
+                'url': self.origin,
+                'file_type': self.file_type,
+                'include_src': self.include_src,
+                'max_depth': self.max_depth,
+                'frontier': list(frontier),
+                'visited': sorted(self.visited),
+                'files': [[item['filename'], item['url'], item['size']] for item in self.deferred_files]
+            })
+            summary.update(exhausted=self.exhausted, continuation=self.continuation)
+            logger.info("Orçamento do escaneamento esgotado (%s): %d diretórios e %d arquivos pendentes",
+                        self.exhausted, len(frontier), len(self.deferred_files))
+        return summary
+    
+    def _completeness(self):
+        """``complete`` e, se houve subárvores abandonadas pelo disjuntor, ``partial_reason``"""
+        if self.skipped:
+            return {'complete': False, 'partial_reason': 'breaker'}
+        return {'complete': self.exhausted is None}
+    
+    def report(self):
+        """Campos do resultado além dos arquivos: pulados, truncados, repetidos e continuação"""
+        report = {
+            'skipped': self.skipped,
+            'truncated': self.truncated,
+            'duplicates': self.duplicates
+        }
+        report.update(self._completeness())
+        if self.exhausted:
+            report.update(exhausted=self.exhausted, continuation=self.continuation)
+        return report
+    
+    def _assemble(self, url, files):
+        """Monta a lista final na mesma ordem da antiga busca em profundidade"""
+        for kind, item in self.listings.get(url, []):
+            if kind == 'file':
+                files.append(item)
+            else:
+                self._assemble(item, files)
+        return files
+    
+    def _collect(self):
+        """Lista final de arquivos, a partir das raízes deste escaneamento"""
+        files = list(self.resumed)
+        for url in self.roots:
+            self._assemble(url, files)
+        return files
+    
+    def _handle_listing(self, url, depth, result, frontier, counts, resolve_sizes, schedule_probe):
+        """Processa uma listagem buscada e retorna os eventos já prontos.
+
+        Subdiretórios novos entram na fronteira; arquivos sem tamanho vão para
+        ``schedule_probe`` e são emitidos quando a sondagem terminar.
+        """
+        events = []
+        counts['directories'] += 1
+        
+        if result.error:
+            counts['errors'] += 1
+            events.append({'type': 'error', 'url': strip_credentials(url), 'error': result.error})
+        
+        directory = {
+            'type': 'directory',
+            'url': strip_credentials(url),
+            'depth': depth,
+            'cached': result.not_modified
+        }
+        if result.truncated:
+            # Listagem maior que o orçamento: só os itens lidos até o limite
+            counts['truncated'] += 1
+            self.truncated.append(strip_credentials(url))
+            directory['truncated'] = True
+        events.append(directory)
+        
+        if self.index is not None:
+            self.indexed.append((url, depth, result))
+        
+        listing = []
+        children = []
+        for item_kind, item in result.items:
+            if item_kind == 'dir':
+                # Só desce se ainda houver profundidade e o diretório for novo
+                key = resource_key(item)
+                if depth >= self.max_depth - 1 or key in self.visited:
+                    continue
+                self.visited.add(key)
+                self.parents[item] = url
+                children.append((item, depth + 1))
+                listing.append((item_kind, item))
+                continue
+            
+            if self._accept_file(item, counts, resolve_sizes, schedule_probe, events):
+                listing.append((item_kind, item))
+        self.listings[url] = listing
+        if self.priorities:
+            children.sort(key=self._priority)
+        frontier.extend(children)
+        return events
+    
+    def _accept_file(self, item, counts, resolve_sizes, schedule_probe, events):
+        """Inclui um arquivo no resultado; False se repetido ou além de ``max_files``
+        (nesse caso ele fica para o token de continuação)"""
+        # Mesmo arquivo por outra URL (espelho na mesma árvore, ícone + nome, query reordenada)
+        key = resource_key(item['url'])
+        if key in self.seen_files:
+            counts['duplicates'] += 1
+            DEDUPLICATED.inc(kind='scan_file')
+            return False
+        self.seen_files.add(key)
+        if counts['accepted'] >= self.budget.max_files:
+            self.deferred_files.append(item)
+            return False
+        counts['accepted'] += 1
+        if item['size'] is None and resolve_sizes:
+            schedule_probe(item)
+        else:
+            # Sem sondagem: tamanhos que a listagem não informou ficam zerados
+            if item['size'] is None:
+                item['size'] = 0
+            counts['files'] += 1
+            events.append(dict(item, type='file'))
+        return True
+    
+    def _resume_files(self, counts, resolve_sizes, schedule_probe):
+        """Arquivos que ficaram de fora do escaneamento anterior pelo limite de arquivos"""
+        events = []
+        for item in (self.resume or {}).get('files', []):
+            if self._accept_file(item, counts, resolve_sizes, schedule_probe, events):
+                self.resumed.append(item)
+        return events
+    
+    @staticmethod
+    def _summary(counts, start_time):
+        return {
+            'type': 'summary',
+            'files_found': counts['files'],
+            'directories': counts['directories'],
+            'errors': counts['errors'],
+            'skipped': counts['skipped'],
+            'truncated': counts['truncated'],
+            'pages': counts['pages'],
+            'duplicates': counts['duplicates'],
+            'elapsed_seconds': round(time.time() - start_time, 3)
+        }
+    
+    def events(self, root_url, resolve_sizes=True):
+        """Percorre a árvore emitindo eventos ``directory``, ``file``, ``error`` e ``summary``"""
+        start_time = time.time()
+        counts = Counter()
+        frontier = self._start(root_url)
+        host_inflight = Counter()
+        pending = {}
+        
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        probe_pool = ThreadPoolExecutor(max_workers=SIZE_PROBE_MAX_WORKERS)
+        
+        def schedule_probe(item):
+            pending[probe_pool.submit(self._probe, item['url'])] = ('probe', item)
+        
+        IN_FLIGHT.inc(kind='scan')
+        try:
+            yield from self._resume_files(counts, resolve_sizes, schedule_probe)
+            while frontier or pending:
+                skipped = []
+                for url, depth in self._dispatch(frontier, host_inflight, counts, skipped):
+                    future = pool.submit(self._fetch, url, depth)
+                    pending[future] = ('listing', (url, depth))
+                yield from skipped
+                
+                if self.exhausted == 'deadline':
+                    yield from self._interrupt(pending.items(), frontier, counts)
+                    break
+                if not pending:
+                    if self.exhausted:
+                        break
+                    # Só restam hosts adiados por Retry-After
+                    if frontier:
+                        time.sleep(self._wait_timeout(frontier))
+                    continue
+                
+                done, _ = wait(pending, timeout=self._wait_timeout(frontier), return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, payload = pending.pop(future)
+                    
+                    # Estágio de sondagem: tamanho resolvido, arquivo pronto
+                    if kind == 'probe':
+                        payload['size'] = future.result()
+                        counts['files'] += 1
+                        yield dict(payload, type='file')
+                        continue
+                    
+                    url, depth = payload
+                    host_inflight[urlparse(url).netloc] -= 1
+                    result = future.result()
+                    if self._retry_later(url, depth, result, frontier):
+                        continue
+                    yield from self._handle_listing(url, depth, result, frontier, counts,
+                                                    resolve_sizes, schedule_probe)
+        finally:
+            # Cliente pode desistir no meio: não esperar requisições em andamento
+            pool.shutdown(wait=False, cancel_futures=True)
+            probe_pool.shutdown(wait=False, cancel_futures=True)
+            IN_FLIGHT.dec(kind='scan')
+        
+        self.record_index()
+        yield self._finish(frontier, counts, start_time, resolve_sizes)
+    
+    def run(self, root_url, resolve_sizes=True):
+        for event in self.events(root_url, resolve_sizes):
+            pass
+        return self._collect()
+
+def scan_directory_recursive(url, file_type, max_depth=SCAN_DEFAULT_DEPTH, current_depth=0, include_src=False,
+                             resolve_sizes=True, use_cache=True, use_index=True):
+    """Escaneia um diretório recursivamente procurando por arquivos"""
+    crawler = ScanCrawler(file_type, max_depth=max_depth - current_depth, include_src=include_src,
+                          cache=scan_cache if use_cache else None, index=site_index if use_index else None)
+    return crawler.run(url, resolve_sizes)
+
+scan_flights = SingleFlight()
+
+def scan_directory_shared(url, file_type, include_src=False, resolve_sizes=True, use_cache=True,
+                          max_depth=SCAN_DEFAULT_DEPTH, budget=None, resume=None, continuation=None, use_index=True):
+    """Como ``scan_directory_recursive``, mas retorna (arquivos, relatório do
+    ``ScanCrawler.report``) e escaneamentos idênticos simultâneos compartilham
+    uma única execução (o resultado não deve ser alterado)"""
+    budget = budget or ScanBudget()
+    key = (ScanCache.make_key(url, file_type, include_src), bool(resolve_sizes), bool(use_cache),
+           max_depth, budget.key(), continuation, bool(use_index))
+    
+    def scan():
+        crawler = ScanCrawler(file_type, max_depth=max_depth, include_src=include_src,
+                              cache=scan_cache if use_cache else None, budget=budget, resume=resume,
+                              index=site_index if use_index else None)
+        return crawler.run(url, resolve_sizes), crawler.report()
+    
+    (files, report), shared = scan_flights.do(key, scan)
+    if shared:
+        logger.info("Escaneamento compartilhado com uma requisição em andamento")
+    return files, report
+
+def parse_scan_request(data):
+    """Valida os parâmetros de escaneamento; retorna (params, erro)
+
+    Com ``continuation`` (token de um resultado parcial), URL, tipo,
+    ``include_src`` e profundidade vêm do token.
+    """
+    budget, error = ScanBudget.from_request(data)
+    if error:
+        return None, error
+    
+    continuation = data.get('continuation') or None
+    resume = None
+    if continuation:
+        try:
+            resume = decode_scan_token(str(continuation))
+        except ValueError as e:
+            logger.warning("%s", e)
+            return None, "Token de continuação inválido"
+        data = dict(data, url=resume['url'], file_type=resume['file_type'],
+                    include_src=resume['include_src'], max_depth=resume['max_depth'])
+    
+    url = (data.get('url') or '').strip()
+    
+    if not url:
+        return None, "URL é obrigatória"
+    
+    if not is_valid_url(url):
+        return None, "URL inválida"
+    
+    try:
+        max_depth = int(data.get('max_depth') or SCAN_DEFAULT_DEPTH)
+    except (TypeError, ValueError):
+        max_depth = 0
+    if not 1 <= max_depth <= SCAN_MAX_DEPTH:
+        return None, f"max_depth deve estar entre 1 e {SCAN_MAX_DEPTH}"
+    
+    params = {
+        'url': url,
+        'file_type': data.get('file_type', 'zip'),
+        'include_src': data.get('include_src', False),
+        'resolve_sizes': data.get('resolve_sizes', True),
+        'use_cache': data.get('use_cache', True),
+        'use_index': data.get('use_index', True),
+        'max_depth': max_depth,
+        'budget': budget,
+        'resume': resume,
+        'continuation': continuation
+    }
+    
+    logger.info("Iniciando escaneamento de: %s (tipo=%s, include_src=%s)",
+                strip_credentials(url), params['file_type'], params['include_src'])
+    
+    # Verificar se é URL interna (apenas aviso, não bloqueia)
+    is_internal = '172.17.' in url or '192.168.' in url or '10.' in url
+    if is_internal:
+        logger.warning("URL interna detectada: %s (pode não ser acessível em produção: Vercel/AWS)",
+                       strip_credentials(url))
+    
+    # Verificar se contém credenciais (apenas aviso)
+    if has_credentials(url):
+        logger.warning("URL contém credenciais (usuário/senha); elas são omitidas dos logs")
+    
+    return params, None
+
+@app.route('/scan', methods=['POST'])
+def scan_url():
+    try:
+        data = request.get_json()
+        params, error = parse_scan_request(data)
+        if error:
+            return jsonify({
+                "success": False,
+                "error": error
+            }), 400
+        
+        # Escanear o diretório
+        files, report = scan_directory_shared(params['url'], params['file_type'],
+                                              include_src=params['include_src'],
+                                              resolve_sizes=params['resolve_sizes'],
+                                              use_cache=params['use_cache'],
+                                              max_depth=params['max_depth'],
+                                              budget=params['budget'],
+                                              resume=params['resume'],
+                                              continuation=params['continuation'],
+                                              use_index=params['use_index'])
+        
+        logger.info("Encontrados %d arquivos", len(files))
+        
+        return jsonify({
+            "success": True,
+            "files_found": len(files),
+            "files": files,
+            **report,
+            "message": f"Encontrados {len(files)} arquivos do tipo {params['file_type']}"
+        })
+        
+    except Exception as e:
+        logger.exception("Erro no escaneamento: %s", e)
+        return jsonify({
+            "success": False,
+            "error": f"Erro interno: {str(e)}"
+        }), 500
+
+def format_scan_event(event, stream_format):
+    """Serializa um evento do crawler como linha NDJSON ou evento SSE"""
+    payload = json.dumps(event, ensure_ascii=False)
+    if stream_format == 'sse':
+        return f"event: {event['type']}\ndata: {payload}\n\n"
+    return payload + '\n'
+
+@app.route('/scan-stream', methods=['OPTIONS'])
+def scan_stream_options():
+    """Handle preflight requests for CORS"""
+    return '', 200
+
+@app.route('/scan-stream', methods=['GET', 'POST'])
+def scan_stream():
+    """Escaneamento com resultados incrementais (NDJSON ou Server-Sent Events)"""
+    # EventSource só faz GET: aceitar os parâmetros também pela query string
+    data = request.get_json(silent=True) or {}
+    if request.method == 'GET':
+        data = {key: value for key, value in request.args.items()}
+        for flag in ('include_src', 'resolve_sizes', 'use_cache', 'use_index'):
+            if flag in data:
+                data[flag] = data[flag].lower() in ('1', 'true', 'yes')
+    
+    params, error = parse_scan_request(data)
+    if error:
+        return jsonify({
+            "success": False,
+            "error": error
+        }), 400
+    
+    stream_format = data.get('format')
+    if not stream_format:
+        stream_format = 'sse' if 'text/event-stream' in request.headers.get('Accept', '') else 'ndjson'
+    if stream_format not in SCAN_STREAM_FORMATS:
+        return jsonify({
+            "success": False,
+            "error": f"Formato inválido: {stream_format} (use 'ndjson' ou 'sse')"
+        }), 400
+    
+    crawler = ScanCrawler(params['file_type'], max_depth=params['max_depth'], include_src=params['include_src'],
+                          cache=scan_cache if params['use_cache'] else None,
+                          budget=params['budget'], resume=params['resume'],
+                          index=site_index if params['use_index'] else None)
+    
+    def generate():
+        try:
+            for event in crawler.events(params['url'], params['resolve_sizes']):
+                yield format_scan_event(event, stream_format)
+        except Exception as e:
+            logger.exception("Erro no escaneamento: %s", e)
+            yield format_scan_event({'type': 'error', 'url': strip_credentials(params['url']), 'error': str(e)}, stream_format)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype=SCAN_STREAM_FORMATS[stream_format],
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'Access-Control-Allow-Origin': '*'
+        }
+    )
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Estatísticas internas de desempenho"""
+    return jsonify({
+        "version": VERSION,
+        "http_pools": http_pool.stats(),
+        "compression": compression_stats.snapshot(),
+        "scan_cache": scan_cache.stats(),
+        "site_index": site_index.stats(),
+        "download_cache": download_cache.stats(),
+        "coalescing": {
+            "scan": scan_flights.stats(),
+            "download": download_flights.stats()
+        }
+    })
+
+def parse_since(value):
+    """Instante do ``since``: timestamp Unix ou data ISO 8601 (sem fuso = UTC)"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+@app.route('/changes', methods=['GET'])
+def changes():
+    """Arquivos novos e removidos de um site indexado desde ``since``"""
+    url = (request.args.get('url') or '').strip()
+    if not url or not is_valid_url(url):
+        return jsonify({
+            "success": False,
+            "error": "URL inválida ou ausente"
+        }), 400
+    
+    try:
+        since = parse_since(request.args.get('since', '0'))
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "Parâmetro since inválido (use timestamp Unix ou data ISO 8601)"
+        }), 400
+    
+    if not site_index.enabled:
+        return jsonify({
+            "success": False,
+            "error": "Índice de sites desativado (SITE_INDEX_DB)"
+        }), 503
+    
+    include_src = request.args.get('include_src', '').lower() in ('1', 'true', 'yes')
+    scope = SiteIndex.make_scope(url, request.args.get('file_type', 'zip'), include_src)
+    # Janela fechada em ``until``: serve de ``since`` para a próxima chamada
+    until = time.time()
+    result = site_index.changes(scope, since, until)
+    if result is None:
+        return jsonify({
+            "success": False,
+            "error": "Site ainda não indexado: faça um /scan antes"
+        }), 404
+    
+    return jsonify(dict(result, success=True, since=since, until=until))
+
+
+@app.route('/download-stream', methods=['OPTIONS'])
+def download_stream_options():
+    """Handle preflight requests for CORS"""
+    return '', 200
+
+class ZipStreamBuffer:
+    """Destino de escrita não-seekable para ``zipfile``.
+
+    O ``zipfile`` passa a usar data descriptors e os bytes escritos são
+    entregues ao cliente a cada ``drain()``, sem manter o arquivo inteiro.
+    """
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+class ArchiveEntryIndex:
+    """Entradas de um pedido de download, indexadas por arquivo e por nome.
+
+    URLs equivalentes (``resource_key``) viram uma entrada só, antes de
+    qualquer download; os outros nomes pedidos para o mesmo arquivo ficam em
+    ``aliases``. Nomes repetidos (sem diferenciar maiúsculas) ganham " (2)",
+    " (3)"... na ordem do pedido, então o ZIP sai igual mesmo com
+    ``order=completion``. Os nomes dos relatórios do ZIP ficam reservados.
+    """
+    
+    def __init__(self, reserved=(DOWNLOAD_ERRORS_ENTRY, DOWNLOAD_DUPLICATES_ENTRY)):
+        self.entries = []
+        self.duplicates = 0
+        self._by_key = {}
+        self._names = {name.lower() for name in reserved}
+    
+    def unique_name(self, filename):
+        if filename.lower() not in self._names:
+            return filename
+        stem, ext = os.path.splitext(filename)
+        if stem.lower().endswith('.tar'):
+            stem, ext = stem[:-4], stem[-4:] + ext
+        number = 2
+        while f"{stem} ({number}){ext}".lower() in self._names:
+            number += 1
+        return f"{stem} ({number}){ext}"
+    
+    def add(self, url, filename):
+        """Acrescenta uma entrada; False se o mesmo arquivo já estava no pedido"""
+        key = resource_key(url)
+        entry = self._by_key.get(key)
+        if entry is not None:
+            self.duplicates += 1
+            DEDUPLICATED.inc(kind='download_url')
+            logger.debug("URL repetida no pedido: %s (%s)", filename, strip_credentials(url))
+            if filename.lower() != entry['filename'].lower():
+                entry.setdefault('aliases', []).append(filename)
+            return False
+        
+        name = self.unique_name(filename)
+        if name != filename:
+            logger.debug("Nome repetido no ZIP: %s -> %s", filename, name)
+        self._names.add(name.lower())
+        entry = self._by_key[key] = {'url': url, 'filename': name}
+        self.entries.append(entry)
+        return True
+
+def prepare_download_entries(files):
+    """Normaliza a lista recebida do frontend em entradas {url, filename}, sem
+    arquivos repetidos e com nomes únicos (``ArchiveEntryIndex``)"""
+    index = ArchiveEntryIndex()
+    for idx, file_info in enumerate(files):
+        file_url = None
+        filename = None
+        
+        # Se file_info é string (URL direta)
+        if isinstance(file_info, str):
+            # Verificar se é uma URL ou JSON string
+            if file_info.startswith('http://') or file_info.startswith('https://'):
+                # É uma URL direta
+                file_url = file_info
+                # Extrair filename da URL
+                parsed = urlparse(file_url)
+                filename = os.path.basename(parsed.path)
+                # Remover /view se existir
+                if filename == 'view':
+                    path_parts = parsed.path.rstrip('/view').split('/')
+                    filename = path_parts[-1] if path_parts else f'file_{idx}'
+                logger.debug("URL direta convertida: %s <- %s", filename, file_url)
+            else:
+                # Tentar fazer parse como JSON
+                try:
+                    file_info = json.loads(file_info)
+                except json.JSONDecodeError:
+                    logger.warning("file_info não é URL nem JSON válido: %s", file_info)
+                    continue
+        
+        # Se file_info agora é dict, extrair url e filename
+        if isinstance(file_info, dict):
+            file_url = file_info.get('url')
+            filename = file_info.get('filename')
+            
+            if not file_url:
+                logger.warning("Arquivo sem url: %s", file_info)
+                continue
+            
+            if not filename:
+                # Tentar extrair filename da URL
+                parsed = urlparse(file_url)
+                filename = os.path.basename(parsed.path)
+                if filename == 'view':
+                    path_parts = parsed.path.rstrip('/view').split('/')
+                    filename = path_parts[-1] if path_parts else f'file_{idx}'
+                logger.debug("Filename extraído da URL: %s", filename)
+        
+        # Validação final
+        if not file_url or not filename:
+            logger.warning("Arquivo inválido após processamento: url=%s, filename=%s", file_url, filename)
+            continue
+        
+        # Converter URLs do tipo /view para /@@download/file (Plone/gov.br)
+        if file_url.endswith('/view'):
+            file_url = file_url.replace('/view', '/@@download/file')
+            logger.debug("URL convertida: %s", file_url)
+        
+        index.add(file_url, filename)
+    
+    if index.duplicates:
+        logger.info("%d URLs repetidas no pedido: cada arquivo é baixado uma vez", index.duplicates)
+    return index.entries
+
+def open_upstream_file(file_url, conditional_headers=None):
+    """Abre o download de um arquivo em modo streaming (corpo ainda não lido)"""
+    logger.debug("Baixando: %s", strip_credentials(file_url))
+    
+    # Preparar autenticação se necessário
+    auth = None
+    parsed_url = urlparse(file_url)
+    if parsed_url.username and parsed_url.password:
+        auth = (parsed_url.username, parsed_url.password)
+    
+    # Baixar arquivo com headers que simulam browser
+    response = http_pool.session_for(file_url).get(
+        file_url, timeout=15, auth=auth, headers=dict(DOWNLOAD_HEADERS, **(conditional_headers or {})),
+        allow_redirects=True, stream=True
+    )
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    return response
+
+class CompressionStats:
+    """Contadores globais de compressão do ZIP (expostos em /stats)"""
+    
+    def __init__(self):
+        self.entries = Counter()
+        self.bytes = Counter()
+        self.cpu_seconds = Counter()
+        self._lock = threading.Lock()
+    
+    def record(self, compress_type, size, cpu_seconds):
+        method = COMPRESSION_NAMES[compress_type]
+        with self._lock:
+            self.entries[method] += 1
+            self.bytes[method] += size
+            self.cpu_seconds[method] += cpu_seconds
+    
+    def estimated_cpu_saved(self):
+        """CPU que as entradas STORED teriam gasto com DEFLATE, pela taxa medida"""
+        with self._lock:
+            if not self.bytes['deflated']:
+                return 0.0
+            rate = self.cpu_seconds['deflated'] / self.bytes['deflated']
+            return max(self.bytes['stored'] * rate - self.cpu_seconds['stored'], 0.0)
+    
+    def snapshot(self):
+        with self._lock:
+            data = {
+                method: {
+                    'entries': self.entries[method],
+                    'bytes': self.bytes[method],
+                    'cpu_seconds': round(self.cpu_seconds[method], 4)
+                }
+                for method in COMPRESSION_NAMES.values()
+            }
+        data['estimated_cpu_saved_seconds'] = round(self.estimated_cpu_saved(), 4)
+        return data
+
+compression_stats = CompressionStats()
+
+class CompressionPolicy:
+    """Escolhe STORED ou DEFLATED para cada entrada do ZIP.
+
+    No modo ``auto`` arquivos já comprimidos (pela extensão ou content-type)
+    são gravados sem recompressão; nos demais uma amostra do início do corpo
+    é comprimida rapidamente e só vale DEFLATE se houver ganho real.
+    """
+    
+    def __init__(self, mode='auto', level=None):
+        self.mode = mode
+        self.level = ZIP_COMPRESSION_LEVEL if level is None else level
+    
+    def choose(self, filename, content_type='', sample=b''):
+        """Retorna (compress_type, motivo)"""
+        if self.mode == 'store':
+            return zipfile.ZIP_STORED, 'request'
+        if self.mode == 'deflate':
+            return zipfile.ZIP_DEFLATED, 'request'
+        
+        if get_file_extension(filename) in INCOMPRESSIBLE_EXTENSIONS:
+            return zipfile.ZIP_STORED, 'extension'
+        mime = content_type.split(';', 1)[0].strip()
+        if mime in INCOMPRESSIBLE_CONTENT_TYPES or mime.startswith(('video/', 'audio/')):
+            return zipfile.ZIP_STORED, 'content-type'
+        if sample:
+            ratio = len(zlib.compress(sample, 1)) / len(sample)
+            if ratio >= COMPRESSION_MIN_RATIO:
+                return zipfile.ZIP_STORED, 'sample'
+        return zipfile.ZIP_DEFLATED, 'sample'
+    
+    def zip_info(self, filename, compress_type):
+        # Entrada com data descriptor + ZIP64: o tamanho não precisa ser conhecido
+        zinfo = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+        zinfo.compress_type = compress_type
+        if compress_type == zipfile.ZIP_DEFLATED:
+            if hasattr(zipfile.ZipInfo, 'compress_level'):
+                zinfo.compress_level = self.level
+            else:
+                zinfo._compresslevel = self.level
+        return zinfo
+
+class ByteBudget:
+    """Orçamento de bytes em memória compartilhado pelos downloads em andamento"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+    
+    def try_acquire(self, size):
+        with self._lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+    
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+
+class CachedBody:
+    """Corpo de um arquivo guardado no cache de downloads"""
+    
+    def __init__(self, key, path, size, content_type, etag, last_modified, digest=None):
+        self.key = key
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+    
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+    
+    def open(self):
+        return open(self.path, 'rb')
+
+class DownloadCache(LazyDatabase):
+    """Cache em disco dos arquivos baixados, endereçado pelo conteúdo.
+
+    O índice (SQLite) liga a URL final de cada arquivo ao SHA-256 do corpo e
+    aos validadores ``ETag``/``Last-Modified``; o mesmo conteúdo servido por
+    URLs diferentes ocupa um único blob. Acima de ``max_bytes`` os blobs usados
+    há mais tempo são removidos (LRU).
+    """
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._init_db()
+    
+    def _open_db(self):
+        if not self.directory or self.max_bytes <= 0:
+            return None
+        try:
+            os.makedirs(os.path.join(self.directory, 'blobs'), exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.directory, 'index.db'), check_same_thread=False)
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS download_entries ('
+                'key TEXT PRIMARY KEY, url TEXT, digest TEXT, size INTEGER, content_type TEXT, '
+                'etag TEXT, last_modified TEXT, last_used REAL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS download_entries_digest ON download_entries (digest)')
+            db.commit()
+            return db
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Cache de downloads desativado: %s", e)
+            return None
+    
+    @staticmethod
+    def make_key(url):
+        return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+    
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest)
+    
+    def cacheable(self, headers):
+        """Só vale guardar o que pode ser revalidado depois"""
+        if not self.enabled or 'no-store' in headers.get('Cache-Control', '').lower():
+            return False
+        return bool(headers.get('ETag') or headers.get('Last-Modified'))
+    
+    def lookup(self, url):
+        if not self.enabled:
+            return None
+        key = self.make_key(url)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT digest, size, content_type, etag, last_modified FROM download_entries WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.counters['misses'] += 1
+                return None
+            digest, size, content_type, etag, last_modified = row
+            if not os.path.exists(self._blob_path(digest)):
+                self._forget(key)
+                self._db.commit()
+                self.counters['misses'] += 1
+                return None
+        return CachedBody(key, self._blob_path(digest), size, content_type, etag, last_modified, digest)
+    
+    def record_hit(self, body):
+        """Upstream respondeu 304: o corpo em cache continua válido"""
+        with self._lock:
+            self._db.execute('UPDATE download_entries SET last_used = ? WHERE key = ?', (time.time(), body.key))
+            self._db.commit()
+            self.counters['hits'] += 1
+            self.counters['bytes_served'] += body.size
+    
+    def store(self, url, headers, fileobj, digest, size):
+        """Guarda o corpo (já baixado em ``fileobj``) sob o hash ``digest``"""
+        if not self.enabled or size > self.max_bytes:
+            return
+        path = self._blob_path(digest)
+        tmp_path = None
+        if not os.path.exists(path):
+            # Cópia fora do lock; o blob só aparece com o nome final já completo
+            fileobj.seek(0)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as tmp:
+                shutil.copyfileobj(fileobj, tmp, ZIP_STREAM_CHUNK_SIZE)
+                tmp_path = tmp.name
+        
+        key = self.make_key(url)
+        with self._lock:
+            if tmp_path is not None:
+                os.replace(tmp_path, path)
+            elif os.path.exists(path):
+                self.counters['dedup_hits'] += 1
+            else:
+                # Blob removido por despejo enquanto isso; fica para a próxima
+                return
+            
+            row = self._db.execute('SELECT digest FROM download_entries WHERE key = ?', (key,)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO download_entries '
+                '(key, url, digest, size, content_type, etag, last_modified, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, strip_credentials(url), digest, size, headers.get('content-type', '').lower(),
+                 headers.get('ETag'), headers.get('Last-Modified'), time.time())
+            )
+            if row is not None:
+                self.counters['refreshed'] += 1
+                if row[0] != digest:
+                    self._release_blob(row[0])
+            self.counters['stores'] += 1
+            self.counters['bytes_stored'] += size
+            self._evict()
+            self._db.commit()
+    
+    def _forget(self, key):
+        row = self._db.execute('SELECT digest FROM download_entries WHERE key = ?', (key,)).fetchone()
+        self._db.execute('DELETE FROM download_entries WHERE key = ?', (key,))
+        if row is not None:
+            self._release_blob(row[0])
+    
+    def _release_blob(self, digest):
+        """Apaga o blob se nenhuma URL aponta mais para ele"""
+        if self._db.execute('SELECT 1 FROM download_entries WHERE digest = ? LIMIT 1', (digest,)).fetchone():
+            return False
+        try:
+            os.remove(self._blob_path(digest))
+        except OSError:
+            # Já removido, ou ainda aberto por um leitor (Windows)
+            pass
+        return True
+    
+    def _total_bytes(self):
+        return self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM download_entries GROUP BY digest)'
+        ).fetchone()[0]
+    
+    def _evict(self):
+        total = self._total_bytes()
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute('SELECT key, digest, size FROM download_entries ORDER BY last_used').fetchall()
+        for key, digest, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM download_entries WHERE key = ?', (key,))
+            if self._release_blob(digest):
+                total -= size
+                self.counters['evictions'] += 1
+    
+    def stats(self):
+        with self._lock:
+            data = dict(self.counters)
+            data['enabled'] = self.enabled
+            if self.enabled:
+                lookups = data.get('hits', 0) + data.get('misses', 0)
+                data.update({
+                    'entries': self._db.execute('SELECT COUNT(*) FROM download_entries').fetchone()[0],
+                    'blobs': self._db.execute('SELECT COUNT(DISTINCT digest) FROM download_entries').fetchone()[0],
+                    'bytes': self._total_bytes(),
+                    'max_bytes': self.max_bytes,
+                    'hit_ratio': round(data.get('hits', 0) / lookups, 3) if lookups else 0.0
+                })
+        return data
+
+download_cache = DownloadCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_MAX_BYTES)
+download_flights = SingleFlight()
+
+class SharedBody:
+    """Corpo baixado, compartilhado pelos downloads coalescidos da mesma URL.
+
+    Cada leitor mantém sua própria posição e lê por ``read_at``; o arquivo (e
+    a parte do orçamento de memória que ocupa) só é liberado quando o último
+    leitor chama ``release``.
+    """
+    
+    def __init__(self, fileobj, size, content_type, budget=None, held=0, digest=None):
+        self.file = fileobj
+        self.size = size
+        self.content_type = content_type
+        self.digest = digest
+        self._budget = budget
+        self._held = held
+        self._refs = 1
+        self._lock = threading.Lock()
+    
+    def acquire(self, count=1):
+        with self._lock:
+            self._refs += count
+    
+    def read_at(self, offset, size):
+        with self._lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+    
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs:
+                return
+            self.file.close()
+        if self._budget is not None and self._held:
+            self._budget.release(self._held)
+
+class BodyAccumulator:
+    """Recebe o corpo de um download em blocos, dentro do orçamento de memória.
 
-def should_include_file(filename, file_type):
-    """Verifica se o arquivo deve ser incluído baseado no tipo"""
-    ext = get_file_extension(filename)
+    O que não cabe no orçamento vai para disco. O SHA-256 é calculado durante
+    a leitura: identifica conteúdo repetido no ZIP e, com ``cacheable``, é o
+    endereço do corpo no cache de downloads.
+    """
+    
+    def __init__(self, budget, cacheable=False):
+        self.budget = budget
+        # max_size=0: quem decide a ida para disco é o orçamento, não o tamanho
+        self.body = tempfile.SpooledTemporaryFile(max_size=0)
+        self.cacheable = cacheable
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.held = 0
+        self.spilled = False
+    
+    def write(self, chunk):
+        if not self.spilled:
+            if self.budget.try_acquire(len(chunk)):
+                self.held += len(chunk)
+            else:
+                self.body.rollover()
+                self.spilled = True
+        self.body.write(chunk)
+        self.digest.update(chunk)
+        self.size += len(chunk)
+    
+    def discard(self):
+        self.body.close()
+        self.budget.release(self.held)
     
-    if file_type == 'zip':
-        return ext in ['.zip', '.7z', '.rar', '.tar', '.gz', '.bz2']
-    elif file_type == 'images':
-        return ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.svg']
-    elif file_type == 'pdf':
-        return ext == '.pdf'
-    return False
+    def finish(self, url, headers):
+        BYTES_IN.inc(self.size, kind='download')
+        digest = self.digest.hexdigest()
+        if self.cacheable:
+            download_cache.store(url, headers, self.body, digest, self.size)
+        content_type = headers.get('content-type', '').lower()
+        return SharedBody(self.body, self.size, content_type, self.budget, self.held, digest)
 
-def is_valid_url(url):
-    """Verifica se a URL é válida"""
-    try:
-        result = urlparse(url)
-        return all([result.scheme, result.netloc])
-    except:
-        return False
+def download_upstream_body(url, budget):
+    """Baixa o corpo de ``url`` (ou revalida a cópia em cache).
 
-def has_credentials(url):
-    """Verifica se a URL contém credenciais (usuário/senha)"""
+    Retorna um ``CachedBody`` quando o upstream responde 304, senão um
+    ``SharedBody``; o que não cabe no orçamento de memória vai para disco.
+    """
+    cached = download_cache.lookup(url)
+    response = open_upstream_file(url, cached.conditional_headers() if cached else None)
+    if cached is not None and response.status_code == 304:
+        response.close()
+        download_cache.record_hit(cached)
+        logger.debug("Cache de download válido: %s (%d bytes)", strip_credentials(url), cached.size)
+        return cached
+    
+    accumulator = BodyAccumulator(budget, download_cache.cacheable(response.headers))
     try:
-        result = urlparse(url)
-        return bool(result.username or result.password)
-    except:
-        return False
+        for chunk in response.iter_content(ZIP_STREAM_CHUNK_SIZE):
+            accumulator.write(chunk)
+    except Exception:
+        accumulator.discard()
+        raise
+    finally:
+        response.close()
+    return accumulator.finish(url, response.headers)
 
-def scan_directory_recursive(url, file_type, max_depth=3, current_depth=0, include_src=False):
-    """Escaneia um diretório recursivamente procurando por arquivos"""
-    files = []
+def share_download_body(body, waiters):
+    # Uma referência por download em espera, antes de o resultado ser entregue
+    if isinstance(body, SharedBody):
+        body.acquire(waiters)
+
+class PrefetchedFile:
+    """Resultado de um download antecipado (corpo completo ou erro)"""
     
-    if current_depth >= max_depth:
-        return files
+    def __init__(self, index, entry):
+        self.index = index
+        self.entry = entry
+        self.body = None
+        self.size = 0
+        self.content_type = ''
+        self.digest = None
+        self.cached = False
+        self.shared = False
+        self.error = None
+        self._file = None
+        self._mapped = None
     
-    try:
-        print(f"Escaneando: {url} (profundidade: {current_depth})")
-        
-        # Preparar autenticação se necessário
-        auth = None
-        parsed_url = urlparse(url)
-        if parsed_url.username and parsed_url.password:
-            auth = (parsed_url.username, parsed_url.password)
+    def fetch(self, budget):
+        """Baixa o corpo inteiro; downloads simultâneos da mesma URL são coalescidos"""
+        url = self.entry['url']
         
-        # Fazer requisição com timeout e autenticação
-        response = requests.get(url, timeout=30, stream=True, auth=auth)
-        response.raise_for_status()
-        
-        # Verificar se é um arquivo direto (não HTML)
-        content_type = response.headers.get('content-type', '').lower()
-        filename = os.path.basename(parsed_url.path)
-        
-        # Se não é HTML, verificar se é um arquivo do tipo desejado
-        if 'text/html' not in content_type and filename:
-            if should_include_file(filename, file_type):
-                file_size = int(response.headers.get('content-length', 0))
-                files.append({
-                    'filename': filename,
-                    'url': url,
-                    'size': file_size
-                })
-                print(f"Arquivo direto encontrado: {filename} ({file_size} bytes)")
-            return files
+        def download():
+            with IN_FLIGHT.track(kind='download'), STAGE_SECONDS.time(stage='file_download'):
+                return download_upstream_body(url, budget)
         
-        # Se é HTML, continuar com o escaneamento de diretório
-        if 'text/html' not in content_type:
-            return files
-        
-        # Parse simples do HTML usando regex
-        html_content = response.text
-        
-        # Debug: mostrar parte do conteúdo HTML
-        print(f"Content-Type: {content_type}")
-        print(f"HTML preview: {html_content[:200]}...")
-        
-        # Encontrar links usando regex simples
-        link_pattern = r'<a[^>]*href=["\']([^"\']*)["\'][^>]*>'
-        links = re.findall(link_pattern, html_content, re.IGNORECASE)
-        
-        print(f"Encontrados {len(links)} links href")
-        
-        # Se include_src=True, também buscar elementos com atributo src
-        if include_src:
-            src_pattern = r'<(?:img|script|iframe|video|audio|source|embed)[^>]*src=["\']([^"\']*)["\'][^>]*>'
-            src_links = re.findall(src_pattern, html_content, re.IGNORECASE)
-            print(f"Encontrados {len(src_links)} elementos com src")
-            links.extend(src_links)
-        
-        # Se não encontrou links, tentar outros padrões
-        if len(links) == 0:
-            # Tentar encontrar URLs de arquivos diretamente no HTML
-            file_patterns = {
-                'pdf': r'[^"\'>\s]+\.pdf(?:\?[^"\'>\s]*)?',
-                'zip': r'[^"\'>\s]+\.(?:zip|7z|rar|tar|gz|bz2)(?:\?[^"\'>\s]*)?',
-                'images': r'[^"\'>\s]+\.(?:png|jpg|jpeg|gif|bmp|webp|svg)(?:\?[^"\'>\s]*)?'
-            }
-            
-            if file_type in file_patterns:
-                file_links = re.findall(file_patterns[file_type], html_content, re.IGNORECASE)
-                print(f"Encontrados {len(file_links)} arquivos {file_type} via regex direto")
-                links.extend(file_links)
+        body, self.shared = download_flights.do(url, download, share=share_download_body)
+        if self.shared:
+            logger.debug("Download compartilhado: %s", self.entry['filename'])
+        self.attach(body)
+    
+    def attach(self, body):
+        """Associa o corpo baixado (``SharedBody``) ou em cache (``CachedBody``)"""
+        self.size = body.size
+        self.content_type = body.content_type
+        self.digest = body.digest
+        if isinstance(body, CachedBody):
+            self._open_cached(body)
+        else:
+            self.body = body
+    
+    def _open_cached(self, cached):
+        """Usa o blob do cache; o corpo é lido por mmap, sem cópia para o heap"""
+        # Só downloads servidos do cache usam mmap: importado aqui
+        import mmap
         
-        for href in links:
-            if not href or href in ['../', './', '/']:
-                continue
-            
-            # Construir URL completa
-            full_url = urljoin(url, href)
-            
-            # Verificar se é um arquivo
-            filename = os.path.basename(href.rstrip('/'))
-            
-            if not filename:
+        self.cached = True
+        self._file = cached.open()
+        if self.size:
+            self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def sample(self, size):
+        """Primeiros bytes do corpo, para a política de compressão"""
+        if self._mapped is not None:
+            return self._mapped[:size]
+        if self.body is not None:
+            return self.body.read_at(0, size)
+        return b''
+    
+    def chunks(self, chunk_size):
+        if self._mapped is not None:
+            view = memoryview(self._mapped)
+            for start in range(0, self.size, chunk_size):
+                yield view[start:start + chunk_size]
+            return
+        if self.body is None:
+            return
+        offset = 0
+        while True:
+            data = self.body.read_at(offset, chunk_size)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+    
+    def close(self):
+        if self._mapped is not None:
+            try:
+                self._mapped.close()
+            except BufferError:
+                # Ainda há fatias em uso; o mapeamento é fechado pelo GC
+                pass
+            self._mapped = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.body is not None:
+            self.body.release()
+            self.body = None
+
+class DownloadPrefetcher:
+    """Estágio de download antecipado para o ZIP.
+
+    Baixa até ``max_parallel`` arquivos ao mesmo tempo, respeitando um limite
+    por host e um orçamento de bytes em memória, e entrega os resultados na
+    ordem do pedido ou na ordem de conclusão.
+    """
+    
+    def __init__(self, entries, max_parallel=None, max_per_host=None, budget_bytes=None):
+        self.entries = entries
+        self.max_parallel = max_parallel or DOWNLOAD_MAX_PARALLEL
+        self.max_per_host = max_per_host or DOWNLOAD_MAX_PER_HOST
+        self.budget = ByteBudget(budget_bytes or DOWNLOAD_INFLIGHT_BYTES)
+    
+    def _fetch(self, result):
+        try:
+            result.fetch(self.budget)
+        except Exception as e:
+            result.close()
+            result.error = e
+        return result
+    
+    def _next_batch(self, queue, host_inflight, in_flight, next_index):
+        """Retira da fila os arquivos que podem começar agora"""
+        batch = []
+        deferred = deque()
+        # Janela limita quantos arquivos podem ficar prontos à espera do ZIP
+        window = self.max_parallel * 2
+        while queue and in_flight + len(batch) < self.max_parallel:
+            result = queue.popleft()
+            host = urlparse(result.entry['url']).netloc
+            if host_inflight[host] >= self.max_per_host or result.index >= next_index + window:
+                deferred.append(result)
                 continue
-            
-            # Verificar se deve ser incluído
-            if should_include_file(filename, file_type):
-                file_size = 0
-                try:
-                    # Tentar obter o tamanho do arquivo
-                    head_response = requests.head(full_url, timeout=10, auth=auth)
-                    if head_response.status_code == 200:
-                        file_size = int(head_response.headers.get('content-length', 0))
-                except:
-                    pass
+            host_inflight[host] += 1
+            batch.append((host, result))
+        queue.extendleft(reversed(deferred))
+        return batch
+    
+    @staticmethod
+    def _pop_ready(ready, next_index, order):
+        """Resultados que já podem ser entregues; retorna (resultados, next_index)"""
+        released = []
+        if order == 'completion':
+            for index in sorted(ready):
+                next_index += 1
+                released.append(ready.pop(index))
+        else:
+            while next_index in ready:
+                released.append(ready.pop(next_index))
+                next_index += 1
+        return released, next_index
+    
+    def results(self, order='request'):
+        queue = deque(PrefetchedFile(idx, entry) for idx, entry in enumerate(self.entries))
+        host_inflight = Counter()
+        pending = {}
+        ready = {}
+        next_index = 0
+        
+        pool = ThreadPoolExecutor(max_workers=self.max_parallel)
+        try:
+            while queue or pending or ready:
+                for host, result in self._next_batch(queue, host_inflight, len(pending), next_index):
+                    pending[pool.submit(self._fetch, result)] = host
                 
-                files.append({
-                    'filename': filename,
-                    'url': full_url,
-                    'size': file_size
-                })
+                if pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        host_inflight[pending.pop(future)] -= 1
+                        result = future.result()
+                        ready[result.index] = result
                 
-                print(f"Arquivo encontrado: {filename} ({file_size} bytes)")
-            
-            # Se for um diretório, escanear recursivamente
-            elif href.endswith('/') and current_depth < max_depth - 1:
-                sub_files = scan_directory_recursive(full_url, file_type, max_depth, current_depth + 1, include_src)
-                files.extend(sub_files)
-        
-    except Exception as e:
-        print(f"Erro ao escanear {url}: {str(e)}")
+                released, next_index = self._pop_ready(ready, next_index, order)
+                yield from released
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            for result in ready.values():
+                result.close()
+
+def parse_download_request(data):
+    """Extrai e valida a lista de arquivos do corpo; retorna (files, erro)"""
+    if not data:
+        logger.warning("Nenhum dado JSON recebido")
+        return None, "Nenhum dado recebido"
+    
+    # Aceitar tanto 'files' quanto 'selected_files' do frontend
+    files = data.get('files', data.get('selected_files', []))
+    
+    # Se files é uma string JSON, fazer parse
+    if isinstance(files, str):
+        try:
+            files = json.loads(files)
+            logger.debug("Files era string JSON, convertido para lista")
+        except json.JSONDecodeError as e:
+            logger.warning("Erro ao fazer parse de files como JSON: %s", e)
+            return None, "Formato de arquivos inválido (JSON mal formado)"
     
-    return files
+    if not files:
+        logger.warning("Nenhum arquivo recebido")
+        logger.debug("Dados recebidos: %s", data)
+        return None, "Nenhum arquivo para download"
+    
+    # Validar estrutura dos arquivos
+    if not isinstance(files, list):
+        logger.warning("'files' não é uma lista. Tipo: %s", type(files))
+        return None, "Formato de arquivos inválido"
+    
+    return files, None
 
-@app.route('/scan', methods=['POST'])
-def scan_url():
-    try:
-        data = request.get_json()
-        url = data.get('url', '').strip()
-        file_type = data.get('file_type', 'zip')
-        include_src = data.get('include_src', False)
-        
-        if not url:
-            return jsonify({
-                "success": False,
-                "error": "URL é obrigatória"
-            }), 400
-        
-        if not is_valid_url(url):
-            return jsonify({
-                "success": False,
-                "error": "URL inválida"
-            }), 400
-        
-        print(f"Iniciando escaneamento de: {url}")
-        print(f"Tipo de arquivo: {file_type}")
-        print(f"Incluir elementos src: {include_src}")
-        
-        # Verificar se é URL interna (apenas aviso, não bloqueia)
-        is_internal = '172.17.' in url or '192.168.' in url or '10.' in url
-        if is_internal:
-            print(f"AVISO: URL interna detectada: {url}")
-            print("Nota: URLs internas podem não ser acessíveis em produção (Vercel/AWS)")
-        
-        # Verificar se contém credenciais (apenas aviso)
-        if has_credentials(url):
-            print(f"AVISO: URL contém credenciais (usuário/senha)")
-            print("Nota: Tenha cuidado com URLs que contêm senhas em logs")
+def parse_archive_options(data):
+    """Opções de montagem do ZIP (ordem e compressão); retorna (opções, erro)"""
+    order = data.get('order', 'request')
+    if order not in DOWNLOAD_ORDERS:
+        return None, f"Ordem inválida: {order} (use 'request' ou 'completion')"
+    
+    compression = data.get('compression', 'auto')
+    compression_level = data.get('compression_level', ZIP_COMPRESSION_LEVEL)
+    # bool é subclasse de int e 2.0 == 2: só inteiros de verdade são aceitos
+    valid_level = type(compression_level) is int and 0 <= compression_level <= 9
+    if compression not in COMPRESSION_MODES or not valid_level:
+        return None, "Compressão inválida (use 'auto', 'store' ou 'deflate' e nível de 0 a 9)"
+    
+    return {'order': order, 'policy': CompressionPolicy(compression, compression_level)}, None
+
+class ZipArchiveWriter:
+    """Monta o ZIP em streaming a partir dos resultados do ``DownloadPrefetcher``.
+
+    Mantém a contabilidade por arquivo (baixados, falhados e mensagens de
+    erro) e grava as falhas em ``_erros_download.txt`` no fim do arquivo.
+    Um corpo com o mesmo SHA-256 de uma entrada já gravada não é gravado de
+    novo; ``_duplicados.txt`` diz a que entrada corresponde cada nome omitido.
+    """
+    
+    def __init__(self, policy):
+        self.policy = policy
+        self.downloaded_count = 0
+        self.failed_count = 0
+        self.deduplicated_count = 0
+        self.error_messages = []
+        self.duplicate_messages = []
+        self.total_bytes = 0
+        self._written = {}
+    
+    def record_failure(self, result):
+        error_msg = f"Erro ao baixar {result.entry['filename']}: {str(result.error)}"
+        logger.warning("%s", error_msg)
+        self.error_messages.append(error_msg)
+        self.failed_count += 1
+    
+    def emit(self, buffer):
+        data = buffer.drain()
+        self.total_bytes += len(data)
+        return data
+    
+    def record_duplicates(self, result, original):
+        """Nomes omitidos do ZIP por apontarem para o conteúdo da entrada ``original``"""
+        filename = result.entry['filename']
+        if filename != original:
+            self.duplicate_messages.append(f"{filename}: mesmo conteúdo de {original}")
+        for alias in result.entry.get('aliases', ()):
+            self.duplicate_messages.append(f"{alias}: mesmo arquivo que {original}")
+    
+    def write_entry(self, zipf, buffer, result):
+        """Grava um resultado no ZIP, gerando os bytes prontos para envio"""
+        if result.error is not None:
+            self.record_failure(result)
+            return
         
-        # Escanear o diretório
-        files = scan_directory_recursive(url, file_type, include_src=include_src)
+        filename = result.entry['filename']
+        original = self._written.get(result.digest) if result.size else None
+        if original is not None:
+            result.close()
+            logger.info("Conteúdo repetido fora do ZIP: %s (igual a %s)", filename, original)
+            DEDUPLICATED.inc(kind='archive_content')
+            self.deduplicated_count += 1
+            self.record_duplicates(result, original)
+            return
         
-        print(f"Encontrados {len(files)} arquivos")
+        try:
+            compress_type, reason = self.policy.choose(
+                filename, result.content_type, result.sample(COMPRESSION_SAMPLE_SIZE)
+            )
+            zinfo = self.policy.zip_info(filename, compress_type)
+            cpu_start = time.thread_time()
+            write_seconds = 0.0
+            with zipf.open(zinfo, 'w', force_zip64=True) as dest:
+                for chunk in result.chunks(ZIP_STREAM_CHUNK_SIZE):
+                    # Tempo de escrita sem contar a espera pelo cliente nos yields
+                    write_start = time.perf_counter()
+                    dest.write(chunk)
+                    data = self.emit(buffer)
+                    write_seconds += time.perf_counter() - write_start
+                    if data:
+                        yield data
+            compression_stats.record(compress_type, result.size, time.thread_time() - cpu_start)
+            STAGE_SECONDS.observe(write_seconds, stage='zip_write')
+        finally:
+            result.close()
         
-        return jsonify({
-            "success": True,
-            "files_found": len(files),
-            "files": files,
-            "message": f"Encontrados {len(files)} arquivos do tipo {file_type}"
-        })
+        logger.debug("Arquivo adicionado: %s (%s, %s)", filename, COMPRESSION_NAMES[compress_type], reason)
+        self.downloaded_count += 1
+        if result.digest is not None:
+            self._written.setdefault(result.digest, filename)
+        self.record_duplicates(result, filename)
+    
+    def write_reports(self, zipf):
+        # Falhas ocorridas depois do início do stream vão num relatório dentro do ZIP
+        if self.error_messages:
+            zipf.writestr(DOWNLOAD_ERRORS_ENTRY, '\n'.join(self.error_messages) + '\n')
+        if self.duplicate_messages:
+            zipf.writestr(DOWNLOAD_DUPLICATES_ENTRY, '\n'.join(self.duplicate_messages) + '\n')
+    
+    def stream(self, results):
+        buffer = ZipStreamBuffer()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for result in results:
+                yield from self.write_entry(zipf, buffer, result)
+            self.write_reports(zipf)
         
-    except Exception as e:
-        print(f"Erro no escaneamento: {str(e)}")
-        return jsonify({
-            "success": False,
-            "error": f"Erro interno: {str(e)}"
-        }), 500
+        yield self.emit(buffer)
 
-@app.route('/download', methods=['POST'])
-def download_files():
-    return jsonify({
-        "success": True,
-        "downloaded": 0,
-        "failed": 0,
-        "files": [],
-        "errors": []
-    })
+class RangeMismatch(Exception):
+    """O servidor ignorou o ``Range`` ou o arquivo mudou entre as faixas (não adianta repetir)"""
 
-@app.route('/download-stream', methods=['OPTIONS'])
-def download_stream_options():
-    """Handle preflight requests for CORS"""
-    return '', 200
+class RangedDownload:
+    """Download de um arquivo grande em faixas de bytes paralelas.
+
+    As faixas (``Range: bytes=início-fim``) são buscadas por até
+    ``connections`` conexões ao mesmo tempo e entregues em ordem; no máximo
+    ``connections + 1`` faixas ficam em memória. Uma faixa que falha é
+    repetida até ``retries`` vezes, e ``If-Range`` garante que todas venham
+    da mesma versão do arquivo. A parte independente do cliente HTTP é
+    compartilhada com o modo ASGI.
+    """
+    
+    def __init__(self, url, size, headers, auth=None, connections=None, part_size=None, retries=None):
+        self.url = url
+        self.size = size
+        self.auth = auth
+        self.connections = connections or DOWNLOAD_RANGE_CONNECTIONS
+        self.part_size = part_size or DOWNLOAD_RANGE_PART_SIZE
+        self.retries = DOWNLOAD_RANGE_RETRIES if retries is None else retries
+        # If-Range só aceita ETag forte; senão, a data de modificação
+        etag = headers.get('etag')
+        self.validator = etag if etag and not etag.startswith('W/') else headers.get('last-modified')
+        self.retried = 0
+    
+    @staticmethod
+    def supported(headers):
+        """O upstream anunciou ``Accept-Ranges: bytes`` para o corpo sem codificação"""
+        return ('bytes' in headers.get('accept-ranges', '').lower()
+                and headers.get('content-encoding', 'identity').lower() == 'identity')
+    
+    def parts(self):
+        return [(start, min(start + self.part_size, self.size) - 1) for start in range(0, self.size, self.part_size)]
+    
+    def request_headers(self, start, end):
+        headers = dict(DOWNLOAD_HEADERS, Range=f'bytes={start}-{end}')
+        if self.validator:
+            headers['If-Range'] = self.validator
+        return headers
+    
+    def check_part(self, status, headers, start, end, body):
+        """Valida a resposta de uma faixa; ``ValueError`` para falhas que valem nova tentativa"""
+        if status == 200:
+            raise RangeMismatch("Servidor ignorou o Range ou o arquivo mudou durante o download")
+        content_range = headers.get('content-range', '')
+        if status != 206 or not content_range.startswith(f'bytes {start}-{end}/'):
+            raise RangeMismatch(f"Resposta inesperada para a faixa {start}-{end}: {status} {content_range}")
+        if len(body) != end - start + 1:
+            raise ValueError(f"Faixa {start}-{end} incompleta: {len(body)} bytes")
+        BYTES_IN.inc(len(body), kind='download')
+    
+    def retry_delay(self, start, end, attempt, error):
+        """Espera antes de repetir uma faixa; None quando as tentativas acabaram"""
+        if attempt >= self.retries:
+            return None
+        self.retried += 1
+        logger.warning("Faixa %d-%d falhou (%s); nova tentativa %d de %d",
+                       start, end, error, attempt + 1, self.retries)
+        return HTTP_BACKOFF * 2 ** attempt
+    
+    def fetch(self, start, end):
+        session = http_pool.session_for(self.url)
+        attempt = 0
+        while True:
+            try:
+                with IN_FLIGHT.track(kind='download_range'):
+                    response = session.get(self.url, headers=self.request_headers(start, end), auth=self.auth,
+                                           timeout=DOWNLOAD_RANGE_TIMEOUT, allow_redirects=True)
+                self.check_part(response.status_code, response.headers, start, end, response.content)
+                return response.content
+            except (requests.RequestException, ValueError) as e:
+                delay = self.retry_delay(start, end, attempt, e)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+    
+    def chunks(self):
+        """Corpo inteiro, faixa a faixa e em ordem"""
+        parts = iter(self.parts())
+        window = deque()
+        pool = ThreadPoolExecutor(max_workers=self.connections)
+        try:
+            for start, end in itertools.islice(parts, self.connections + 1):
+                window.append(pool.submit(self.fetch, start, end))
+            while window:
+                data = window.popleft().result()
+                following = next(parts, None)
+                if following is not None:
+                    window.append(pool.submit(self.fetch, *following))
+                yield data
+        finally:
+            # Cliente desistiu ou uma faixa falhou de vez: não esperar as demais
+            pool.shutdown(wait=False, cancel_futures=True)
+
+def upstream_auth(original_url, final_url):
+    """Credenciais da URL original, se o download terminou no mesmo host (após redirecionamentos)"""
+    original = urlparse(original_url)
+    if not (original.username and original.password) or urlparse(final_url).hostname != original.hostname:
+        return None
+    return (original.username, original.password)
+
+def single_download_headers(filename, content_type, size=None):
+    """Headers da resposta de um download único (sem ZIP)"""
+    headers = {
+        'Content-Disposition': f'attachment; filename={filename}',
+        'Content-Type': content_type,
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Expose-Headers': 'Content-Disposition, Content-Length, Content-Type'
+    }
+    if size is not None:
+        headers['Content-Length'] = str(size)
+    return headers
+
+def declared_length(headers):
+    """``Content-Length`` do upstream, ou None (chunked ou inválido)"""
+    length = headers.get('content-length', '')
+    return int(length) if length.isdigit() else None
+
+def stream_large_download(response, file_url, filename, start_time):
+    """Resposta de um download único grande ou de tamanho desconhecido: em
+    faixas paralelas quando o upstream aceita ``Range``, senão repassando o
+    corpo em streaming"""
+    size = declared_length(response.headers)
+    content_type = response.headers.get('content-type', 'application/octet-stream')
+    
+    if size is not None and RangedDownload.supported(response.headers):
+        # O corpo desta resposta não é usado: as faixas trazem tudo
+        response.close()
+        download = RangedDownload(response.url, size, response.headers, upstream_auth(file_url, response.url))
+        body = download.chunks()
+        mode = f"{len(download.parts())} faixas"
+    else:
+        download = None
+        body = response.iter_content(ZIP_STREAM_CHUNK_SIZE)
+        mode = "streaming"
+    logger.info("Arquivo grande (%s bytes): download em %s", size if size is not None else '?', mode)
+    # Corpo comprimido pelo upstream chega descomprimido: tamanho final desconhecido
+    length = size if response.headers.get('content-encoding', 'identity').lower() == 'identity' else None
+    
+    def generate():
+        sent = 0
+        try:
+            with IN_FLIGHT.track(kind='download'):
+                for chunk in body:
+                    if download is None:
+                        BYTES_IN.inc(len(chunk), kind='download')
+                    sent += len(chunk)
+                    yield chunk
+            STAGE_SECONDS.observe(time.time() - start_time, stage='file_download')
+            logger.info("Arquivo grande enviado em %.2fs: %d bytes%s", time.time() - start_time, sent,
+                        f", {download.retried} faixas repetidas" if download and download.retried else "")
+        except Exception as e:
+            # Headers já enviados: só resta encerrar a conexão antes do Content-Length
+            logger.error("Download grande interrompido após %d de %s bytes: %s", sent,
+                         size if size is not None else '?', e)
+            raise
+        finally:
+            BYTES_OUT.inc(sent, endpoint='download_stream')
+            response.close()
+    
+    return Response(generate(), mimetype=content_type, direct_passthrough=True,
+                    headers=single_download_headers(filename, content_type, length))
+
+def resolve_single_download(file_info):
+    """URL final e nome do arquivo de um download único (sem ZIP)"""
+    file_url = None
+    filename = None
+    
+    # Processar file_info
+    if isinstance(file_info, str):
+        if file_info.startswith('http://') or file_info.startswith('https://'):
+            file_url = file_info
+            parsed = urlparse(file_url)
+            filename = os.path.basename(parsed.path)
+            if filename == 'view':
+                path_parts = parsed.path.rstrip('/view').split('/')
+                filename = path_parts[-1] if path_parts else 'arquivo'
+    elif isinstance(file_info, dict):
+        file_url = file_info.get('url')
+        filename = file_info.get('filename')
+        if not filename:
+            parsed = urlparse(file_url)
+            filename = os.path.basename(parsed.path)
+            if filename == 'view':
+                path_parts = parsed.path.rstrip('/view').split('/')
+                filename = path_parts[-1] if path_parts else 'arquivo'
+    
+    if not file_url:
+        raise ValueError(f"Arquivo inválido: {file_info}")
+    
+    # Converter URL /view para /@@download/file
+    original_url = file_url
+    if file_url.endswith('/view'):
+        file_url = file_url.replace('/view', '/@@download/file')
+        logger.debug("URL convertida de %s para %s", original_url, file_url)
+    elif not file_url.endswith('/@@download/file'):
+        # Se não termina com /view nem /@@download/file, adicionar /@@download/file
+        if '/view' in file_url:
+            file_url = file_url.replace('/view', '/@@download/file')
+        else:
+            # Adicionar /@@download/file se parece ser do gov.br/Plone
+            if 'gov.br' in file_url and not file_url.endswith(('.pdf', '.zip', '.7z')):
+                file_url = f"{file_url}/@@download/file"
+        logger.debug("URL ajustada para: %s", file_url)
+    
+    return file_url, filename
 
 @app.route('/download-stream', methods=['POST'])
 def download_stream():
     """Faz download de múltiplos arquivos e retorna como stream"""
     try:
-        from flask import Response, stream_with_context
-        import io
-        import zipfile
-        
         data = request.get_json()
-        
-        if not data:
-            print("Erro: Nenhum dado JSON recebido")
-            return jsonify({
-                "success": False,
-                "error": "Nenhum dado recebido"
-            }), 400
-        
-        # Aceitar tanto 'files' quanto 'selected_files' do frontend
-        files = data.get('files', data.get('selected_files', []))
-        
-        # Se files é uma string JSON, fazer parse
-        if isinstance(files, str):
-            import json
-            try:
-                files = json.loads(files)
-                print(f"Files era string JSON, convertido para lista")
-            except json.JSONDecodeError as e:
-                print(f"Erro ao fazer parse de files como JSON: {e}")
-                return jsonify({
-                    "success": False,
-                    "error": "Formato de arquivos inválido (JSON mal formado)"
-                }), 400
-        
-        if not files:
-            print(f"Erro: Nenhum arquivo recebido. Dados completos: {data}")
+        files, error = parse_download_request(data)
+        if error:
             return jsonify({
                 "success": False,
-                "error": "Nenhum arquivo para download"
+                "error": error
             }), 400
         
-        # Validar estrutura dos arquivos
-        if not isinstance(files, list):
-            print(f"Erro: 'files' não é uma lista. Tipo: {type(files)}")
-            return jsonify({
-                "success": False,
-                "error": "Formato de arquivos inválido"
-            }), 400
-        
-        print(f"Iniciando download de {len(files)} arquivos")
-        print(f"Arquivos recebidos: {files}")
+        logger.info("Iniciando download de %d arquivos", len(files))
+        logger.debug("Arquivos recebidos: %s", files)
         
         # Se é apenas 1 arquivo, baixar direto (sem ZIP)
         if len(files) == 1:
-            file_info = files[0]
+            file_url, filename = resolve_single_download(files[0])
             
-            # Processar file_info
-            if isinstance(file_info, str):
-                if file_info.startswith('http://') or file_info.startswith('https://'):
-                    file_url = file_info
-                    parsed = urlparse(file_url)
-                    filename = os.path.basename(parsed.path)
-                    if filename == 'view':
-                        path_parts = parsed.path.rstrip('/view').split('/')
-                        filename = path_parts[-1] if path_parts else 'arquivo'
-            elif isinstance(file_info, dict):
-                file_url = file_info.get('url')
-                filename = file_info.get('filename')
-                if not filename:
-                    parsed = urlparse(file_url)
-                    filename = os.path.basename(parsed.path)
-                    if filename == 'view':
-                        path_parts = parsed.path.rstrip('/view').split('/')
-                        filename = path_parts[-1] if path_parts else 'arquivo'
-            
-            # Converter URL /view para /@@download/file
-            original_url = file_url
-            if file_url.endswith('/view'):
-                file_url = file_url.replace('/view', '/@@download/file')
-                print(f"✓ URL convertida de: {original_url}")
-                print(f"✓ URL convertida para: {file_url}")
-            elif not file_url.endswith('/@@download/file'):
-                # Se não termina com /view nem /@@download/file, adicionar /@@download/file
-                if '/view' in file_url:
-                    file_url = file_url.replace('/view', '/@@download/file')
-                else:
-                    # Adicionar /@@download/file se parece ser do gov.br/Plone
-                    if 'gov.br' in file_url and not file_url.endswith(('.pdf', '.zip', '.7z')):
-                        file_url = f"{file_url}/@@download/file"
-                print(f"✓ URL ajustada para: {file_url}")
-            
-            print(f"📥 Iniciando download: {filename}")
-            print(f"🔗 URL final: {file_url}")
+            logger.info("Iniciando download: %s", filename, extra={'url': strip_credentials(file_url)})
             
             # Preparar autenticação
             auth = None
@@ -351,172 +3428,423 @@ def download_stream():
                 auth = (parsed_url.username, parsed_url.password)
             
             # Baixar arquivo com timeout mais curto para arquivos pequenos
-            import time
             start_time = time.time()
             
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-            response = requests.get(file_url, timeout=15, auth=auth, headers=headers, allow_redirects=True, stream=False)
-            response.raise_for_status()
+            cached = download_cache.lookup(file_url)
+            request_headers = dict(DOWNLOAD_HEADERS, **(cached.conditional_headers() if cached else {}))
+            # Só os headers por enquanto: o tamanho decide entre o caminho simples e o de arquivos grandes
+            response = http_pool.session_for(file_url).get(file_url, timeout=15, auth=auth, headers=request_headers, allow_redirects=True, stream=True)
+            
+            if cached is not None and response.status_code == 304:
+                # Corpo em cache ainda válido: servidor WSGI pode usar sendfile
+                response.close()
+                download_cache.record_hit(cached)
+                BYTES_OUT.inc(cached.size, endpoint='download_stream')
+                content_type = cached.content_type or 'application/octet-stream'
+                logger.info("Arquivo servido do cache em %.2fs: %d bytes", time.time() - start_time, cached.size)
+                return Response(
+                    wrap_file(request.environ, cached.open(), ZIP_STREAM_CHUNK_SIZE),
+                    mimetype=content_type,
+                    direct_passthrough=True,
+                    headers=single_download_headers(filename, content_type, cached.size)
+                )
+            try:
+                response.raise_for_status()
+            except Exception:
+                response.close()
+                raise
+            
+            # Sem Content-Length (chunked) o tamanho só se sabe no fim: não carregar na memória
+            size = declared_length(response.headers)
+            if size is None or size >= DOWNLOAD_LARGE_THRESHOLD:
+                return stream_large_download(response, file_url, filename, start_time)
+            
+            content = response.content
+            if download_cache.cacheable(response.headers):
+                download_cache.store(file_url, response.headers, io.BytesIO(content),
+                                     hashlib.sha256(content).hexdigest(), len(content))
             
             download_time = time.time() - start_time
+            STAGE_SECONDS.observe(download_time, stage='file_download')
+            BYTES_IN.inc(len(content), kind='download')
+            BYTES_OUT.inc(len(content), endpoint='download_stream')
             
             # Detectar tipo de conteúdo
             content_type = response.headers.get('content-type', 'application/octet-stream')
             
-            print(f"✓ Arquivo baixado em {download_time:.2f}s: {len(response.content)} bytes, tipo: {content_type}")
+            logger.info("Arquivo baixado em %.2fs: %d bytes, tipo: %s", download_time, len(content), content_type)
             
             # Retornar arquivo direto (sem ZIP)
-            from flask import Response
             return Response(
-                response.content,
+                content,
                 mimetype=content_type,
-                headers={
-                    'Content-Disposition': f'attachment; filename={filename}',
-                    'Content-Type': content_type,
-                    'Content-Length': str(len(response.content)),
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                    'Access-Control-Allow-Headers': 'Content-Type',
-                    'Access-Control-Expose-Headers': 'Content-Disposition, Content-Length, Content-Type'
-                }
+                headers=single_download_headers(filename, content_type, len(content))
             )
         
-        # Múltiplos arquivos: criar ZIP
-        memory_file = io.BytesIO()
-        downloaded_count = 0
-        failed_count = 0
-        error_messages = []
-        
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for idx, file_info in enumerate(files):
-                # Se file_info é string (URL direta)
-                if isinstance(file_info, str):
-                    # Verificar se é uma URL ou JSON string
-                    if file_info.startswith('http://') or file_info.startswith('https://'):
-                        # É uma URL direta
-                        file_url = file_info
-                        # Extrair filename da URL
-                        parsed = urlparse(file_url)
-                        filename = os.path.basename(parsed.path)
-                        # Remover /view se existir
-                        if filename == 'view':
-                            path_parts = parsed.path.rstrip('/view').split('/')
-                            filename = path_parts[-1] if path_parts else f'file_{idx}'
-                        print(f"URL direta convertida: {filename} <- {file_url}")
-                    else:
-                        # Tentar fazer parse como JSON
-                        import json
-                        try:
-                            file_info = json.loads(file_info)
-                        except json.JSONDecodeError:
-                            print(f"Erro: file_info não é URL nem JSON válido: {file_info}")
-                            continue
-                
-                # Se file_info agora é dict, extrair url e filename
-                if isinstance(file_info, dict):
-                    file_url = file_info.get('url')
-                    filename = file_info.get('filename')
-                    
-                    if not file_url:
-                        print(f"Arquivo sem url: {file_info}")
-                        continue
-                    
-                    if not filename:
-                        # Tentar extrair filename da URL
-                        parsed = urlparse(file_url)
-                        filename = os.path.basename(parsed.path)
-                        if filename == 'view':
-                            path_parts = parsed.path.rstrip('/view').split('/')
-                            filename = path_parts[-1] if path_parts else f'file_{idx}'
-                        print(f"Filename extraído da URL: {filename}")
-                
-                # Validação final
-                if not file_url or not filename:
-                    print(f"Arquivo inválido após processamento: url={file_url}, filename={filename}")
-                    continue
-                
-                try:
-                    # Converter URLs do tipo /view para /@@download/file (Plone/gov.br)
-                    if file_url.endswith('/view'):
-                        file_url = file_url.replace('/view', '/@@download/file')
-                        print(f"URL convertida: {file_url}")
-                    
-                    print(f"Baixando: {filename} de {file_url}")
-                    
-                    # Preparar autenticação se necessário
-                    auth = None
-                    parsed_url = urlparse(file_url)
-                    if parsed_url.username and parsed_url.password:
-                        auth = (parsed_url.username, parsed_url.password)
-                    
-                    # Baixar arquivo com headers que simulam browser
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                    }
-                    response = requests.get(file_url, timeout=15, auth=auth, headers=headers, allow_redirects=True, stream=False)
-                    response.raise_for_status()
-                    
-                    # Adicionar ao ZIP
-                    zipf.writestr(filename, response.content)
-                    print(f"✓ Arquivo adicionado: {filename}")
-                    downloaded_count += 1
-                    
-                except Exception as e:
-                    error_msg = f"Erro ao baixar {filename}: {str(e)}"
-                    print(f"✗ {error_msg}")
-                    error_messages.append(error_msg)
-                    failed_count += 1
-                    # Continuar com próximo arquivo
-                    continue
+        # Múltiplos arquivos: ZIP gerado em streaming
+        entries = prepare_download_entries(files)
+        options, error = parse_archive_options(data)
+        if error:
+            return jsonify({
+                "success": False,
+                "error": error
+            }), 400
+        
+        # Downloads em paralelo; o ZIP consome as entradas já concluídas
+        prefetched = DownloadPrefetcher(entries).results(options['order'])
+        writer = ZipArchiveWriter(options['policy'])
         
-        # Verificar se algum arquivo foi baixado com sucesso
-        print(f"Resumo: {downloaded_count} baixados, {failed_count} falharam")
+        # Esperar o primeiro arquivo baixado antes de responder: se nenhum
+        # estiver acessível ainda é possível devolver o erro 400 com os detalhes
+        first_result = None
+        for result in prefetched:
+            if result.error is None:
+                first_result = result
+                break
+            writer.record_failure(result)
         
-        if downloaded_count == 0:
+        if first_result is None:
+            logger.info("Resumo: %d baixados, %d falharam", writer.downloaded_count, writer.failed_count)
             return jsonify({
                 "success": False,
                 "error": "Nenhum arquivo foi baixado com sucesso",
                 "details": {
                     "total": len(files),
-                    "downloaded": downloaded_count,
-                    "failed": failed_count,
-                    "errors": error_messages
+                    "downloaded": writer.downloaded_count,
+                    "failed": writer.failed_count,
+                    "errors": writer.error_messages
                 }
             }), 400
         
-        # Voltar para o início do arquivo
-        memory_file.seek(0)
-        
-        print(f"✓ ZIP criado com sucesso! Tamanho: {memory_file.getbuffer().nbytes} bytes")
-        
-        # Retornar ZIP como stream
-        zip_data = memory_file.getvalue()
+        def generate():
+            try:
+                for data in writer.stream(itertools.chain([first_result], prefetched)):
+                    BYTES_OUT.inc(len(data), endpoint='download_stream')
+                    yield data
+            finally:
+                prefetched.close()
+            
+            logger.info("Resumo: %d baixados, %d falharam", writer.downloaded_count, writer.failed_count)
+            logger.debug("Compressão: CPU economizada estimada (acumulada) %.3fs", compression_stats.estimated_cpu_saved())
+            logger.info("ZIP enviado com sucesso. Tamanho: %d bytes", writer.total_bytes)
         
         return Response(
-            zip_data,
+            stream_with_context(generate()),
             mimetype='application/zip',
             headers={
                 'Content-Disposition': 'attachment; filename=arquivos.zip',
                 'Content-Type': 'application/zip',
-                'Content-Length': str(len(zip_data)),
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Expose-Headers': 'Content-Disposition, Content-Length'
+                'Access-Control-Expose-Headers': 'Content-Disposition, Content-Type'
             }
         )
         
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
-        print(f"Erro no download stream: {str(e)}")
-        print(f"Traceback completo:\n{error_details}")
+        logger.error("Erro no download stream: %s\n%s", e, error_details)
         return jsonify({
             "success": False,
             "error": f"Erro ao fazer download: {str(e)}",
             "details": error_details if app.debug else None
         }), 500
 
+class DownloadJob:
+    """Job de download em segundo plano.
+
+    O resultado (ZIP, ou o próprio arquivo quando há só um) é gravado num
+    arquivo temporário "spooled": fica em memória até ``JOB_SPOOL_MAX_MB`` e
+    depois vai para disco. Leituras concorrentes usam ``read_at`` sob lock.
+    """
+    
+    def __init__(self, entries, options):
+        self.id = uuid.uuid4().hex
+        self.entries = entries
+        self.options = options
+        self.status = 'queued'
+        self.error = None
+        self.writer = ZipArchiveWriter(options['policy'])
+        self.filename = 'arquivos.zip'
+        self.mimetype = 'application/zip'
+        self.size = 0
+        self.created_at = time.time()
+        self.finished_at = None
+        self._file = tempfile.SpooledTemporaryFile(max_size=JOB_SPOOL_MAX_BYTES)
+        self._lock = threading.Lock()
+    
+    def _write(self, data):
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self.size += len(data)
+    
+    def read_at(self, offset, size):
+        with self._lock:
+            if self._file is None:
+                return b''
+            self._file.seek(offset)
+            return self._file.read(size)
+    
+    def run(self):
+        self.status = 'running'
+        IN_FLIGHT.inc(kind='job')
+        logger.info("Job %s: iniciando download de %d arquivos", self.id, len(self.entries))
+        prefetched = DownloadPrefetcher(self.entries).results(self.options['order'])
+        try:
+            if len(self.entries) == 1:
+                # Um arquivo só: resultado é o próprio arquivo, como no /download-stream
+                result = next(prefetched)
+                if result.error is not None:
+                    self.writer.record_failure(result)
+                else:
+                    self.filename = result.entry['filename']
+                    self.mimetype = result.content_type or 'application/octet-stream'
+                    try:
+                        for chunk in result.chunks(JOB_READ_CHUNK_SIZE):
+                            self._write(chunk)
+                    finally:
+                        result.close()
+                    self.writer.downloaded_count += 1
+            else:
+                for data in self.writer.stream(prefetched):
+                    self._write(data)
+            
+            self.status = 'completed' if self.writer.downloaded_count else 'failed'
+            if self.status == 'failed':
+                self.error = "Nenhum arquivo foi baixado com sucesso"
+        except Exception as e:
+            logger.exception("Job %s: erro: %s", self.id, e)
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            prefetched.close()
+            IN_FLIGHT.dec(kind='job')
+            self.finished_at = time.time()
+        
+        logger.info("Job %s: %s (%d baixados, %d falharam, %d bytes)", self.id, self.status,
+                    self.writer.downloaded_count, self.writer.failed_count, self.size)
+    
+    def discard(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+    
+    def expired(self, now):
+        return self.finished_at is not None and now - self.finished_at > JOB_TTL_SECONDS
+    
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": len(self.entries),
+            "downloaded": self.writer.downloaded_count,
+            "failed": self.writer.failed_count,
+            "deduplicated": self.writer.deduplicated_count,
+            "errors": self.writer.error_messages,
+            "bytes_written": self.size,
+            "filename": self.filename,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "download_url": f"/jobs/{self.id}/download" if self.status == 'completed' else None
+        }
+
+class JobFileReader:
+    """Leitor do resultado de um job com posição própria (seekable para Range)"""
+    
+    def __init__(self, job):
+        self.job = job
+        self.position = 0
+    
+    def seekable(self):
+        return True
+    
+    def seek(self, position):
+        self.position = position
+    
+    def tell(self):
+        return self.position
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        data = self.job.read_at(self.position, JOB_READ_CHUNK_SIZE)
+        if not data:
+            raise StopIteration
+        self.position += len(data)
+        BYTES_OUT.inc(len(data), endpoint='job_download')
+        return data
+
+class DownloadJobManager:
+    """Registro em memória dos jobs do processo, com pool de execução limitado"""
+    
+    def __init__(self, max_workers=JOB_MAX_WORKERS):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download-job')
+    
+    def _purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.expired(now)]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            job.discard()
+    
+    def submit(self, entries, options):
+        self._purge_expired()
+        job = DownloadJob(entries, options)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._pool.submit(job.run)
+        return job
+    
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def status_counts(self):
+        with self._lock:
+            return Counter(job.status for job in self._jobs.values())
+
+download_jobs = DownloadJobManager()
+
+@app.route('/download', methods=['OPTIONS'])
+def download_options():
+    """Handle preflight requests for CORS"""
+    return '', 200
+
+@app.route('/download', methods=['POST'])
+def download_files():
+    """Cria um job de download em segundo plano e devolve o ID imediatamente"""
+    data = request.get_json(silent=True)
+    files, error = parse_download_request(data)
+    if error:
+        return jsonify({
+            "success": False,
+            "error": error
+        }), 400
+    
+    options, error = parse_archive_options(data)
+    if error:
+        return jsonify({
+            "success": False,
+            "error": error
+        }), 400
+    
+    entries = prepare_download_entries(files)
+    if not entries:
+        return jsonify({
+            "success": False,
+            "error": "Nenhum arquivo válido para download"
+        }), 400
+    
+    job = download_jobs.submit(entries, options)
+    return jsonify({
+        "success": True,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "download_url": f"/jobs/{job.id}/download"
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Progresso de um job de download"""
+    job = download_jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            "success": False,
+            "error": "Job não encontrado"
+        }), 404
+    return jsonify(dict(job.to_dict(), success=True))
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def job_download(job_id):
+    """Entrega o resultado do job; com Range, downloads interrompidos são retomados"""
+    job = download_jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            "success": False,
+            "error": "Job não encontrado"
+        }), 404
+    
+    if job.status != 'completed':
+        return jsonify(dict(job.to_dict(), success=False, error=job.error or "Job ainda não concluído")), 409
+    
+    response = Response(
+        JobFileReader(job),
+        mimetype=job.mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename={job.filename}',
+            'Content-Length': str(job.size),
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'Content-Disposition, Content-Length, Content-Range, Accept-Ranges, ETag'
+        }
+    )
+    response.set_etag(job.id)
+    response.last_modified = job.finished_at
+    return response.make_conditional(request, accept_ranges=True, complete_length=job.size)
+
+def collect_component_stats():
+    """Contadores já mantidos pelos caches, pools e jobs, lidos a cada coleta"""
+    scan = scan_cache.stats()
+    yield ('scan_cache_events_total', 'counter', 'Eventos do cache de listagens', [
+        ({'event': event}, scan.get(event, 0)) for event in ('memory_hits', 'disk_hits', 'misses', 'stores', 'evictions')
+    ])
+    downloads = download_cache.stats()
+    yield ('download_cache_events_total', 'counter', 'Eventos do cache de downloads', [
+        ({'event': event}, downloads.get(event, 0))
+        for event in ('hits', 'misses', 'dedup_hits', 'stores', 'refreshed', 'evictions')
+    ])
+    yield ('download_cache_bytes', 'gauge', 'Bytes ocupados pelo cache de downloads', [({}, downloads.get('bytes', 0))])
+    yield ('coalesced_calls_total', 'counter', 'Operações executadas e compartilhadas (single-flight)', [
+        ({'kind': kind, 'result': result}, flights.stats().get(result, 0))
+        for kind, flights in (('scan', scan_flights), ('download', download_flights))
+        for result in ('executed', 'shared')
+    ])
+    pools = http_pool.stats()
+    yield ('http_pool_connections_total', 'counter', 'Conexões abertas por host', [
+        ({'host': host}, data['connections']) for host, data in pools.items()
+    ])
+    yield ('http_pool_requests_total', 'counter', 'Requisições feitas por host', [
+        ({'host': host}, data['requests']) for host, data in pools.items()
+    ])
+    compression = compression_stats.snapshot()
+    yield ('zip_entry_bytes_total', 'counter', 'Bytes gravados no ZIP por método', [
+        ({'method': method}, compression[method]['bytes']) for method in COMPRESSION_NAMES.values()
+    ])
+    yield ('download_jobs', 'gauge', 'Jobs de download registrados por status', [
+        ({'status': status}, count) for status, count in download_jobs.status_counts().items()
+    ])
+
+metrics.add_collector(collect_component_stats)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Métricas no formato de exposição de texto do Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def warm_up():
+    """Adianta o que a primeira requisição pagaria: conexões SQLite dos caches e
+    do índice e o contexto TLS das sessões HTTP. Idempotente; roda na importação
+    com WARM_START=1 e no startup (lifespan) do modo ASGI."""
+    start = time.perf_counter()
+    for store in (scan_cache, site_index, download_cache):
+        store.open()
+    try:
+        http_pool.warm_up()
+    except (OSError, ssl.SSLError) as e:
+        logger.warning("Pré-aquecimento do contexto TLS falhou: %s", e)
+    logger.info("Pré-aquecimento concluído em %.1f ms", (time.perf_counter() - start) * 1000)
+
+if WARM_START:
+    warm_up()
+
 # Para o Elastic Beanstalk
 application = app
 
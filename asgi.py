@@ -0,0 +1,878 @@
+"""Modo de execução ASGI (assíncrono) da AutoHunter API.
+
+As rotas de I/O intenso (``/scan``, ``/scan-stream`` e ``/download-stream``)
+rodam sobre asyncio com um único ``httpx.AsyncClient``: cada listagem,
+sondagem HEAD ou download em andamento é uma corrotina, não uma thread, e
+o número de requisições simultâneas ao upstream fica limitado só pelos
+limites por host e pelo pool de conexões (``ASGI_MAX_CONNECTIONS``).
+
+O parse das listagens, a ordem do crawler, o cache, o orçamento de memória
+e a montagem do ZIP são os mesmos do modo WSGI (``application.py``); os
+contratos JSON e de streaming não mudam. As demais rotas (``/download``,
+``/jobs``, ``/stats``, ``/metrics``, preflight ``OPTIONS``...) são
+atendidas pela aplicação Flask através do ``WsgiToAsgi`` do asgiref.
+
+Uso:
+    pip install -r requirements-async.txt
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import os
+import time
+import traceback
+import zipfile
+from collections import Counter, deque
+from urllib.parse import parse_qsl, urlparse
+
+import httpx
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from application import (
+    BYTES_IN,
+    BYTES_OUT,
+    DOWNLOAD_HEADERS,
+    DOWNLOAD_LARGE_THRESHOLD,
+    DOWNLOAD_RANGE_TIMEOUT,
+    HTTP_REQUEST_SECONDS,
+    HTTP_REQUESTS,
+    IN_FLIGHT,
+    LISTING_CHUNK_SIZE,
+    SCAN_DEFAULT_DEPTH,
+    SCAN_LISTING_TIMEOUT,
+    SCAN_PROBE_TIMEOUT,
+    SCAN_STREAM_FORMATS,
+    SIZE_PROBE_MAX_WORKERS,
+    STAGE_SECONDS,
+    UPSTREAM_RESPONSES,
+    UPSTREAM_SECONDS,
+    ZIP_STREAM_CHUNK_SIZE,
+    BodyAccumulator,
+    DirectoryListing,
+    DownloadPrefetcher,
+    ListingBuilder,
+    PrefetchedFile,
+    RangedDownload,
+    ScanBudget,
+    ScanCache,
+    ScanCrawler,
+    ZipArchiveWriter,
+    ZipStreamBuffer,
+    app as flask_app,
+    compression_stats,
+    declared_length,
+    download_cache,
+    format_scan_event,
+    logger,
+    parse_archive_options,
+    parse_download_request,
+    parse_scan_request,
+    prepare_download_entries,
+    record_listing_failure,
+    resolve_single_download,
+    scan_cache,
+    scan_flights,
+    site_index,
+    strip_credentials,
+    upstream_auth,
+    warm_up,
+)
+
+# Conexões simultâneas do cliente httpx (todas as rotas assíncronas juntas)
+ASGI_MAX_CONNECTIONS = int(os.environ.get("ASGI_MAX_CONNECTIONS", 100))
+ASGI_MAX_KEEPALIVE = int(os.environ.get("ASGI_MAX_KEEPALIVE", 20))
+
+# Saída do ZIP acumulada por ida à thread de compressão (menos trocas com o loop)
+ZIP_SEND_BATCH_SIZE = 1024 * 1024
+
+CORS_HEADERS = [(b'access-control-allow-origin', b'*')]
+DOWNLOAD_CORS_HEADERS = CORS_HEADERS + [
+    (b'access-control-allow-methods', b'POST, OPTIONS'),
+    (b'access-control-allow-headers', b'Content-Type'),
+]
+
+
+async def record_upstream_request(request):
+    request.extensions['autohunter_start'] = time.perf_counter()
+
+
+async def record_upstream_response(response):
+    """Equivalente ao hook de resposta da sessão requests do modo WSGI"""
+    host = response.url.host or ''
+    start = response.request.extensions.get('autohunter_start')
+    if start is not None:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start, host=host)
+    UPSTREAM_RESPONSES.inc(host=host, status=response.status_code)
+
+
+def build_client():
+    # Credenciais na URL (usuario:senha@host) viram Basic auth automaticamente
+    return httpx.AsyncClient(
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=ASGI_MAX_CONNECTIONS,
+                            max_keepalive_connections=ASGI_MAX_KEEPALIVE),
+        event_hooks={'request': [record_upstream_request], 'response': [record_upstream_response]}
+    )
+
+
+async def fetch_directory_listing_async(client, url, file_type, include_src=False, cached=None,
+                                        timeout=SCAN_LISTING_TIMEOUT, max_bytes=None):
+    """Versão assíncrona de ``fetch_directory_listing``"""
+    builder = None
+    try:
+        logger.debug("Escaneando: %s", strip_credentials(url))
+
+        # Requisição condicional quando já existe uma versão em cache
+        headers = cached.conditional_headers() if cached else {}
+
+        async with client.stream('GET', url, headers=headers, timeout=timeout) as response:
+            if response.status_code == 304 and cached:
+                logger.debug("Listagem não modificada (304): %s", strip_credentials(url))
+                return cached.copy(not_modified=True)
+            response.raise_for_status()
+
+            builder = ListingBuilder(url, file_type, include_src, response.headers, max_bytes)
+            if builder.wants_body:
+                async for chunk in response.aiter_bytes(LISTING_CHUNK_SIZE):
+                    if not builder.feed(chunk):
+                        break
+        return builder.finish()
+
+    except Exception as e:
+        listing = record_listing_failure(builder.listing if builder is not None else DirectoryListing(), e)
+        logger.warning("Erro ao escanear %s: %s", strip_credentials(url), listing.error)
+        return listing
+
+
+async def probe_file_size_async(client, url, timeout=SCAN_PROBE_TIMEOUT):
+    """Obtém o tamanho de um arquivo via HEAD (0 se não for possível)"""
+    with IN_FLIGHT.track(kind='head_probe'), STAGE_SECONDS.time(stage='head_probe'):
+        try:
+            response = await client.head(url, timeout=timeout, follow_redirects=False)
+            if response.status_code == 200:
+                return int(response.headers.get('content-length', 0))
+        except Exception:
+            pass
+    return 0
+
+
+class AsyncScanCrawler(ScanCrawler):
+    """``ScanCrawler`` sobre asyncio.
+
+    Mesma fronteira BFS, limite por host e formato de eventos; listagens e
+    sondagens são tarefas asyncio em vez de futures de um pool de threads.
+    """
+
+    def __init__(self, client, file_type, **kwargs):
+        super().__init__(file_type, **kwargs)
+        self.client = client
+
+    async def _fetch_async(self, url):
+        timeout = self.governor.timeout(urlparse(url).netloc, SCAN_LISTING_TIMEOUT)
+        with IN_FLIGHT.track(kind='listing_fetch'), STAGE_SECONDS.time(stage='listing_fetch'):
+            start = time.perf_counter()
+            listing = await self._fetch_listing_async(url, timeout)
+            listing.elapsed = time.perf_counter() - start
+            return listing
+
+    async def _fetch_listing_async(self, url, timeout):
+        max_bytes = self.budget.max_listing_bytes
+        if self.cache is None:
+            return await fetch_directory_listing_async(self.client, url, self.file_type, self.include_src,
+                                                       timeout=timeout, max_bytes=max_bytes)
+
+        key = ScanCache.make_key(url, self.file_type, self.include_src)
+        # O cache pode ir ao SQLite: fora do event loop
+        cached = await asyncio.to_thread(self.cache.get, key)
+        listing = await fetch_directory_listing_async(self.client, url, self.file_type, self.include_src,
+                                                      cached=cached, timeout=timeout, max_bytes=max_bytes)
+        if not listing.not_modified and listing.cacheable:
+            self.fetched[url] = (key, listing)
+        return listing
+
+    async def _probe_async(self, url, slots):
+        host = urlparse(url).netloc
+        if self.governor.is_open(host):
+            return 0
+        async with slots:
+            return await probe_file_size_async(self.client, url, self.governor.timeout(host, SCAN_PROBE_TIMEOUT))
+
+    async def events(self, root_url, resolve_sizes=True):
+        """Percorre a árvore emitindo eventos ``directory``, ``file``, ``error`` e ``summary``"""
+        start_time = time.time()
+        counts = Counter()
+        frontier = self._frontier(root_url)
+        # Consulta ao índice (SQLite, com o lock que record() segura na escrita): fora do event loop
+        await asyncio.to_thread(self.load_priorities)
+        self.budget.start()
+        host_inflight = Counter()
+        pending = {}
+        listing_slots = asyncio.Semaphore(self.max_workers)
+        probe_slots = asyncio.Semaphore(SIZE_PROBE_MAX_WORKERS)
+
+        async def fetch(url):
+            async with listing_slots:
+                return await self._fetch_async(url)
+
+        def schedule_probe(item):
+            pending[asyncio.ensure_future(self._probe_async(item['url'], probe_slots))] = ('probe', item)
+
+        IN_FLIGHT.inc(kind='scan')
+        try:
+            for event in self._resume_files(counts, resolve_sizes, schedule_probe):
+                yield event
+            while frontier or pending:
+                skipped = []
+                for url, depth in self._dispatch(frontier, host_inflight, counts, skipped):
+                    pending[asyncio.ensure_future(fetch(url))] = ('listing', (url, depth))
+                for event in skipped:
+                    yield event
+
+                if self.exhausted == 'deadline':
+                    for event in self._interrupt(pending.items(), frontier, counts):
+                        yield event
+                    break
+                if not pending:
+                    if self.exhausted:
+                        break
+                    # Só restam hosts adiados por Retry-After
+                    if frontier:
+                        await asyncio.sleep(self._wait_timeout(frontier))
+                    continue
+
+                done, _ = await asyncio.wait(pending, timeout=self._wait_timeout(frontier),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    kind, payload = pending.pop(task)
+
+                    # Estágio de sondagem: tamanho resolvido, arquivo pronto
+                    if kind == 'probe':
+                        payload['size'] = task.result()
+                        counts['files'] += 1
+                        yield dict(payload, type='file')
+                        continue
+
+                    url, depth = payload
+                    host_inflight[urlparse(url).netloc] -= 1
+                    result = task.result()
+                    if self._retry_later(url, depth, result, frontier):
+                        continue
+                    for event in self._handle_listing(url, depth, result, frontier, counts,
+                                                      resolve_sizes, schedule_probe):
+                        yield event
+        finally:
+            # Cliente pode desistir no meio: cancelar as requisições em andamento
+            for task in pending:
+                task.cancel()
+            IN_FLIGHT.dec(kind='scan')
+
+        await asyncio.to_thread(self.record_index)
+        # _finish grava as listagens novas no cache (SQLite)
+        yield await asyncio.to_thread(self._finish, frontier, counts, start_time, resolve_sizes)
+
+    async def run(self, root_url, resolve_sizes=True):
+        events = self.events(root_url, resolve_sizes)
+        try:
+            async for _ in events:
+                pass
+        finally:
+            await events.aclose()
+        return self._collect()
+
+
+async def open_scan_index(use_index):
+    """``site_index`` de um escaneamento, aberto fora do event loop (importar o
+    sqlite3 e criar as tabelas); None se não pedido ou desativado"""
+    if use_index and await asyncio.to_thread(site_index.open):
+        return site_index
+    return None
+
+
+async def scan_directory_shared_async(client, url, file_type, include_src=False, resolve_sizes=True,
+                                      use_cache=True, max_depth=SCAN_DEFAULT_DEPTH, budget=None, resume=None,
+                                      continuation=None, use_index=True):
+    """Versão assíncrona de ``scan_directory_shared`` (mesmas chaves e contadores)"""
+    budget = budget or ScanBudget()
+    key = (ScanCache.make_key(url, file_type, include_src), bool(resolve_sizes), bool(use_cache),
+           max_depth, budget.key(), continuation, bool(use_index))
+
+    async def scan():
+        crawler = AsyncScanCrawler(client, file_type, max_depth=max_depth, include_src=include_src,
+                                   cache=scan_cache if use_cache else None, budget=budget, resume=resume,
+                                   index=await open_scan_index(use_index))
+        return await crawler.run(url, resolve_sizes), crawler.report()
+
+    (files, report), shared = await scan_flights.do_async(key, scan)
+    if shared:
+        logger.info("Escaneamento compartilhado com uma requisição em andamento")
+    return files, report
+
+
+async def download_upstream_body_async(client, url, budget):
+    """Versão assíncrona de ``download_upstream_body`` (mesmo cache e orçamento)"""
+    cached = await asyncio.to_thread(download_cache.lookup, url)
+    headers = dict(DOWNLOAD_HEADERS, **(cached.conditional_headers() if cached else {}))
+    logger.debug("Baixando: %s", strip_credentials(url))
+
+    async with client.stream('GET', url, headers=headers, timeout=15) as response:
+        if cached is not None and response.status_code == 304:
+            await asyncio.to_thread(download_cache.record_hit, cached)
+            logger.debug("Cache de download válido: %s (%d bytes)", strip_credentials(url), cached.size)
+            return cached
+        response.raise_for_status()
+
+        accumulator = BodyAccumulator(budget, download_cache.cacheable(response.headers))
+        try:
+            async for chunk in response.aiter_bytes(ZIP_STREAM_CHUNK_SIZE):
+                accumulator.write(chunk)
+        except BaseException:
+            accumulator.discard()
+            raise
+    # Gravação no cache copia o corpo em disco: fora do event loop
+    return await asyncio.to_thread(accumulator.finish, url, response.headers)
+
+
+def store_single_download(url, headers, content):
+    download_cache.store(url, headers, io.BytesIO(content), hashlib.sha256(content).hexdigest(), len(content))
+
+
+class AsyncDownloadPrefetcher(DownloadPrefetcher):
+    """``DownloadPrefetcher`` sobre asyncio (mesma janela, limites e orçamento).
+
+    Downloads simultâneos da mesma URL não são coalescidos neste modo (só
+    os escaneamentos do ``/scan`` são).
+    """
+
+    def __init__(self, client, entries, **kwargs):
+        super().__init__(entries, **kwargs)
+        self.client = client
+
+    async def _fetch_async(self, result):
+        try:
+            with IN_FLIGHT.track(kind='download'), STAGE_SECONDS.time(stage='file_download'):
+                body = await download_upstream_body_async(self.client, result.entry['url'], self.budget)
+            result.attach(body)
+        except Exception as e:
+            result.close()
+            result.error = e
+        return result
+
+    async def results(self, order='request'):
+        queue = deque(PrefetchedFile(idx, entry) for idx, entry in enumerate(self.entries))
+        host_inflight = Counter()
+        pending = {}
+        ready = {}
+        next_index = 0
+
+        try:
+            while queue or pending or ready:
+                for host, result in self._next_batch(queue, host_inflight, len(pending), next_index):
+                    pending[asyncio.ensure_future(self._fetch_async(result))] = host
+
+                if pending:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        host_inflight[pending.pop(task)] -= 1
+                        result = task.result()
+                        ready[result.index] = result
+
+                released, next_index = self._pop_ready(ready, next_index, order)
+                for result in released:
+                    yield result
+        finally:
+            for task in pending:
+                task.cancel()
+            for result in ready.values():
+                result.close()
+
+
+class AsyncRangedDownload(RangedDownload):
+    """``RangedDownload`` sobre httpx: mesmas faixas, janela e validação, com tarefas asyncio"""
+
+    def __init__(self, client, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = client
+
+    async def fetch_async(self, start, end, slots):
+        attempt = 0
+        while True:
+            try:
+                async with slots:
+                    with IN_FLIGHT.track(kind='download_range'):
+                        response = await self.client.get(self.url, headers=self.request_headers(start, end),
+                                                         auth=self.auth, timeout=DOWNLOAD_RANGE_TIMEOUT)
+                self.check_part(response.status_code, response.headers, start, end, response.content)
+                return response.content
+            except (httpx.HTTPError, ValueError) as e:
+                delay = self.retry_delay(start, end, attempt, e)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def chunks(self):
+        parts = iter(self.parts())
+        window = deque()
+        slots = asyncio.Semaphore(self.connections)
+        try:
+            for start, end in itertools.islice(parts, self.connections + 1):
+                window.append(asyncio.ensure_future(self.fetch_async(start, end, slots)))
+            while window:
+                data = await window.popleft()
+                following = next(parts, None)
+                if following is not None:
+                    window.append(asyncio.ensure_future(self.fetch_async(*following, slots)))
+                yield data
+        finally:
+            for task in window:
+                task.cancel()
+
+
+def next_output(entry, limit=ZIP_SEND_BATCH_SIZE):
+    """Avança a escrita de uma entrada do ZIP até juntar ``limit`` bytes de saída"""
+    parts = []
+    size = 0
+    for data in entry:
+        parts.append(data)
+        size += len(data)
+        if size >= limit:
+            break
+    return b''.join(parts)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class ResponseSender:
+    """Envio de respostas ASGI com as métricas de requisição do modo WSGI"""
+
+    def __init__(self, send, endpoint, method):
+        self._send = send
+        self.endpoint = endpoint
+        self.method = method
+        self.start = time.perf_counter()
+        self.started = False
+        self.finished = False
+
+    async def start_response(self, status, content_type, headers=()):
+        self.started = True
+        HTTP_REQUESTS.inc(endpoint=self.endpoint, method=self.method, status=status)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - self.start, endpoint=self.endpoint)
+        await self._send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', content_type.encode())] + list(headers)
+        })
+
+    async def body(self, data, more=True):
+        self.finished = not more
+        await self._send({'type': 'http.response.body', 'body': bytes(data), 'more_body': more})
+
+    async def full(self, status, data, content_type, headers=()):
+        headers = [(b'content-length', str(len(data)).encode())] + list(headers)
+        await self.start_response(status, content_type, headers)
+        await self.body(data, more=False)
+
+    async def json(self, payload, status=200):
+        # Mesma serialização do jsonify do Flask
+        data = json.dumps(payload, sort_keys=True).encode() + b'\n'
+        await self.full(status, data, 'application/json', CORS_HEADERS)
+
+
+def header_value(scope, name):
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+class ThreadedWsgiInstance(WsgiToAsgiInstance):
+    # Cada requisição WSGI numa thread do pool padrão do loop, e não na
+    # thread única compartilhada (thread_sensitive) que o asgiref usa
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """``WsgiToAsgi`` em que um download longo de ``/jobs`` não bloqueia as outras rotas"""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+class AsyncApp:
+    """Aplicação ASGI: rotas assíncronas próprias e o resto via Flask"""
+
+    ROUTES = {
+        ('POST', '/scan'): 'scan',
+        ('GET', '/scan-stream'): 'scan_stream',
+        ('POST', '/scan-stream'): 'scan_stream',
+        ('POST', '/download-stream'): 'download_stream',
+    }
+
+    def __init__(self, wsgi_app):
+        self.fallback = ThreadedWsgiToAsgi(wsgi_app)
+        self.client = None
+
+    def get_client(self):
+        # Criado sob demanda para servidores que não enviam eventos de lifespan
+        if self.client is None:
+            self.client = build_client()
+        return self.client
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        route = self.ROUTES.get((scope.get('method'), scope.get('path')))
+        if scope['type'] != 'http' or route is None:
+            await self.fallback(scope, receive, send)
+            return
+
+        body = await read_body(receive)
+        if body is None:
+            return
+        sender = ResponseSender(send, scope['path'], scope['method'])
+        handler = asyncio.ensure_future(getattr(self, route)(scope, body, sender))
+        # Cliente desconectou: cancelar o trabalho em andamento contra o upstream
+        watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await asyncio.wait({handler, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            handler.cancel()
+            raise
+        finally:
+            watcher.cancel()
+        if not handler.done():
+            handler.cancel()
+            logger.info("Cliente desconectou durante %s %s", scope['method'], scope['path'])
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not handler.cancelled():
+                raise
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.get_client()
+                await asyncio.to_thread(warm_up)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                    self.client = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def scan(self, scope, body, sender):
+        try:
+            data = json.loads(body) if body else None
+            params, error = parse_scan_request(data or {})
+            if error:
+                await sender.json({"success": False, "error": error}, 400)
+                return
+
+            files, report = await scan_directory_shared_async(
+                self.get_client(), params['url'], params['file_type'],
+                include_src=params['include_src'],
+                resolve_sizes=params['resolve_sizes'],
+                use_cache=params['use_cache'],
+                max_depth=params['max_depth'],
+                budget=params['budget'],
+                resume=params['resume'],
+                continuation=params['continuation'],
+                use_index=params['use_index']
+            )
+
+            logger.info("Encontrados %d arquivos", len(files))
+
+            await sender.json({
+                "success": True,
+                "files_found": len(files),
+                "files": files,
+                **report,
+                "message": f"Encontrados {len(files)} arquivos do tipo {params['file_type']}"
+            })
+
+        except Exception as e:
+            logger.exception("Erro no escaneamento: %s", e)
+            await sender.json({"success": False, "error": f"Erro interno: {str(e)}"}, 500)
+
+    async def scan_stream(self, scope, body, sender):
+        """Escaneamento com resultados incrementais (NDJSON ou Server-Sent Events)"""
+        # EventSource só faz GET: aceitar os parâmetros também pela query string
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        if scope['method'] == 'GET':
+            data = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+            for flag in ('include_src', 'resolve_sizes', 'use_cache', 'use_index'):
+                if flag in data:
+                    data[flag] = data[flag].lower() in ('1', 'true', 'yes')
+
+        params, error = parse_scan_request(data)
+        if error:
+            await sender.json({"success": False, "error": error}, 400)
+            return
+
+        stream_format = data.get('format')
+        if not stream_format:
+            stream_format = 'sse' if 'text/event-stream' in header_value(scope, b'accept') else 'ndjson'
+        if stream_format not in SCAN_STREAM_FORMATS:
+            await sender.json({
+                "success": False,
+                "error": f"Formato inválido: {stream_format} (use 'ndjson' ou 'sse')"
+            }, 400)
+            return
+
+        crawler = AsyncScanCrawler(self.get_client(), params['file_type'], max_depth=params['max_depth'],
+                                   include_src=params['include_src'],
+                                   cache=scan_cache if params['use_cache'] else None,
+                                   budget=params['budget'], resume=params['resume'],
+                                   index=await open_scan_index(params['use_index']))
+
+        await sender.start_response(200, SCAN_STREAM_FORMATS[stream_format] + '; charset=utf-8', [
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ] + CORS_HEADERS)
+        events = crawler.events(params['url'], params['resolve_sizes'])
+        try:
+            async for event in events:
+                await sender.body(format_scan_event(event, stream_format).encode())
+        except Exception as e:
+            logger.exception("Erro no escaneamento: %s", e)
+            event = {'type': 'error', 'url': strip_credentials(params['url']), 'error': str(e)}
+            await sender.body(format_scan_event(event, stream_format).encode())
+        finally:
+            await events.aclose()
+        await sender.body(b'', more=False)
+
+    async def download_stream(self, scope, body, sender):
+        """Faz download de múltiplos arquivos e retorna como stream"""
+        try:
+            data = json.loads(body) if body else None
+            files, error = parse_download_request(data)
+            if error:
+                await sender.json({"success": False, "error": error}, 400)
+                return
+
+            logger.info("Iniciando download de %d arquivos", len(files))
+            logger.debug("Arquivos recebidos: %s", files)
+
+            # Se é apenas 1 arquivo, baixar direto (sem ZIP)
+            if len(files) == 1:
+                await self.download_single(files[0], sender)
+                return
+
+            # Múltiplos arquivos: ZIP gerado em streaming
+            entries = prepare_download_entries(files)
+            options, error = parse_archive_options(data)
+            if error:
+                await sender.json({"success": False, "error": error}, 400)
+                return
+
+            prefetched = AsyncDownloadPrefetcher(self.get_client(), entries).results(options['order'])
+            try:
+                await self.stream_zip(files, prefetched, ZipArchiveWriter(options['policy']), sender)
+            finally:
+                await prefetched.aclose()
+
+        except Exception as e:
+            error_details = traceback.format_exc()
+            logger.error("Erro no download stream: %s\n%s", e, error_details)
+            if sender.started:
+                # Headers já enviados: não cabe outra resposta, só encerrar o corpo
+                if not sender.finished:
+                    await sender.body(b'', more=False)
+                return
+            await sender.json({
+                "success": False,
+                "error": f"Erro ao fazer download: {str(e)}",
+                "details": error_details if flask_app.debug else None
+            }, 500)
+
+    async def stream_zip(self, files, prefetched, writer, sender):
+        # Esperar o primeiro arquivo baixado antes de responder: se nenhum
+        # estiver acessível ainda é possível devolver o erro 400 com os detalhes
+        first_result = None
+        async for result in prefetched:
+            if result.error is None:
+                first_result = result
+                break
+            writer.record_failure(result)
+
+        if first_result is None:
+            logger.info("Resumo: %d baixados, %d falharam", writer.downloaded_count, writer.failed_count)
+            await sender.json({
+                "success": False,
+                "error": "Nenhum arquivo foi baixado com sucesso",
+                "details": {
+                    "total": len(files),
+                    "downloaded": writer.downloaded_count,
+                    "failed": writer.failed_count,
+                    "errors": writer.error_messages
+                }
+            }, 400)
+            return
+
+        await sender.start_response(200, 'application/zip', [
+            (b'content-disposition', b'attachment; filename=arquivos.zip'),
+            (b'access-control-expose-headers', b'Content-Disposition, Content-Type'),
+        ] + DOWNLOAD_CORS_HEADERS)
+
+        buffer = ZipStreamBuffer()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            result = first_result
+            while result is not None:
+                # Compressão e leitura do corpo em thread, para não travar o
+                # event loop com CPU ou disco
+                entry = writer.write_entry(zipf, buffer, result)
+                while True:
+                    data = await asyncio.to_thread(next_output, entry)
+                    if not data:
+                        break
+                    BYTES_OUT.inc(len(data), endpoint='download_stream')
+                    await sender.body(data)
+                try:
+                    result = await prefetched.__anext__()
+                except StopAsyncIteration:
+                    result = None
+            writer.write_reports(zipf)
+
+        data = writer.emit(buffer)
+        BYTES_OUT.inc(len(data), endpoint='download_stream')
+        await sender.body(data, more=False)
+
+        logger.info("Resumo: %d baixados, %d falharam", writer.downloaded_count, writer.failed_count)
+        logger.debug("Compressão: CPU economizada estimada (acumulada) %.3fs", compression_stats.estimated_cpu_saved())
+        logger.info("ZIP enviado com sucesso. Tamanho: %d bytes", writer.total_bytes)
+
+    async def download_single(self, file_info, sender):
+        file_url, filename = resolve_single_download(file_info)
+
+        logger.info("Iniciando download: %s", filename, extra={'url': strip_credentials(file_url)})
+        start_time = time.time()
+
+        cached = await asyncio.to_thread(download_cache.lookup, file_url)
+        request_headers = dict(DOWNLOAD_HEADERS, **(cached.conditional_headers() if cached else {}))
+        # Só os headers por enquanto: o tamanho decide entre o caminho simples e o de arquivos grandes
+        client = self.get_client()
+        response = await client.send(client.build_request('GET', file_url, headers=request_headers, timeout=15),
+                                     stream=True)
+        try:
+            await self.send_single(response, file_url, filename, cached, sender, start_time)
+        finally:
+            await response.aclose()
+
+    async def send_single(self, response, file_url, filename, cached, sender, start_time):
+        headers = [(b'content-disposition', f'attachment; filename={filename}'.encode())] + DOWNLOAD_CORS_HEADERS + [
+            (b'access-control-expose-headers', b'Content-Disposition, Content-Length, Content-Type'),
+        ]
+
+        if cached is not None and response.status_code == 304:
+            # Corpo em cache ainda válido: lido do disco em blocos, fora do event loop
+            await asyncio.to_thread(download_cache.record_hit, cached)
+            BYTES_OUT.inc(cached.size, endpoint='download_stream')
+            content_type = cached.content_type or 'application/octet-stream'
+            logger.info("Arquivo servido do cache em %.2fs: %d bytes", time.time() - start_time, cached.size)
+            await sender.start_response(200, content_type, [(b'content-length', str(cached.size).encode())] + headers)
+            with cached.open() as handle:
+                while True:
+                    chunk = await asyncio.to_thread(handle.read, ZIP_STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await sender.body(chunk)
+            await sender.body(b'', more=False)
+            return
+        response.raise_for_status()
+
+        # Sem Content-Length (chunked) o tamanho só se sabe no fim: não carregar na memória
+        size = declared_length(response.headers)
+        if size is None or size >= DOWNLOAD_LARGE_THRESHOLD:
+            await self.send_large(response, file_url, headers, sender, start_time)
+            return
+
+        content = await response.aread()
+        if download_cache.cacheable(response.headers):
+            await asyncio.to_thread(store_single_download, file_url, response.headers, content)
+
+        download_time = time.time() - start_time
+        STAGE_SECONDS.observe(download_time, stage='file_download')
+        BYTES_IN.inc(len(content), kind='download')
+        BYTES_OUT.inc(len(content), endpoint='download_stream')
+
+        # Detectar tipo de conteúdo
+        content_type = response.headers.get('content-type', 'application/octet-stream')
+
+        logger.info("Arquivo baixado em %.2fs: %d bytes, tipo: %s", download_time, len(content), content_type)
+
+        await sender.full(200, content, content_type, headers)
+
+    async def send_large(self, response, file_url, headers, sender, start_time):
+        """Versão assíncrona de ``stream_large_download``"""
+        size = declared_length(response.headers)
+        content_type = response.headers.get('content-type', 'application/octet-stream')
+
+        if size is not None and RangedDownload.supported(response.headers):
+            # O corpo desta resposta não é usado: as faixas trazem tudo
+            await response.aclose()
+            final_url = str(response.url)
+            download = AsyncRangedDownload(self.get_client(), final_url, size, response.headers,
+                                           upstream_auth(file_url, final_url))
+            body = download.chunks()
+            mode = f"{len(download.parts())} faixas"
+        else:
+            download = None
+            body = response.aiter_bytes(ZIP_STREAM_CHUNK_SIZE)
+            mode = "streaming"
+        logger.info("Arquivo grande (%s bytes): download em %s", size if size is not None else '?', mode)
+
+        # Corpo comprimido pelo upstream chega descomprimido: tamanho final desconhecido
+        if size is not None and response.headers.get('content-encoding', 'identity').lower() == 'identity':
+            headers = [(b'content-length', str(size).encode())] + headers
+        await sender.start_response(200, content_type, headers)
+        sent = 0
+        try:
+            with IN_FLIGHT.track(kind='download'):
+                async for chunk in body:
+                    if download is None:
+                        BYTES_IN.inc(len(chunk), kind='download')
+                    sent += len(chunk)
+                    await sender.body(chunk)
+            STAGE_SECONDS.observe(time.time() - start_time, stage='file_download')
+            logger.info("Arquivo grande enviado em %.2fs: %d bytes%s", time.time() - start_time, sent,
+                        f", {download.retried} faixas repetidas" if download and download.retried else "")
+        except Exception as e:
+            # Headers já enviados: a resposta fica incompleta e o servidor encerra a conexão
+            logger.error("Download grande interrompido após %d de %s bytes: %s", sent,
+                         size if size is not None else '?', e)
+            return
+        finally:
+            BYTES_OUT.inc(sent, endpoint='download_stream')
+            await body.aclose()
+        await sender.body(b'', more=False)
+
+
+app = AsyncApp(flask_app)
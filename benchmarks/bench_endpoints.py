@@ -0,0 +1,259 @@
+"""Benchmark de ponta a ponta do /scan e do /download-stream.
+
+Sobe o ``MockFileServer`` (árvore autoindex sintética + páginas Plone ``/view``)
+e dispara requisições concorrentes contra a API de duas formas:
+
+- ``test_client``: cliente de teste do Flask, no mesmo processo (sem rede)
+- ``wsgi``: servidor WSGI real do Werkzeug (``make_server``, com threads)
+- ``asgi``: modo assíncrono (``asgi.py``) sob uvicorn; requer ``requirements-async.txt``
+
+Cenários: ``scan`` (árvore inteira), ``download`` (ZIP com arquivos da árvore)
+e ``plone`` (ZIP a partir de URLs ``/view``). Para cada modo/cenário são
+reportados vazão, latência p50/p99 e pico de RSS do processo; o resultado é
+salvo em JSON e pode ser comparado com uma execução anterior (``--compare``).
+
+Os caches de listagem e de download ficam desligados por padrão, para medir
+o trabalho real contra o upstream.
+
+Uso:
+    python benchmarks/bench_endpoints.py --requests 20 --concurrency 4 --latency 0.01
+    python benchmarks/bench_endpoints.py --compare benchmarks/results/anterior.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Configuração lida na importação do application
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from mock_server import MockFileServer, TreeConfig  # noqa: E402
+
+SCENARIOS = ('scan', 'download', 'plone')
+MODES = ('test_client', 'wsgi', 'asgi')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+class TestClientDriver:
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, path, payload):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post(path, json=payload)
+        return response.status_code, len(response.get_data())
+
+    def close(self):
+        pass
+
+
+class WSGIDriver:
+    def __init__(self, app):
+        import requests
+        from werkzeug.serving import make_server
+
+        self._requests = requests
+        # Sem o log de acesso por requisição do servidor de desenvolvimento
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        self._local = threading.local()
+
+    def post(self, path, payload):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        response = session.post(self.base_url + path, json=payload, timeout=300)
+        return response.status_code, len(response.content)
+
+    def close(self):
+        self.server.shutdown()
+
+
+class ASGIDriver(WSGIDriver):
+    def __init__(self, app):
+        import requests
+        import uvicorn
+        from asgi import app as asgi_app
+
+        self._requests = requests
+        self.server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=0, log_level='warning'))
+        self._thread = threading.Thread(target=self.server.run, daemon=True)
+        self._thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.base_url = f'http://127.0.0.1:{port}'
+        self._local = threading.local()
+
+    def close(self):
+        self.server.should_exit = True
+        self._thread.join()
+
+
+def build_payload(scenario, server, args):
+    if scenario == 'scan':
+        return '/scan', {
+            'url': f'{server.base_url}/tree/',
+            'file_type': 'pdf',
+            'use_cache': args.use_cache
+        }
+    urls = server.tree_urls() if scenario == 'download' else server.plone_urls()
+    files = [{'url': url, 'filename': f'arquivo_{idx}.pdf'} for idx, url in enumerate(urls[:args.download_files])]
+    return '/download-stream', {'files': files, 'compression': args.compression}
+
+
+def run_scenario(driver, path, payload, args):
+    latencies = []
+    errors = 0
+    total_bytes = 0
+    lock = threading.Lock()
+
+    def one_request(_):
+        nonlocal errors, total_bytes
+        start = time.perf_counter()
+        try:
+            status, size = driver.post(path, payload)
+        except Exception:
+            status, size = None, 0
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            total_bytes += size
+            if status != 200:
+                errors += 1
+
+    for _ in range(args.warmup):
+        one_request(None)
+    latencies.clear()
+    errors = 0
+    total_bytes = 0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one_request, range(args.requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        'requests': args.requests,
+        'errors': errors,
+        'seconds': round(wall, 4),
+        'throughput_rps': round(args.requests / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'mb_out': round(total_bytes / 1024 / 1024, 2),
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as handle:
+        baseline = {(item['mode'], item['scenario']): item for item in json.load(handle)['results']}
+    print(f"\nComparação com {baseline_path}:")
+    print(f"{'modo':<12} {'cenário':<9} {'req/s':>16} {'p50 (ms)':>18} {'p99 (ms)':>18}")
+    for item in results:
+        old = baseline.get((item['mode'], item['scenario']))
+        if old is None:
+            continue
+        cells = []
+        for key in ('throughput_rps', 'p50_ms', 'p99_ms'):
+            delta = (item[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            cells.append(f"{item[key]:>8} ({delta:+5.1f}%)")
+        print(f"{item['mode']:<12} {item['scenario']:<9} {cells[0]:>16} {cells[1]:>18} {cells[2]:>18}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--files', type=int, default=5)
+    parser.add_argument('--file-size', type=int, default=256 * 1024)
+    parser.add_argument('--latency', type=float, default=0.005, help='atraso por resposta do mock, em segundos')
+    parser.add_argument('--plone-docs', type=int, default=20)
+    parser.add_argument('--download-files', type=int, default=20, help='arquivos por ZIP')
+    parser.add_argument('--compression', default='auto', choices=('auto', 'store', 'deflate'))
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--modes', default='test_client,wsgi', help=f"modos separados por vírgula ({', '.join(MODES)})")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--use-cache', action='store_true', help='liga os caches de listagem e de download')
+    parser.add_argument('--output', help='arquivo JSON (padrão: benchmarks/results/<data>.json)')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    args = parser.parse_args()
+
+    if not args.use_cache:
+        os.environ['DOWNLOAD_CACHE_MAX_MB'] = '0'
+    from application import VERSION, app
+
+    config = TreeConfig(args.fanout, args.depth, args.files, args.file_size, args.latency, args.plone_docs)
+    server = MockFileServer(config).start()
+    drivers = {'test_client': TestClientDriver, 'wsgi': WSGIDriver, 'asgi': ASGIDriver}
+
+    results = []
+    print(f"Árvore: {config.total_files()} arquivos, latência {args.latency * 1000:.0f} ms; "
+          f"{args.requests} requisições, concorrência {args.concurrency}")
+    print(f"{'modo':<12} {'cenário':<9} {'req/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'MB saída':>9} {'RSS (MB)':>9} {'erros':>6}")
+    try:
+        for mode in filter(None, args.modes.split(',')):
+            driver = drivers[mode](app)
+            try:
+                for scenario in filter(None, args.scenarios.split(',')):
+                    path, payload = build_payload(scenario, server, args)
+                    result = dict(mode=mode, scenario=scenario, **run_scenario(driver, path, payload, args))
+                    results.append(result)
+                    print(f"{mode:<12} {scenario:<9} {result['throughput_rps']:>8} {result['p50_ms']:>9} "
+                          f"{result['p99_ms']:>9} {result['mb_out']:>9} {result['peak_rss_mb']:>9} {result['errors']:>6}")
+            finally:
+                driver.close()
+    finally:
+        server.stop()
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'version': VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': dict(vars(args), tree=config.to_dict()),
+        'results': results
+    }
+    with open(output, 'w') as handle:
+        json.dump(report, handle, indent=2)
+    print(f"\nResultados salvos em {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Benchmark da partida a frio: tempo de importação do módulo da API.
+
+Cada rodada é um processo Python novo com ``-X importtime`` importando o
+módulo (``application`` por padrão, ou ``asgi``); o relatório do interpretador
+é lido e, entre as rodadas, fica a mediana de:
+
+- ``total``: importação completa do módulo (com todas as dependências)
+- ``self``: só o corpo do módulo (classes, regex, singletons)
+- cada import direto do módulo (``flask``, ``requests``, ...), acumulado
+- ``process``: processo inteiro, do ``exec`` ao fim (inclui o interpretador)
+
+Com ``--first-request`` o processo também atende uma requisição pelo cliente
+de teste do Flask e o tempo dela entra como ``first_request``. Cada processo
+recebe um ``TMPDIR`` vazio, como um contêiner novo (caches e índice SQLite
+ainda não existem); ``--reuse-tmp`` mantém o diretório temporário do sistema.
+O bytecode do módulo é recompilado antes das rodadas, para que um ``.pyc``
+desatualizado não pese na medição. O resultado é salvo em JSON e pode ser
+comparado com uma execução anterior (``--compare``).
+
+Uso:
+    python benchmarks/bench_import_time.py --runs 15
+    python benchmarks/bench_import_time.py --env WARM_START=1 --first-request /stats
+    python benchmarks/bench_import_time.py --compare benchmarks/results/import-anterior.json
+"""
+import argparse
+import compileall
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Impresso pelo processo filho depois da importação (e da primeira requisição)
+FIRST_REQUEST_SCRIPT = '''
+import time
+import {module}
+start = time.perf_counter()
+{module}.{app}.test_client().get({path!r})
+print('first_request_us', int((time.perf_counter() - start) * 1e6))
+'''
+
+
+def parse_importtime(stderr, module):
+    """Tempos (µs) do módulo e de seus imports diretos a partir da saída do ``-X importtime``"""
+    lines = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_part, cumulative_part, raw_name = line.split('|', 2)
+        self_us = int(self_part.split(':')[1])
+        cumulative_us = int(cumulative_part)
+        # Um espaço separa a coluna do nome; cada nível de import acrescenta dois
+        depth = (len(raw_name) - len(raw_name.lstrip(' ')) - 1) // 2
+        lines.append((depth, raw_name.strip(), self_us, cumulative_us))
+
+    # O relatório lista os filhos antes do pai: os imports diretos são as
+    # linhas de profundidade 1 logo antes da linha do módulo
+    for index, (depth, name, self_us, cumulative_us) in enumerate(lines):
+        if depth == 0 and name == module:
+            children = {}
+            for child_depth, child_name, _, child_cumulative in reversed(lines[:index]):
+                if child_depth == 0:
+                    break
+                if child_depth == 1:
+                    children[child_name] = child_cumulative
+            return {'total': cumulative_us, 'self': self_us, 'imports': children}
+    raise RuntimeError(f"Módulo {module} não encontrado na saída do -X importtime")
+
+
+def run_once(args, env):
+    if args.first_request:
+        app_name = 'app' if args.module == 'application' else 'flask_app'
+        code = FIRST_REQUEST_SCRIPT.format(module=args.module, app=app_name, path=args.first_request)
+    else:
+        code = f'import {args.module}'
+    if not args.reuse_tmp:
+        scratch = tempfile.TemporaryDirectory(prefix='bench-import-')
+        env = dict(env, TMPDIR=scratch.name)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, env=env,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if not args.reuse_tmp:
+        scratch.cleanup()
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    sample = parse_importtime(result.stderr, args.module)
+    sample['process'] = int(elapsed * 1e6)
+    for line in result.stdout.splitlines():
+        if line.startswith('first_request_us '):
+            sample['first_request'] = int(line.split()[1])
+    return sample
+
+
+def summarize(samples, top):
+    def median_ms(values):
+        return round(statistics.median(values) / 1000, 2)
+
+    summary = {key: median_ms([sample[key] for sample in samples])
+               for key in ('total', 'self', 'process', 'first_request') if key in samples[0]}
+    names = set().union(*(sample['imports'] for sample in samples))
+    imports = {name: median_ms([sample['imports'].get(name, 0) for sample in samples]) for name in names}
+    summary['imports'] = dict(sorted(imports.items(), key=lambda item: -item[1])[:top])
+    return summary
+
+
+def compare(summary, baseline_path):
+    with open(baseline_path) as handle:
+        baseline = json.load(handle)['summary']
+    print(f"\nComparação com {baseline_path}:")
+    print(f"{'medida':<28} {'antes (ms)':>11} {'agora (ms)':>11} {'delta':>8}")
+    rows = [(key, baseline.get(key), summary.get(key)) for key in ('total', 'self', 'process', 'first_request')]
+    names = list(dict.fromkeys(list(summary['imports']) + list(baseline['imports'])))
+    rows += [(f"  {name}", baseline['imports'].get(name, 0.0), summary['imports'].get(name, 0.0)) for name in names]
+    for label, old, new in rows:
+        if old is None or new is None:
+            continue
+        delta = f"{(new - old) / old * 100:+5.1f}%" if old else '   novo'
+        print(f"{label:<28} {old:>11} {new:>11} {delta:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='application', choices=('application', 'asgi'))
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=12, help='imports diretos listados')
+    parser.add_argument('--first-request', metavar='PATH', help='atende uma requisição GET após a importação')
+    parser.add_argument('--reuse-tmp', action='store_true', help='não isola o TMPDIR de cada processo')
+    parser.add_argument('--env', action='append', default=[], metavar='NOME=VALOR',
+                        help='variável de ambiente do processo medido (repetível)')
+    parser.add_argument('--output', help='arquivo JSON (padrão: benchmarks/results/import-<data>.json)')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    args = parser.parse_args()
+
+    env = dict(os.environ, LOG_LEVEL='WARNING')
+    env.update(item.split('=', 1) for item in args.env)
+    compileall.compile_file(os.path.join(ROOT, f'{args.module}.py'), quiet=1)
+    if args.module == 'asgi':
+        compileall.compile_file(os.path.join(ROOT, 'application.py'), quiet=1)
+
+    # Uma rodada descartada: caches do sistema de arquivos e do interpretador
+    run_once(args, env)
+    samples = [run_once(args, env) for _ in range(args.runs)]
+    summary = summarize(samples, args.top)
+
+    print(f"Importação de {args.module}: mediana de {args.runs} processos")
+    print(f"{'total':<28} {summary['total']:>8} ms")
+    print(f"{'corpo do módulo (self)':<28} {summary['self']:>8} ms")
+    print(f"{'processo inteiro':<28} {summary['process']:>8} ms")
+    if 'first_request' in summary:
+        print(f"{'primeira requisição':<28} {summary['first_request']:>8} ms")
+    print("Imports diretos (acumulado):")
+    for name, value in summary['imports'].items():
+        print(f"  {name:<26} {value:>8} ms")
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         'import-' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'summary': summary
+    }
+    with open(output, 'w') as handle:
+        json.dump(report, handle, indent=2)
+    print(f"\nResultados salvos em {output}")
+
+    if args.compare:
+        compare(summary, args.compare)
+
+
+if __name__ == '__main__':
+    main()
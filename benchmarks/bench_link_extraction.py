@@ -0,0 +1,138 @@
+"""Micro-benchmark da extração de links das listagens HTML do /scan.
+
+Compara, em listagens autoindex grandes (Apache em tabela e nginx em <pre>):
+
+- ``regex``: implementação anterior (várias passadas de ``re.findall`` no corpo inteiro)
+- ``html.parser``: referência com ``html.parser`` da stdlib, alimentado em blocos
+- ``extractor``: ``LinkExtractor`` atual, incremental, alimentado em blocos
+
+Uso:
+    python benchmarks/bench_link_extraction.py [--entries 20000] [--repeat 5]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+import tracemalloc
+from html.parser import HTMLParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from application import (  # noqa: E402
+    AUTOINDEX_SIZE_PATTERN,
+    LISTING_CHUNK_SIZE,
+    LinkExtractor,
+    parse_size_token,
+)
+
+
+def legacy_extract(body, file_type, include_src=False):
+    """Implementação anterior do scan"""
+    links = re.findall(r'<a[^>]*href=["\']([^"\']*)["\'][^>]*>', body, re.IGNORECASE)
+    if include_src:
+        src_pattern = r'<(?:img|script|iframe|video|audio|source|embed)[^>]*src=["\']([^"\']*)["\'][^>]*>'
+        links.extend(re.findall(src_pattern, body, re.IGNORECASE))
+    if len(links) == 0:
+        file_patterns = {
+            'pdf': r'[^"\'>\s]+\.pdf(?:\?[^"\'>\s]*)?',
+            'zip': r'[^"\'>\s]+\.(?:zip|7z|rar|tar|gz|bz2)(?:\?[^"\'>\s]*)?',
+            'images': r'[^"\'>\s]+\.(?:png|jpg|jpeg|gif|bmp|webp|svg)(?:\?[^"\'>\s]*)?'
+        }
+        if file_type in file_patterns:
+            links.extend(re.findall(file_patterns[file_type], body, re.IGNORECASE))
+
+    # Leitura da coluna "Size" (antiga parse_listing_sizes)
+    row_pattern = r'<a[^>]*href=["\']([^"\']*)["\'][^>]*>.*?</a>(.*?)(?=<a[\s>]|</tr>|\n|$)'
+    sizes = {}
+    for href, row in re.findall(row_pattern, body, re.IGNORECASE | re.DOTALL):
+        match = AUTOINDEX_SIZE_PATTERN.search(re.sub(r'<[^>]+>', ' ', row).replace('&nbsp;', ' '))
+        if match:
+            sizes[href] = parse_size_token(match.group(1))
+    return links
+
+
+class _ReferenceParser(HTMLParser):
+    """Só coleta hrefs/srcs: limite inferior do custo do html.parser"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if value and (name == 'href' and tag == 'a'):
+                self.links.append(value)
+
+
+def html_parser_extract(body, file_type, include_src=False):
+    parser = _ReferenceParser()
+    for start in range(0, len(body), LISTING_CHUNK_SIZE):
+        parser.feed(body[start:start + LISTING_CHUNK_SIZE])
+    parser.close()
+    return parser.links
+
+
+def extractor_extract(body, file_type, include_src=False):
+    extractor = LinkExtractor(file_type, include_src)
+    for start in range(0, len(body), LISTING_CHUNK_SIZE):
+        extractor.feed(body[start:start + LISTING_CHUNK_SIZE])
+    extractor.close()
+    return extractor.links()
+
+
+IMPLEMENTATIONS = (
+    ('regex', legacy_extract),
+    ('html.parser', html_parser_extract),
+    ('extractor', extractor_extract),
+)
+
+
+def apache_fixture(entries):
+    rows = ''.join(
+        f'<tr><td valign="top"><img src="/icons/layout.gif" alt="[   ]"></td>'
+        f'<td><a href="arquivo_{i}.pdf">arquivo_{i}.pdf</a></td>'
+        f'<td align="right">2026-10-01 10:22  </td><td align="right">{i % 900 + 1}K</td><td>&nbsp;</td></tr>\n'
+        for i in range(entries)
+    )
+    return f'<html><body><table>{rows}</table></body></html>'
+
+
+def nginx_fixture(entries):
+    rows = ''.join(
+        f'<a href="arquivo_{i}.pdf">arquivo_{i}.pdf</a>{" " * 40}18-Oct-2026 10:00{" " * 12}{i * 37}\n'
+        for i in range(entries)
+    )
+    return f'<html><body><pre><a href="../">../</a>\n{rows}</pre></body></html>'
+
+
+def measure(func, body, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(body, 'pdf')
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func(body, 'pdf')
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fixtures = {'apache': apache_fixture(args.entries), 'nginx': nginx_fixture(args.entries)}
+    print(f"{'fixture':<8} {'MB':>6} {'impl':<12} {'melhor (s)':>11} {'pico (MB)':>10} {'links':>7}")
+    for name, body in fixtures.items():
+        size_mb = len(body) / 1024 / 1024
+        for impl, func in IMPLEMENTATIONS:
+            best, peak, links = measure(func, body, args.repeat)
+            print(f"{name:<8} {size_mb:>6.1f} {impl:<12} {best:>11.4f} {peak / 1024 / 1024:>10.2f} {links:>7}")
+
+
+if __name__ == '__main__':
+    main()
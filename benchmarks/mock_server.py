@@ -0,0 +1,206 @@
+"""Servidor HTTP local com árvores autoindex sintéticas, para os benchmarks.
+
+Rotas:
+
+- ``/tree/...``: listagem estilo nginx (``<pre>``) com ``fanout`` subdiretórios
+  por nível até ``depth`` níveis e ``files`` arquivos PDF por diretório
+- ``/plone/``: pasta estilo Plone com links ``<doc>/view``; cada ``/view`` é
+  uma página HTML e ``<doc>/@@download/file`` entrega o arquivo
+
+Todas as respostas têm ``Content-Length`` (keep-alive), ``ETag`` com suporte a
+``If-None-Match`` e um atraso opcional (``latency``) antes de responder.
+
+Uso isolado:
+    python benchmarks/mock_server.py --fanout 4 --depth 3 --files 10 --port 8900
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class TreeConfig:
+    """Forma da árvore sintética servida pelo ``MockFileServer``"""
+
+    def __init__(self, fanout=3, depth=3, files=5, file_size=64 * 1024, latency=0.0,
+                 plone_docs=20, compressible=0.5):
+        self.fanout = fanout
+        self.depth = depth
+        self.files = files
+        self.file_size = file_size
+        self.latency = latency
+        self.plone_docs = plone_docs
+        self.compressible = compressible
+
+    def total_files(self):
+        directories = sum(self.fanout ** level for level in range(self.depth + 1))
+        return directories * self.files
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head):
+        config = self.server.config
+        if config.latency:
+            time.sleep(config.latency)
+        path = self.path.split('?', 1)[0]
+        self.server.count(path)
+
+        if path.startswith('/tree/'):
+            route = self.tree_listing if path.endswith('/') else self.file_body
+        elif path.startswith('/plone/'):
+            route = self.plone_page
+        else:
+            route = None
+        result = route(path) if route else None
+        if result is None:
+            self.send_body(404, b'not found', 'text/plain', head)
+            return
+        status, body, content_type = result
+        self.send_body(status, body, content_type, head)
+
+    def send_body(self, status, body, content_type, head):
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def tree_listing(self, path):
+        config = self.server.config
+        level = len([part for part in path.split('/') if part]) - 1
+        if level > config.depth:
+            return None
+        rows = ['<a href="../">../</a>']
+        if level < config.depth:
+            rows.extend(f'<a href="d{i}/">d{i}/</a>{" " * 30}18-Oct-2026 10:00{" " * 19}-'
+                        for i in range(config.fanout))
+        rows.extend(f'<a href="f{i}.pdf">f{i}.pdf</a>{" " * 30}18-Oct-2026 10:00{config.file_size:>20}'
+                    for i in range(config.files))
+        title = f'Index of {path}'
+        body = f'<html><head><title>{title}</title></head><body><h1>{title}</h1><hr><pre>' \
+               + '\n'.join(rows) + '\n</pre><hr></body></html>'
+        return 200, body.encode(), 'text/html'
+
+    def file_body(self, path):
+        return 200, self.server.file_content(path), 'application/pdf'
+
+    def plone_page(self, path):
+        config = self.server.config
+        if path == '/plone/':
+            links = ''.join(f'<li><a href="/plone/doc-{i}.pdf/view">Documento {i}</a></li>'
+                            for i in range(config.plone_docs))
+            return 200, f'<html><body><ul>{links}</ul></body></html>'.encode(), 'text/html'
+        if path.endswith('/view'):
+            doc = path[:-len('/view')]
+            body = f'<html><body><a href="{doc}/@@download/file">Baixar</a></body></html>'
+            return 200, body.encode(), 'text/html'
+        if path.endswith('/@@download/file'):
+            return 200, self.server.file_content(path), 'application/pdf'
+        return None
+
+
+class MockFileServer(ThreadingHTTPServer):
+    """Servidor em thread própria; ``base_url`` aponta para ``127.0.0.1:<porta>``"""
+
+    daemon_threads = True
+    # Backlog padrão (5) descarta conexões em rajadas e distorce a latência
+    request_queue_size = 1024
+
+    def __init__(self, config=None, port=0):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.config = config or TreeConfig()
+        self.requests = 0
+        self._lock = threading.Lock()
+        # Parte aleatória (incompressível) compartilhada; o prefixo torna cada arquivo único
+        random_size = int(self.config.file_size * (1 - self.config.compressible))
+        self._random_block = os.urandom(random_size)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, path):
+        with self._lock:
+            self.requests += 1
+
+    def file_content(self, path):
+        size = self.config.file_size
+        prefix = (path.encode() * (size // max(len(path), 1) + 1))[:size - len(self._random_block)]
+        return prefix + self._random_block
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def tree_urls(self):
+        """URLs de todos os arquivos da árvore, em ordem de profundidade"""
+        urls = []
+
+        def walk(prefix, level):
+            urls.extend(f'{prefix}f{i}.pdf' for i in range(self.config.files))
+            if level < self.config.depth:
+                for i in range(self.config.fanout):
+                    walk(f'{prefix}d{i}/', level + 1)
+
+        walk(f'{self.base_url}/tree/', 0)
+        return urls
+
+    def plone_urls(self):
+        return [f'{self.base_url}/plone/doc-{i}.pdf/view' for i in range(self.config.plone_docs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--files', type=int, default=5)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='atraso por resposta, em segundos')
+    parser.add_argument('--plone-docs', type=int, default=20)
+    parser.add_argument('--port', type=int, default=8900)
+    args = parser.parse_args()
+
+    config = TreeConfig(args.fanout, args.depth, args.files, args.file_size, args.latency, args.plone_docs)
+    server = MockFileServer(config, args.port)
+    print(f"Servindo {config.total_files()} arquivos em {server.base_url}/tree/ e {server.base_url}/plone/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Módulos da API ficam na raiz do repositório (sem pacote)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+# Caches e índice SQLite num diretório temporário próprio da execução
+os.environ.setdefault('SITE_INDEX_DB', os.path.join(tempfile.mkdtemp(prefix='autohunter-tests-'), 'index.db'))
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip('httpx')
+import httpx
+
+import asgi
+from application import SiteIndex
+from mock_server import MockFileServer, TreeConfig
+
+
+@pytest.fixture
+def tree_server():
+    server = MockFileServer(TreeConfig(fanout=2, depth=1, files=2, file_size=256)).start()
+    yield server
+    server.stop()
+
+
+class ThreadRecorder:
+    """Envolve métodos de um objeto e anota em que thread cada chamada rodou"""
+
+    def __init__(self, target, names):
+        self.calls = []
+        for name in names:
+            setattr(target, name, self._wrap(name, getattr(target, name)))
+
+    def _wrap(self, name, method):
+        def wrapper(*args, **kwargs):
+            self.calls.append((name, threading.get_ident()))
+            return method(*args, **kwargs)
+        return wrapper
+
+    def on_thread(self, ident):
+        return [name for name, thread in self.calls if thread == ident]
+
+
+def run_on_loop(coroutine_factory):
+    """Roda a corrotina e devolve (resultado, id da thread do event loop)"""
+    async def main():
+        return await coroutine_factory(), threading.get_ident()
+    return asyncio.run(main())
+
+
+def test_index_priorities_stay_off_the_event_loop(tree_server, tmp_path):
+    index = SiteIndex(str(tmp_path / 'index.db'))
+    assert index.open()
+    recorder = ThreadRecorder(index, ['priorities', 'record'])
+
+    async def scan():
+        async with httpx.AsyncClient() as client:
+            for _ in range(2):
+                crawler = asgi.AsyncScanCrawler(client, 'pdf', index=index)
+                files = await crawler.run(tree_server.base_url + '/tree/')
+        return files
+
+    files, loop_thread = run_on_loop(scan)
+    assert len(files) == 6
+    assert [name for name, _ in recorder.calls] == ['priorities', 'record'] * 2
+    assert recorder.on_thread(loop_thread) == []
+
+
+def test_site_index_opens_off_the_event_loop(tree_server, tmp_path, monkeypatch):
+    # Índice ainda fechado, como na partida a frio
+    index = SiteIndex(str(tmp_path / 'index.db'))
+    monkeypatch.setattr(asgi, 'site_index', index)
+    recorder = ThreadRecorder(index, ['_open_db', 'priorities', 'record'])
+
+    async def scan():
+        async with httpx.AsyncClient() as client:
+            return await asgi.scan_directory_shared_async(client, tree_server.base_url + '/tree/', 'pdf',
+                                                          use_cache=False)
+
+    (files, report), loop_thread = run_on_loop(scan)
+    assert len(files) == 6 and report['complete']
+    assert [name for name, _ in recorder.calls] == ['_open_db', 'priorities', 'record']
+    assert recorder.on_thread(loop_thread) == []
+
+
+def test_download_error_after_headers_ends_the_body(tree_server, monkeypatch):
+    original = asgi.ZipArchiveWriter.write_entry
+
+    def failing_write_entry(self, zipf, buffer, result):
+        # Falha no segundo arquivo, depois de o 200 e o início do ZIP já terem saído
+        if result.entry['filename'] == 'f1.pdf':
+            raise RuntimeError('falha no meio do ZIP')
+        return original(self, zipf, buffer, result)
+
+    monkeypatch.setattr(asgi.ZipArchiveWriter, 'write_entry', failing_write_entry)
+    body = ('{"files": ["%s/tree/f0.pdf", "%s/tree/f1.pdf"]}' % (tree_server.base_url, tree_server.base_url)).encode()
+    scope = {'type': 'http', 'method': 'POST', 'path': '/download-stream', 'headers': [], 'query_string': b''}
+    messages = []
+
+    async def download():
+        app = asgi.AsyncApp(asgi.flask_app)
+        requests = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+
+        try:
+            await app(scope, receive, send)
+        finally:
+            await app.get_client().aclose()
+
+    run_on_loop(download)
+    starts = [message for message in messages if message['type'] == 'http.response.start']
+    assert [message['status'] for message in starts] == [200]
+    assert messages[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
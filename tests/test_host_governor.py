@@ -0,0 +1,60 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from application import HTTP_RETRY_AFTER_MAX, app
+
+
+class BusyHandler(BaseHTTPRequestHandler):
+    """Raiz com 8 subdiretórios; cada um responde 503 com um Retry-After longo"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/':
+            links = ''.join(f'<a href="d{i}/">d{i}/</a>\n' for i in range(8))
+            body = f'<html><title>Index of /</title><body><h1>Index of /</h1><pre>{links}</pre></body></html>'.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+        else:
+            self.server.busy_hits += 1
+            body = b'busy'
+            self.send_response(503)
+            self.send_header('Retry-After', '120')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def busy_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BusyHandler)
+    server.busy_hits = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_long_retry_after_fails_fast(busy_server):
+    start = time.monotonic()
+    response = app.test_client().post('/scan', json={
+        'url': f'http://127.0.0.1:{busy_server.server_address[1]}/',
+        'file_type': 'pdf',
+        'use_cache': False,
+        'use_index': False
+    })
+    elapsed = time.monotonic() - start
+    result = response.get_json()
+
+    # Sem dormir o Retry-After nem repetir dentro do urllib3
+    assert elapsed < HTTP_RETRY_AFTER_MAX
+    assert busy_server.busy_hits <= 8
+    assert result['complete'] is False
+    assert result['partial_reason'] == 'breaker'
+    assert result['skipped'] and result['skipped'][0]['reason'] == 'Retry-After de 120s'
@@ -0,0 +1,41 @@
+import math
+
+import pytest
+
+from application import SCAN_DEADLINE_SECONDS, SCAN_MAX_PAGES, ScanBudget, app
+
+
+@pytest.mark.parametrize('value', ['nan', float('nan'), 'inf', float('inf'), '-inf', 1e400])
+def test_rejects_non_finite_limits(value):
+    budget, error = ScanBudget.from_request({'max_seconds': value})
+    assert budget is None
+    assert 'max_seconds' in error
+
+
+@pytest.mark.parametrize('name', ['max_seconds', 'max_pages', 'max_files', 'max_listing_bytes'])
+@pytest.mark.parametrize('value', [True, False])
+def test_rejects_booleans(name, value):
+    budget, error = ScanBudget.from_request({name: value})
+    assert budget is None
+    assert name in error
+
+
+def test_accepts_lower_limits_and_clamps_to_server_maximum():
+    budget, error = ScanBudget.from_request({'max_seconds': '0.5', 'max_pages': 10 ** 9})
+    assert error is None
+    assert budget.max_seconds == 0.5
+    assert budget.max_pages == SCAN_MAX_PAGES
+
+
+def test_deadline_stays_finite():
+    budget, _ = ScanBudget.from_request({})
+    budget.start()
+    assert math.isfinite(budget.remaining())
+    assert budget.remaining() <= SCAN_DEADLINE_SECONDS
+
+
+@pytest.mark.parametrize('value', ['nan', True])
+def test_scan_endpoint_returns_400(value):
+    response = app.test_client().post('/scan', json={'url': 'http://127.0.0.1:1/', 'max_seconds': value})
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False